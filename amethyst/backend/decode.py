@@ -88,6 +88,250 @@ def Control(inst, itype, ctrl):
         with opcode_match & funct3_match & funct7_match:
             SetControlSignals(inst_spec, itype, ctrl)
 
+def ExpandCompressed(inst):
+    """Expand an RVC (compressed) instruction into its 32-bit equivalent.
+
+    Only the low 16 bits of inst are considered. Instructions that aren't
+    compressed are passed through unchanged. Compressed encodings without a
+    32-bit equivalent in RV64IC (the floating point loads / stores and the
+    reserved encodings) expand to 0, which doesn't match any instruction.
+    """
+
+    expanded = Wire(Bits(32))
+
+    def Lit(value, width):
+        lit = Wire(Bits(width))
+        lit <<= value
+        return lit
+
+    zero = Lit(0, 1)
+    c = Wire(Bits(16))
+    c <<= inst(15, 0)
+    c12 = c(12, 12)
+
+    #
+    # The 3-bit register fields (rd', rs1', rs2') name x8 - x15.
+    #
+
+    rd = c(11, 7)
+    rs2 = c(6, 2)
+    rdp = Cat([Lit(0b01, 2), c(4, 2)])
+    rs1p = Cat([Lit(0b01, 2), c(9, 7)])
+    x0 = Lit(0, 5)
+    x1 = Lit(1, 5)
+    x2 = Lit(2, 5)
+
+    #
+    # Instruction format encoders. Immediates are given at their full width
+    # (including the implicit low zero bit for branches and jumps).
+    #
+
+    def IType(imm, rs1, funct3, rd, opcode):
+        return Cat([imm, rs1, Lit(funct3, 3), rd, Lit(opcode, 7)])
+
+    def SType(imm, rs2, rs1, funct3):
+        return Cat([
+            imm(11, 5), rs2, rs1, Lit(funct3, 3), imm(4, 0),
+            Lit(Opcodes.STORE, 7)
+        ])
+
+    def RType(funct7, rs2, rs1, funct3, rd, opcode):
+        return Cat([
+            Lit(funct7, 7), rs2, rs1, Lit(funct3, 3), rd, Lit(opcode, 7)
+        ])
+
+    def BType(imm, rs1, funct3):
+        return Cat([
+            imm(12, 12), imm(10, 5), x0, rs1, Lit(funct3, 3), imm(4, 1),
+            imm(11, 11), Lit(Opcodes.BRANCH, 7)
+        ])
+
+    def JType(imm, rd):
+        return Cat([
+            imm(20, 20), imm(10, 1), imm(11, 11), imm(19, 12), rd,
+            Lit(Opcodes.JAL, 7)
+        ])
+
+    def Imm(width, fields):
+        imm = Wire(Bits(width))
+        imm <<= Cat(fields)
+        return imm
+
+    #
+    # Immediates, as laid out by the RVC spec.
+    #
+
+    imm6 = Imm(12, [Fill(c12, 7), c(6, 2)])
+    shamt = Imm(6, [c12, c(6, 2)])
+    lui_imm = Imm(20, [Fill(c12, 15), c(6, 2)])
+
+    addi4spn_imm = Imm(12, [
+        Fill(zero, 2), c(10, 7), c(12, 11), c(5, 5), c(6, 6), Fill(zero, 2)])
+
+    addi16sp_imm = Imm(12, [
+        Fill(c12, 3), c(4, 3), c(5, 5), c(2, 2), c(6, 6), Fill(zero, 4)])
+
+    lw_imm = Imm(12, [
+        Fill(zero, 5), c(5, 5), c(12, 10), c(6, 6), Fill(zero, 2)])
+
+    ld_imm = Imm(12, [Fill(zero, 4), c(6, 5), c(12, 10), Fill(zero, 3)])
+
+    lwsp_imm = Imm(12, [
+        Fill(zero, 4), c(3, 2), c12, c(6, 4), Fill(zero, 2)])
+
+    ldsp_imm = Imm(12, [Fill(zero, 3), c(4, 2), c12, c(6, 5), Fill(zero, 3)])
+    swsp_imm = Imm(12, [Fill(zero, 4), c(8, 7), c(12, 9), Fill(zero, 2)])
+    sdsp_imm = Imm(12, [Fill(zero, 3), c(9, 7), c(12, 10), Fill(zero, 3)])
+
+    j_imm = Imm(21, [
+        Fill(c12, 10), c(8, 8), c(10, 9), c(6, 6), c(7, 7), c(2, 2),
+        c(11, 11), c(5, 3), zero])
+
+    b_imm = Imm(13, [
+        Fill(c12, 5), c(6, 5), c(2, 2), c(11, 10), c(4, 3), zero])
+
+    quadrant = c(1, 0)
+    funct3 = c(15, 13)
+
+    expanded <<= 0
+
+    with quadrant == 0b11:
+        expanded <<= inst
+
+    #
+    # Quadrant 0
+    #
+
+    with quadrant == 0b00:
+        with funct3 == 0b000:
+            with c(12, 5) != 0:
+                expanded <<= IType(
+                    addi4spn_imm, x2, 0b000, rdp, Opcodes.OPIMM)
+
+        with funct3 == 0b010:
+            expanded <<= IType(lw_imm, rs1p, 0b010, rdp, Opcodes.LOAD)
+
+        with funct3 == 0b011:
+            expanded <<= IType(ld_imm, rs1p, 0b011, rdp, Opcodes.LOAD)
+
+        with funct3 == 0b110:
+            expanded <<= SType(lw_imm, rdp, rs1p, 0b010)
+
+        with funct3 == 0b111:
+            expanded <<= SType(ld_imm, rdp, rs1p, 0b011)
+
+    #
+    # Quadrant 1
+    #
+
+    with quadrant == 0b01:
+        with funct3 == 0b000:
+            expanded <<= IType(imm6, rd, 0b000, rd, Opcodes.OPIMM)
+
+        with funct3 == 0b001:
+            expanded <<= IType(imm6, rd, 0b000, rd, Opcodes.OPIMM32)
+
+        with funct3 == 0b010:
+            expanded <<= IType(imm6, x0, 0b000, rd, Opcodes.OPIMM)
+
+        with funct3 == 0b011:
+            with rd == 2:
+                expanded <<= IType(
+                    addi16sp_imm, x2, 0b000, x2, Opcodes.OPIMM)
+
+            with otherwise:
+                expanded <<= Cat([lui_imm, rd, Lit(Opcodes.LUI, 7)])
+
+        with funct3 == 0b100:
+            with c(11, 10) == 0b00:
+                expanded <<= IType(
+                    Cat([Lit(0b000000, 6), shamt]),
+                    rs1p, 0b101, rs1p, Opcodes.OPIMM)
+
+            with c(11, 10) == 0b01:
+                expanded <<= IType(
+                    Cat([Lit(0b010000, 6), shamt]),
+                    rs1p, 0b101, rs1p, Opcodes.OPIMM)
+
+            with c(11, 10) == 0b10:
+                expanded <<= IType(imm6, rs1p, 0b111, rs1p, Opcodes.OPIMM)
+
+            with (c(11, 10) == 0b11) & ~c12:
+                with c(6, 5) == 0b00:
+                    expanded <<= RType(
+                        0b0100000, rdp, rs1p, 0b000, rs1p, Opcodes.OP)
+
+                with c(6, 5) == 0b01:
+                    expanded <<= RType(
+                        0b0000000, rdp, rs1p, 0b100, rs1p, Opcodes.OP)
+
+                with c(6, 5) == 0b10:
+                    expanded <<= RType(
+                        0b0000000, rdp, rs1p, 0b110, rs1p, Opcodes.OP)
+
+                with c(6, 5) == 0b11:
+                    expanded <<= RType(
+                        0b0000000, rdp, rs1p, 0b111, rs1p, Opcodes.OP)
+
+            with (c(11, 10) == 0b11) & c12:
+                with c(6, 5) == 0b00:
+                    expanded <<= RType(
+                        0b0100000, rdp, rs1p, 0b000, rs1p, Opcodes.OP32)
+
+                with c(6, 5) == 0b01:
+                    expanded <<= RType(
+                        0b0000000, rdp, rs1p, 0b000, rs1p, Opcodes.OP32)
+
+        with funct3 == 0b101:
+            expanded <<= JType(j_imm, x0)
+
+        with funct3 == 0b110:
+            expanded <<= BType(b_imm, rs1p, 0b000)
+
+        with funct3 == 0b111:
+            expanded <<= BType(b_imm, rs1p, 0b001)
+
+    #
+    # Quadrant 2
+    #
+
+    with quadrant == 0b10:
+        with funct3 == 0b000:
+            expanded <<= IType(
+                Cat([Lit(0b000000, 6), shamt]),
+                rd, 0b001, rd, Opcodes.OPIMM)
+
+        with funct3 == 0b010:
+            expanded <<= IType(lwsp_imm, x2, 0b010, rd, Opcodes.LOAD)
+
+        with funct3 == 0b011:
+            expanded <<= IType(ldsp_imm, x2, 0b011, rd, Opcodes.LOAD)
+
+        with funct3 == 0b100:
+            with ~c12 & (rs2 == 0):
+                expanded <<= IType(Lit(0, 12), rd, 0b000, x0, Opcodes.JALR)
+
+            with ~c12 & (rs2 != 0):
+                expanded <<= RType(0b0000000, rs2, x0, 0b000, rd, Opcodes.OP)
+
+            with c12 & (rs2 == 0) & (rd == 0):
+                expanded <<= Lit(0x00100073, 32)
+
+            with c12 & (rs2 == 0) & (rd != 0):
+                expanded <<= IType(Lit(0, 12), rd, 0b000, x1, Opcodes.JALR)
+
+            with c12 & (rs2 != 0):
+                expanded <<= RType(0b0000000, rs2, rd, 0b000, rd, Opcodes.OP)
+
+        with funct3 == 0b110:
+            expanded <<= SType(swsp_imm, rs2, x2, 0b010)
+
+        with funct3 == 0b111:
+            expanded <<= SType(sdsp_imm, rs2, x2, 0b011)
+
+    NameSignals(locals())
+    return expanded
+
 def GenerateImmediate(inst, itype):
     imm = Wire(Bits(32))
     zero = Wire(Bits(1))
@@ -210,22 +454,137 @@ def RegisterFile():
 
     NameSignals(locals())
 
-def HandleRasCtrl(ras_ctrl, inst, pc):
+def ClassifyCallReturn(inst, is_call, is_return):
+    """Classify calls and returns using the RISC-V link register hints.
+
+    x1 (ra) and x5 (t0) are link registers. A JAL or JALR that writes a link
+    register is a call. A JALR that reads a link register (and doesn't write
+    the same one) is a return. A JALR that does both is a coroutine swap: a
+    return immediately followed by a call.
+    """
+
     link_rs1 = (Rs1(inst) == 1) | (Rs1(inst) == 5)
     link_rd = (Rd(inst) == 1) | (Rd(inst) == 5)
 
-    ras_ctrl.pc <<= pc
-    ras_ctrl.push <<= False
-    ras_ctrl.pop <<= False
+    is_call <<= False
+    is_return <<= False
+
+    with Opcode(inst) == Opcodes.JAL:
+        is_call <<= link_rd
 
     with Opcode(inst) == Opcodes.JALR:
-        ras_ctrl.push <<= link_rd
+        is_call <<= link_rd
 
         with ~link_rd & link_rs1:
-            ras_ctrl.pop <<= True
+            is_return <<= True
 
         with link_rd & link_rs1 & (Rs1(inst) != Rd(inst)):
-            ras_ctrl.pop <<= True
+            is_return <<= True
+
+def HandleRasCtrl(ras_ctrl, is_call, is_return, pc, rvc):
+    ras_ctrl.pc <<= pc
+    ras_ctrl.rvc <<= rvc
+    ras_ctrl.push <<= is_call
+    ras_ctrl.pop <<= is_return
+
+fusion_patterns = ['lui_addi', 'auipc_addi', 'slli_srli', 'auipc_jalr']
+
+def MatchInst(inst, name):
+    """Match inst against the pattern of the named entry in instructions.
+
+    N.B. On RV64 the shift amount of the shift-immediate instructions is 6
+    bits, the msb of which sits in the lsb of funct7. It is left out of the
+    funct7 match for those.
+    """
+
+    pattern = instructions[name].pattern
+    match = Opcode(inst) == pattern.opcode
+
+    if pattern.funct3 is not None:
+        match = match & (Funct3(inst) == pattern.funct3)
+
+    if pattern.funct7 is not None and pattern.opcode == Opcodes.OPIMM:
+        match = match & (inst(31, 26) == (pattern.funct7 >> 1))
+
+    elif pattern.funct7 is not None:
+        match = match & (Funct7(inst) == pattern.funct7)
+
+    return match
+
+def DetectFusion(first, second, fusion):
+    """Detect a pair of adjacent instructions that can be fused.
+
+    In every pattern, the second instruction consumes and overwrites the
+    result of the first, so the pair has a single result and can be issued as
+    one op:
+
+        lui rd, hi ; addi rd, rd, lo     =>  rd = (hi << 12) + lo
+        auipc rd, hi ; addi rd, rd, lo   =>  rd = pc + (hi << 12) + lo
+        slli rd, rs, n ; srli rd, rd, n  =>  rd = rs & (~0 >> n)
+        auipc rd, hi ; jalr rd, lo(rd)   =>  jal rd, pc + (hi << 12) + lo
+    """
+
+    rd = Rd(first)
+    chained = (rd != 0) & (Rs1(second) == rd) & (Rd(second) == rd)
+
+    is_lui = MatchInst(first, 'lui')
+    is_auipc = MatchInst(first, 'auipc')
+    is_addi = MatchInst(second, 'addi')
+    same_shamt = first(25, 20) == second(25, 20)
+
+    fusion.lui_addi <<= chained & is_lui & is_addi
+    fusion.auipc_addi <<= chained & is_auipc & is_addi
+
+    fusion.slli_srli <<= chained & same_shamt & \
+        MatchInst(first, 'slli') & MatchInst(second, 'srli')
+
+    fusion.auipc_jalr <<= chained & is_auipc & MatchInst(second, 'jalr')
+
+def FusedOp(first, second, fusion, op, imm):
+    """Produce the instruction (and immediate) a fused pair is issued as.
+
+    The op is a real instruction (so it decodes as usual) with a zero
+    immediate, which is then replaced by imm. Since auipc is never compressed,
+    the jalr of a fused auipc + jalr is always 4 bytes past the auipc, which
+    is taken out of the jump offset (the op is issued at the pc of the jalr).
+    """
+
+    zero = Wire(Bits(1))
+    zero <<= 0
+
+    def Lit(value, width):
+        lit = Wire(Bits(width))
+        lit <<= value
+        return lit
+
+    rd = Rd(first)
+
+    u_imm = Cat([Fill(first(31, 31), 32), first(31, 12), Fill(zero, 12)])
+    i_imm = Cat([Fill(second(31, 31), 52), second(31, 20)])
+
+    ones = Wire(Bits(C['core-width']))
+    ones <<= (1 << C['core-width']) - 1
+
+    op <<= 0
+    imm <<= 0
+
+    with fusion.lui_addi:
+        op <<= Cat([Lit(0, 20), rd, Lit(Opcodes.LUI, 7)])
+        imm <<= u_imm + i_imm
+
+    with fusion.auipc_addi:
+        op <<= Cat([Lit(0, 20), rd, Lit(Opcodes.AUIPC, 7)])
+        imm <<= u_imm + i_imm
+
+    with fusion.slli_srli:
+        op <<= Cat([
+            Lit(0, 12), Rs1(first), Lit(0b111, 3), rd, Lit(Opcodes.OPIMM, 7)
+        ])
+        imm <<= ones >> first(25, 20)
+
+    with fusion.auipc_jalr:
+        op <<= Cat([Lit(0, 20), rd, Lit(Opcodes.JAL, 7)])
+        imm <<= u_imm + i_imm - 4
 
 @Module
 def DecodeStage():
@@ -240,24 +599,99 @@ def DecodeStage():
     io = Io({
         'if_id': Input(if_bundle),
         'inst': Input(Bits(32)),
+        'next': Input(fetch_entry),
         'stall': Input(Bits(1)),
         'reg_write': Input(reg_write_bundle),
+        'ras_checkpoint': Input(ras_checkpoint_bundle),
         'ras_ctrl': Output(ras_ctrl_bundle),
+        'redirect': Output(decode_redirect_bundle),
+        'fused': Output(Bits(1)),
+        'fusion': Output({name: Bits(1) for name in fusion_patterns}),
         'id_ex': Output(id_ex_bundle),
         'rs1_data': Output(Bits(C['core-width'])),
         'rs2_data': Output(Bits(C['core-width'])),
     })
 
-    inst = Wire(Bits(32))
+    first = Wire(Bits(32))
+    first_rvc = Wire(Bits(1))
+
+    #
+    # Compressed instructions are expanded to their 32-bit equivalents ahead
+    # of Control, so the rest of the pipeline only ever sees 32-bit encodings.
+    # rvc is carried along since the instruction is only 2 bytes long, which
+    # matters to anything that computes pc + instruction length.
+    #
 
     with io.if_id.valid:
-        inst <<= io.inst
+        first <<= ExpandCompressed(io.inst)
+        first_rvc <<= IsCompressed(io.inst)
     with otherwise:
-        inst <<= 0
+        first <<= 0
+        first_rvc <<= False
+
+    #
+    # Macro-op Fusion
+    #
+    # The frontend also hands over the instruction after this one (when it
+    # has it). If the two form one of the patterns in fusion_patterns, they are
+    # issued as a single op and the frontend drops both. The pair must be
+    # sequential, and a predicted taken instruction ends the pair (the jalr of
+    # an auipc + jalr excepted, whose prediction the fused op inherits).
+    #
+
+    second = ExpandCompressed(io.next.inst)
+    second_rvc = IsCompressed(io.next.inst)
+
+    fusion = Wire({name: Bits(1) for name in fusion_patterns})
+    DetectFusion(first, second, fusion)
+
+    fusable = io.if_id.valid & io.next.if_id.valid & \
+        ~io.if_id.pred.taken & \
+        (io.next.if_id.pc == NextPc(io.if_id.pc, first_rvc))
+
+    next_taken = io.next.if_id.pred.taken
+
+    issue = Wire({name: Bits(1) for name in fusion_patterns})
+    issue.lui_addi <<= fusable & fusion.lui_addi & ~next_taken
+    issue.auipc_addi <<= fusable & fusion.auipc_addi & ~next_taken
+    issue.slli_srli <<= fusable & fusion.slli_srli & ~next_taken
+    issue.auipc_jalr <<= fusable & fusion.auipc_jalr
+
+    fused = Wire(Bits(1))
+    fused <<= \
+        issue.lui_addi | issue.auipc_addi | \
+        issue.slli_srli | issue.auipc_jalr
+
+    io.fused <<= fused
+    io.fusion <<= issue
+
+    fused_op = Wire(Bits(32))
+    fused_imm = Wire(Bits(C['core-width']))
+    FusedOp(first, second, issue, fused_op, fused_imm)
+
+    inst = Wire(Bits(32))
+    rvc = Wire(Bits(1))
+    pc = Wire(Bits(C['paddr-width']))
+    pred = Wire(fetch_pred_bundle)
+
+    inst <<= first
+    rvc <<= first_rvc
+    pc <<= io.if_id.pc
+    pred <<= io.if_id.pred
+
+    with fused:
+        inst <<= fused_op
+
+    with issue.auipc_jalr:
+        rvc <<= second_rvc
+        pc <<= io.next.if_id.pc
+        pred <<= io.next.if_id.pred
 
     regfile = Instance(RegisterFile())
 
     itype = Wire(Bits(ITypes.bitwidth))
+    is_call = Wire(Bits(1))
+    is_return = Wire(Bits(1))
 
     regfile.r0_addr <<= Rs1(inst)
     regfile.r0_en <<= ~io.stall
@@ -265,7 +699,7 @@ def DecodeStage():
     regfile.r1_en <<= ~io.stall
 
     regfile.w0_addr <<= io.reg_write.w_addr
-    regfile.w0_en <<= io.reg_write.w_en & ~io.stall
+    regfile.w0_en <<= io.reg_write.w_en
     regfile.w0_data <<= io.reg_write.w_data
 
     #
@@ -276,7 +710,10 @@ def DecodeStage():
 
     io.id_ex.ctrl.valid <<= io.if_id.valid
     io.id_ex.ctrl.inst <<= inst
-    io.id_ex.ctrl.pc <<= io.if_id.pc
+    io.id_ex.ctrl.pc <<= pc
+    io.id_ex.ctrl.pred <<= pred
+    io.id_ex.ctrl.ras <<= io.ras_checkpoint
+    io.id_ex.ctrl.rvc <<= rvc
 
     #
     # Hook up the register read outputs.
@@ -295,10 +732,18 @@ def DecodeStage():
     Control(inst, itype, io.id_ex.ctrl)
 
     #
-    # TODO: Documentation
+    # Calls push their return address onto the return address stack (RAS) and
+    # returns pop it. The RAS lives in the frontend, which reports back the
+    # resulting RAS state (checkpoint) to be carried along with this
+    # instruction. The call / return class is also carried down the pipeline
+    # so the BTB can learn which entries are returns.
     #
 
-    HandleRasCtrl(io.ras_ctrl, inst, io.if_id.pc)
+    ClassifyCallReturn(inst, is_call, is_return)
+    HandleRasCtrl(io.ras_ctrl, is_call, is_return, pc, rvc)
+
+    io.id_ex.ctrl.is_call <<= is_call
+    io.id_ex.ctrl.is_return <<= is_return
 
     #
     # GenerateImmediate produces logic that consume the itype (instruction
@@ -306,6 +751,41 @@ def DecodeStage():
     # this instruction.
     #
 
-    io.id_ex.imm <<= GenerateImmediate(inst, itype)
+    imm = Wire(Bits(C['core-width']))
+    imm <<= GenerateImmediate(inst, itype)
+
+    with fused:
+        imm <<= fused_imm
+
+    io.id_ex.imm <<= imm
+
+    #
+    # Early Redirect
+    #
+    # The target of a JAL is known as soon as its immediate is, so there is no
+    # need to wait for execute when the frontend didn't fetch it. The same goes
+    # for a conditional branch the BTB has no entry for, if it is predicted
+    # taken by the static backward-taken rule (I.e. it probably closes a
+    # loop). Fetch is redirected from here, and the instruction carries on as
+    # if the frontend had predicted it taken.
+    #
+
+    direct_target = Wire(Bits(C['paddr-width']))
+    direct_target <<= pc + imm(C['paddr-width'] - 1, 0)
+
+    is_jal = Opcode(inst) == Opcodes.JAL
+    is_backward_branch = (Opcode(inst) == Opcodes.BRANCH) & inst(31, 31)
+
+    redirect = \
+        (is_jal & (pred.target != direct_target)) | \
+        (is_backward_branch & ~pred.hit)
+
+    io.redirect.valid <<= io.if_id.valid & redirect
+    io.redirect.pc <<= EndPc(pc, rvc)
+    io.redirect.target <<= direct_target
+
+    with redirect:
+        io.id_ex.ctrl.pred.taken <<= True
+        io.id_ex.ctrl.pred.target <<= direct_target
 
     NameSignals(locals())
@@ -109,6 +109,46 @@ def AluControl(alu_inst, alu_op, funct7, funct3):
 
     NameSignals(locals())
 
+def BranchCompare(taken, branch_type, rs1, rs2):
+    """Resolve a conditional branch by comparing its two source registers.
+
+    N.B. This is a dedicated comparator rather than the ALU flags, so the
+    outcome is known in this stage without waiting for the flags to be
+    latched. Signed compares flip the sign bits and reuse the unsigned
+    compare.
+    """
+
+    msb = C['core-width'] - 1
+
+    rs1_signed = Cat([~rs1(msb, msb), rs1(msb - 1, 0)])
+    rs2_signed = Cat([~rs2(msb, msb), rs2(msb - 1, 0)])
+
+    eq = rs1 == rs2
+    lt = LessThan(rs1_signed, rs2_signed)
+    ltu = LessThan(rs1, rs2)
+
+    taken <<= False
+
+    with branch_type == BranchType.EQ:
+        taken <<= eq
+
+    with branch_type == BranchType.NEQ:
+        taken <<= ~eq
+
+    with branch_type == BranchType.LT:
+        taken <<= lt
+
+    with branch_type == BranchType.GEQ:
+        taken <<= ~lt
+
+    with branch_type == BranchType.LTU:
+        taken <<= ltu
+
+    with branch_type == BranchType.GEQU:
+        taken <<= ~ltu
+
+    NameSignals(locals())
+
 @Module
 def ExecuteStage():
     """The execute stage for Geode.
@@ -117,7 +157,9 @@ def ExecuteStage():
     produced in the previous stage (or forwarded values when necessary) to
     perform operations on.
 
-    Additionally, it produces the branch target for branch instructions.
+    Additionally, it resolves branches and jumps: the branch outcome and
+    target are computed here and reported to the branch unit, which redirects
+    the frontend on a misprediction.
     """
 
     io = Io({
@@ -131,6 +173,7 @@ def ExecuteStage():
             'wb_data': Bits(C['core-width'])
         }),
         'mispred': Input(Bits(1)),
+        'branch': Output(branch_bundle),
         'dcache': Output({
             'cpu_req': cpu_cache_req
         }),
@@ -145,10 +188,13 @@ def ExecuteStage():
     # Branch Target Generation
     #
 
-    io.ex_mem.branch_target <<= io.id_ex.ctrl.pc + io.id_ex.imm
+    branch_target = Wire(Bits(C['paddr-width']))
+    branch_target <<= io.id_ex.ctrl.pc + io.id_ex.imm
 
     with io.id_ex.ctrl.ex.jalr:
-        io.ex_mem.branch_target <<= alu.result
+        branch_target <<= alu.result
+
+    io.ex_mem.branch_target <<= branch_target
 
     #
     # Forwarding Logic
@@ -205,8 +251,57 @@ def ExecuteStage():
     with otherwise:
         io.ex_mem.alu_result <<= alu.result
 
+    with io.id_ex.ctrl.ex.auipc:
+        io.ex_mem.alu_result <<= io.id_ex.ctrl.pc + io.id_ex.imm
+
+    #
+    # JAL and JALR write the link address (the pc of the following
+    # instruction) to rd.
+    #
+
+    next_pc = NextPc(io.id_ex.ctrl.pc, io.id_ex.ctrl.rvc)
+
+    with io.id_ex.ctrl.mem.jal:
+        io.ex_mem.alu_result <<= next_pc
+
     io.ex_mem.alu_flags <<= alu.flags
 
+    #
+    # Branch Resolution
+    #
+    # Conditional branches, JAL and JALR are resolved here. Any instruction the
+    # frontend predicted taken is also reported, even if it turns out not to
+    # be a branch, so that the branch unit can correct the fetch stream (and
+    # the BTB).
+    #
+
+    ctrl = io.id_ex.ctrl
+
+    branch_taken = Wire(Bits(1))
+    BranchCompare(branch_taken, ctrl.mem.branch_type, rs1_fwd, rs2_fwd)
+
+    is_ctrl_change = ctrl.mem.branch | ctrl.mem.jal
+    taken = (ctrl.mem.branch & branch_taken) | ctrl.mem.jal
+
+    io.branch.valid <<= ctrl.valid & (is_ctrl_change | ctrl.pred.taken)
+    io.branch.pc <<= ctrl.pc
+    io.branch.taken <<= taken
+    io.branch.pred_target <<= ctrl.pred.target
+    io.branch.is_branch <<= is_ctrl_change
+    io.branch.is_call <<= ctrl.is_call
+    io.branch.is_return <<= ctrl.is_return
+    io.branch.is_indirect <<= ctrl.ex.jalr & ~ctrl.is_return
+    io.branch.rvc <<= ctrl.rvc
+    io.branch.ras <<= ctrl.ras
+    io.branch.pred_taken <<= ctrl.pred.direction
+    io.branch.history <<= ctrl.pred.history
+    io.branch.path <<= ctrl.pred.path
+
+    with taken:
+        io.branch.target <<= branch_target
+    with otherwise:
+        io.branch.target <<= next_pc
+
     #
     # The execute stage is responsible for sending the dcache memory requests.
     #
@@ -216,8 +311,15 @@ def ExecuteStage():
         (io.id_ex.ctrl.mem.mem_read | io.id_ex.ctrl.mem.mem_write) & \
         ~io.mispred
 
+    #
+    # N.B. access_rtype follows the funct3 encoding of loads and stores, so
+    # funct3 is the access type as is.
+    #
+
     io.dcache.cpu_req.addr <<= alu.result
-    io.dcache.cpu_req.rtype <<= access_rtype.d
+    io.dcache.cpu_req.rtype <<= io.id_ex.ctrl.ex.funct3
     io.dcache.cpu_req.read <<= io.id_ex.ctrl.mem.mem_read
+    io.dcache.cpu_req.rd <<= Rd(io.id_ex.ctrl.inst)
+    io.dcache.cpu_req.data <<= rs2_fwd
 
     NameSignals(locals())
@@ -12,6 +12,7 @@ def WritebackStage():
     io = Io({
         'mem_wb': Input(mem_wb_bundle),
         'mem_read_data': Input(Bits(C['core-width'])),
+        'mem_pending': Input(Bits(1)),
         'reg_write': Output(reg_write_bundle)
     })
 
@@ -31,7 +32,12 @@ def WritebackStage():
     # Currently, the register file is set to always write. Instructions that do
     # not update a register simply set their rd to zero (which is ignored).
     #
+    # A load whose data is still pending (it missed in a non-blocking dcache)
+    # has its register written by the dcache later instead.
+    #
 
-    io.reg_write.w_en <<= io.mem_wb.ctrl.wb.write_reg & io.mem_wb.ctrl.valid
+    io.reg_write.w_en <<= \
+        io.mem_wb.ctrl.wb.write_reg & io.mem_wb.ctrl.valid & \
+        ~(io.mem_wb.ctrl.wb.mem_to_reg & io.mem_pending)
 
     NameSignals(locals())
\ No newline at end of file
@@ -1,4 +1,14 @@
 from . import aligner
+from . import arbiter
 from . import cache
 from . import data
+from . import l2
+from . import merge
 from . import meta
+from . import mshr
+from . import predecode
+from . import prefetch
+from . import refill
+from . import sbuffer
+from . import victim
+from . import wbuffer
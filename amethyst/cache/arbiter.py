@@ -0,0 +1,121 @@
+from atlas import *
+from ..support import *
+
+@Module
+def MemArbiter(CC : CacheConfig):
+    """Arbiter between the icache's and dcache's memory ports.
+
+    The L1s share one memory port (to the L2, see cache/l2.py), which takes one
+    request at a time. When both L1s have a request, the one that wasn't
+    granted last goes first (round-robin), so neither can starve the other. A
+    port with both a read and a write sends the read first.
+
+    A read holds the arbiter (busy) until the last beat of its line has been
+    passed back (see mem_read_response), so responses always go to the L1 that
+    asked for them (owner), even when both ask for the same line.
+
+    CC is the config of the cache behind the arbiter, whose lines are the
+    same size as the L1s'.
+    """
+
+    io = Io({
+        'icache': Input(mem_bundle),
+        'dcache': Input(mem_bundle),
+        'mem': Output(mem_bundle)
+    })
+
+    ports = [io.icache, io.dcache]
+
+    busy = Reg(Bits(1), reset_value=False)
+    owner = Reg(Bits(1), reset_value=0)
+    last = Reg(Bits(1), reset_value=1)
+
+    #
+    # Grant
+    #
+
+    want = [port.read.valid | port.write.valid for port in ports]
+
+    grant = Wire(Bits(1))
+    grant <<= 0
+
+    with want[1] & (~want[0] | (last == 0)):
+        grant <<= 1
+
+    read_valid = Wire(Bits(1))
+    read_addr = Wire(Bits(C['paddr-width']))
+    write_valid = Wire(Bits(1))
+    write_addr = Wire(Bits(C['paddr-width']))
+    write_data = Wire(Bits(C['mem-width']))
+
+    read_valid <<= ports[0].read.valid
+    read_addr <<= ports[0].read.addr
+    write_valid <<= ports[0].write.valid
+    write_addr <<= ports[0].write.addr
+    write_data <<= ports[0].write.data
+
+    with grant == 1:
+        read_valid <<= ports[1].read.valid
+        read_addr <<= ports[1].read.addr
+        write_valid <<= ports[1].write.valid
+        write_addr <<= ports[1].write.addr
+        write_data <<= ports[1].write.data
+
+    send_read = Wire(Bits(1))
+    send_write = Wire(Bits(1))
+
+    send_read <<= ~busy & read_valid
+    send_write <<= ~busy & ~read_valid & write_valid
+
+    io.mem.read.valid <<= send_read
+    io.mem.read.addr <<= read_addr
+
+    io.mem.write.valid <<= send_write
+    io.mem.write.addr <<= write_addr
+    io.mem.write.data <<= write_data
+
+    for i, port in enumerate(ports):
+        port.read.ready <<= send_read & (grant == i) & io.mem.read.ready
+        port.write.ready <<= send_write & (grant == i) & io.mem.write.ready
+
+    with (send_read & io.mem.read.ready) | (send_write & io.mem.write.ready):
+        last <<= grant
+
+    with send_read & io.mem.read.ready:
+        busy <<= True
+        owner <<= grant
+
+    #
+    # Responses
+    #
+
+    resp_ready = Wire(Bits(1))
+    resp_ready <<= ports[0].resp.ready
+
+    with owner == 1:
+        resp_ready <<= ports[1].resp.ready
+
+    io.mem.resp.ready <<= busy & resp_ready
+
+    for i, port in enumerate(ports):
+        port.resp.valid <<= busy & (owner == i) & io.mem.resp.valid
+        port.resp.addr <<= io.mem.resp.addr
+        port.resp.data <<= io.mem.resp.data
+
+    resp_take = Wire(Bits(1))
+    resp_take <<= busy & resp_ready & io.mem.resp.valid
+
+    if CC.refill_beats > 1:
+        received = Reg(Bits(Log2Ceil(CC.refill_beats)), reset_value=0)
+
+        with resp_take:
+            received <<= received + 1
+
+            with received == CC.refill_beats - 1:
+                busy <<= False
+
+    else:
+        with resp_take:
+            busy <<= False
+
+    NameSignals(locals())
@@ -3,7 +3,15 @@ from ..support import *
 
 from .aligner import Aligner
 from .data import CacheDataArray
+from .merge import StoreMerger
 from .meta import CacheMetaArray
+from .mshr import MissStatusHoldingRegisters
+from .predecode import *
+from .prefetch import PrefetchBuffer
+from .refill import LineAssembler
+from .sbuffer import StoreBuffer
+from .victim import VictimCache
+from .wbuffer import WriteBackBuffer
 
 #
 # Addresses in this cache are broken up as follows:
@@ -20,7 +28,20 @@ def Cache(CC : CacheConfig):
         'cpu_req': Input(cpu_cache_req),
         'cpu_resp': Output(cpu_cache_resp),
         'cpu_stall': Input(Bits(1)),
+        'prefetch_hint': Input(prefetch_hint_bundle),
         'miss_stall': Output(Bits(1)),
+        'req_stall': Output(Bits(1)),
+        'array_access': Output(Bits(1)),
+        'miss': Output(Bits(1)),
+        'prefetch_useful': Output(Bits(1)),
+        'prefetch_useless': Output(Bits(max(CC.prefetch_slots, 1))),
+        'predecode': Output(Bits(predecode_word_width)),
+        'pending_regs': Output([Bits(1) for _ in range(C['reg-count'])]),
+        'fill_write': Output(reg_fill_bundle),
+        'wb_reclaim': Output(Bits(1)),
+        'store_forward': Output(Bits(1)),
+        'victim_hit': Output(Bits(1)),
+        'victim_miss': Output(Bits(1)),
         'mem': Output(mem_bundle)
     })
 
@@ -28,17 +49,74 @@ def Cache(CC : CacheConfig):
     data_array = Instance(CacheDataArray(CC))
     aligner = Instance(Aligner(CC))
 
+    #
+    # Write-back Buffer
+    #
+    # When enabled (dcache only), the cache talks to memory through the buffer
+    # (see cache/wbuffer.py), which takes evicted lines off the cache's hands
+    # right away so the refill read can go out first.
+    #
+
+    if CC.wb_entries > 0:
+        wbuf = Instance(WriteBackBuffer(CC))
+        io.mem <<= wbuf.mem
+        io.wb_reclaim <<= wbuf.reclaim
+        mem = wbuf.cache
+
+    else:
+        io.wb_reclaim <<= False
+        mem = io.mem
+
+    #
+    # Refill
+    #
+    # When the memory bus is narrower than a line, lines come back over a
+    # number of beats and are put back together by the assembler (see
+    # cache/refill.py). refill is a whole line and refill_beat is each beat
+    # as it arrives.
+    #
+
+    if CC.refill_beats > 1:
+        assembler = Instance(LineAssembler(CC))
+
+        assembler.resp <<= {
+            'valid': mem.resp.valid,
+            'addr': mem.resp.addr,
+            'data': mem.resp.data
+        }
+
+        refill = assembler.line
+        refill_beat = assembler.beat
+
+    else:
+        refill = mem.resp
+        refill_beat = mem.resp
+
+    zero = Wire(Bits(1))
+    zero <<= 0
+
     stall = Wire(Bits(1))
+    req_stall = Wire(Bits(1))
 
     s0_req = Wire(cpu_cache_req)
+    s0_fwd = Wire(Bits(1))
+    s0_fwd_data = Wire(Bits(C['core-width']))
 
     s1_req = Reg(cpu_cache_req, reset_value=cpu_cache_req_reset)
+    s1_way_data = Wire(Bits(CC.line_width))
     s1_read_data = Wire(Bits(CC.line_width))
+    s1_hit = Wire(Bits(1))
+    s1_pending = Wire(Bits(1))
+    s1_store = Wire(Bits(1))
+    s1_fwd = Reg(Bits(1), reset_value=False)
+    s1_fwd_data = Reg(Bits(C['core-width']), reset_value=0)
+    resp_match = Wire(Bits(1))
 
     s2_req = Reg(cpu_cache_req, reset_value=cpu_cache_req_reset)
     s2_resp_data = Reg(Bits(C['core-width']), reset_value=0)
+    s2_pending = Reg(Bits(1), reset_value=False)
 
-    mstates = Enum(['idle', 'read', 'evict', 'update'])
+    mstates = Enum(['idle', 'read', 'evict', 'update', 'fill'])
     about_to_miss = Wire(Bits(1))
     miss_state = Reg(Bits(mstates.bitwidth), reset_value=mstates.idle)
     miss_data = Reg(Bits(C['core-width']), reset_value=0)
@@ -47,9 +125,42 @@ def Cache(CC : CacheConfig):
     io.miss_stall <<= stall
     complete_miss <<= False
 
+    #
+    # N.B. The response of a completed miss is held until the cpu takes it,
+    # since the cpu may be stalled in the cycle the miss completes.
+    #
+
+    with complete_miss & io.cpu_stall:
+        complete_miss <<= True
+
+    #
+    # Line Buffer
+    #
+    # When enabled (icache only), the most recently read line is kept in a
+    # buffer along with its line address. Requests to the buffered line are
+    # served from the buffer in stage 1 instead of reading the meta and data
+    # arrays, so sequential fetches only touch the arrays when they cross into
+    # a new line.
+    #
+
+    lb_valid = Reg(Bits(1), reset_value=False)
+    lb_addr = Reg(Bits(CC.line_addr_width), reset_value=0)
+    lb_line = Reg(Bits(CC.line_width), reset_value=0)
+    lb_fill = Wire(Bits(1))
+
+    next_lb_valid = Wire(Bits(1))
+    next_lb_addr = Wire(Bits(CC.line_addr_width))
+
+    s0_from_lb = Wire(Bits(1))
+    s1_from_lb = Reg(Bits(1), reset_value=False)
+
     with ~stall & ~io.cpu_stall:
         s1_req <<= s0_req
+        s1_from_lb <<= s0_from_lb
+        s1_fwd <<= s0_fwd
+        s1_fwd_data <<= s0_fwd_data
         s2_req <<= s1_req
+        s2_pending <<= s1_pending
 
         with complete_miss:
             s2_resp_data <<= miss_data
@@ -67,28 +178,272 @@ def Cache(CC : CacheConfig):
 
     s0_req <<= io.cpu_req
 
-    meta_array.stall <<= stall | io.cpu_stall
-    data_array.stall <<= stall | io.cpu_stall
+    #
+    # Store Buffer
+    #
+    # When enabled (dcache only), stores from the cpu go into the store buffer
+    # (see cache/sbuffer.py) rather than stage 0, and are drained into stage 0
+    # from there whenever it isn't taken by a load. Loads are looked up in the
+    # buffer as they enter stage 0, and one forwarded from the buffer is a hit
+    # on the forwarded word.
+    #
+    # req_stall tells the cpu that its request wasn't taken, because a store
+    # found the buffer full or a load has to wait for it to drain. Unlike
+    # miss_stall, it only holds the cpu's request, not the ones already in
+    # the cache.
+    #
+
+    if CC.sb_entries > 0:
+        sbuf = Instance(StoreBuffer(CC))
+
+        cpu_load = io.cpu_req.valid & io.cpu_req.read
+        cpu_store = io.cpu_req.valid & ~io.cpu_req.read
+
+        sbuf.lookup.addr <<= io.cpu_req.addr
+        sbuf.lookup.rtype <<= io.cpu_req.rtype
 
-    meta_array.read.addr <<= s0_req.addr
-    data_array.read.addr <<= s0_req.addr
+        load_wait = Wire(Bits(1))
+        load_wait <<= cpu_load & sbuf.forward.wait
+
+        req_stall <<= (cpu_store & sbuf.full) | load_wait
+
+        sbuf.store.valid <<= cpu_store & ~sbuf.full & ~stall & ~io.cpu_stall
+        sbuf.store.addr <<= io.cpu_req.addr
+        sbuf.store.rtype <<= io.cpu_req.rtype
+        sbuf.store.data <<= io.cpu_req.data
+
+        s0_free = Wire(Bits(1))
+        s0_free <<= ~cpu_load | load_wait
+
+        sbuf.drain.ready <<= s0_free & ~stall & ~io.cpu_stall
+
+        with s0_free:
+            s0_req <<= {
+                'valid': sbuf.drain.valid,
+                'addr': sbuf.drain.addr,
+                'rtype': sbuf.drain.rtype,
+                'read': False,
+                'rd': 0,
+                'data': sbuf.drain.data
+            }
+
+        s0_fwd <<= cpu_load & sbuf.forward.hit
+        s0_fwd_data <<= sbuf.forward.data
+
+    else:
+        req_stall <<= False
+        s0_fwd <<= False
+        s0_fwd_data <<= 0
+
+    io.req_stall <<= req_stall
+    io.store_forward <<= s0_fwd & ~stall & ~io.cpu_stall
+
+    #
+    # N.B. s0 is compared against the buffer as it will be _after_ this cycle,
+    # since stage 1 may be filling it with the line s0 is about to use.
+    #
+
+    if CC.line_buffer:
+        next_lb_valid <<= lb_valid | lb_fill
+        next_lb_addr <<= lb_addr
+
+        with lb_fill:
+            next_lb_addr <<= CC.LineAddr(s1_req.addr)
+
+        s0_from_lb <<= \
+            s0_req.valid & next_lb_valid & \
+            (CC.LineAddr(s0_req.addr) == next_lb_addr)
+
+    else:
+        next_lb_valid <<= False
+        next_lb_addr <<= 0
+        s0_from_lb <<= False
+
+    #
+    # array_hold: the arrays keep their last read (see meta.py)
+    # array_addr: the address the arrays read
+    #
+
+    array_hold = Wire(Bits(1))
+    array_addr = Wire(Bits(C['paddr-width']))
+
+    array_hold <<= stall | io.cpu_stall | s0_from_lb
+    array_addr <<= s0_req.addr
+
+    meta_array.stall <<= array_hold
+
+    #
+    # Requests served by the arrays update the replacement state of the set
+    # they hit in (see cache/meta.py).
+    #
+
+    meta_array.touch <<= s1_req.valid & ~s1_from_lb
+    data_array.stall <<= array_hold
+
+    io.array_access <<= s0_req.valid & ~stall & ~io.cpu_stall & ~s0_from_lb
+    io.miss <<= (miss_state == mstates.idle) & about_to_miss
+
+    meta_array.read.addr <<= array_addr
+    data_array.read.addr <<= array_addr
 
     #
     # Stage 1: Handle Request
     #
 
     # This is the "way mux"
-    s1_read_data <<= data_array.resp[meta_array.resp.way]
+    s1_way_data <<= data_array.resp[meta_array.resp.way]
+    s1_hit <<= meta_array.resp.hit
+    s1_store <<= s1_req.valid & ~s1_req.read
+
+    #
+    # Store Bypass
+    #
+    # A store that hits writes the data array in the same cycle the next
+    # request reads it, so when they are in the same set, the line the store
+    # wrote is kept here and used in place of the array's copy.
+    #
+
+    if CC.cache_type == 'dcache':
+        sb_valid = Reg(Bits(1), reset_value=False)
+        sb_way = Reg(Bits(CC.way_addr_width), reset_value=0)
+        sb_data = Reg(Bits(CC.line_width), reset_value=0)
+
+        with sb_valid & (sb_way == meta_array.resp.way):
+            s1_way_data <<= sb_data
+
+    s1_read_data <<= s1_way_data
+
+    with s1_from_lb:
+        s1_read_data <<= lb_line
+        s1_hit <<= True
+
+    #
+    # A line read from the arrays goes into the line buffer.
+    #
+
+    if CC.line_buffer:
+        lb_fill <<= s1_req.valid & ~s1_from_lb & meta_array.resp.hit
+
+        with lb_fill:
+            lb_valid <<= True
+            lb_addr <<= CC.LineAddr(s1_req.addr)
+            lb_line <<= s1_read_data
+
+    else:
+        lb_fill <<= False
 
     aligner.addr <<= s1_req.addr
     aligner.line <<= s1_read_data
     aligner.rtype <<= s1_req.rtype
 
     #
-    # Stage 2: Select and align data
+    # Stores
+    #
+    # A store that hits merges its data into the line (see cache/merge.py),
+    # which is written back into the data array and marked dirty. A store that
+    # misses has its line refilled first, like a load (write-allocate), and its
+    # data is merged into the line as it goes into the arrays.
+    #
+    # fill_line is the line written into the arrays by a refill.
+    #
+
+    fill_line = Wire(Bits(CC.line_width))
+    fill_line <<= refill.data
+
+    if CC.cache_type == 'dcache':
+        merger = Instance(StoreMerger(CC))
+
+        merger.addr <<= s1_req.addr
+        merger.rtype <<= s1_req.rtype
+        merger.data <<= s1_req.data
+        merger.line <<= s1_read_data
+
+        with miss_state != mstates.idle:
+            merger.line <<= refill.data
+
+            with s1_store & resp_match:
+                fill_line <<= merger.result
+
+        store_hit = Wire(Bits(1))
+        store_hit <<= s1_store & s1_hit & ~stall & ~io.cpu_stall
+
+        with ~array_hold:
+            sb_valid <<= \
+                store_hit & (CC.Set(array_addr) == CC.Set(s1_req.addr))
+            sb_way <<= meta_array.resp.way
+            sb_data <<= merger.result
+
+    #
+    # Predecode
+    #
+    # When enabled (icache only), every line written into the cache is run
+    # through the predecoder, and the resulting classes (see pd_class) are kept
+    # in an array alongside the data array. They follow the line into the line
+    # buffer and the classes of the fetched word are returned with it.
     #
 
-    io.cpu_resp.data <<= s2_resp_data
+    if CC.predecode:
+        pd_width = (CC.line_width // 16) * pd_class.bitwidth
+
+        pd_array = Instance(CachePredecodeArray(CC))
+        predecoder = Instance(Predecoder(CC))
+
+        lb_pd = Reg(Bits(pd_width), reset_value=0)
+        s1_read_pd = Wire(Bits(pd_width))
+        s2_resp_pd = Reg(Bits(predecode_word_width), reset_value=0)
+        miss_pd = Reg(Bits(predecode_word_width), reset_value=0)
+
+        pd_array.stall <<= array_hold
+        pd_array.read.addr <<= array_addr
+
+        s1_read_pd <<= pd_array.resp[meta_array.resp.way]
+
+        with s1_from_lb:
+            s1_read_pd <<= lb_pd
+
+        with lb_fill:
+            lb_pd <<= s1_read_pd
+
+        s1_resp_pd = PredecodeWord(CC, s1_read_pd, s1_req.addr)
+
+        with ~stall & ~io.cpu_stall:
+            with complete_miss:
+                s2_resp_pd <<= miss_pd
+            with otherwise:
+                s2_resp_pd <<= s1_resp_pd
+
+        predecoder.line <<= refill.data
+
+        if CC.comb_resp:
+            with complete_miss:
+                io.predecode <<= miss_pd
+            with otherwise:
+                io.predecode <<= s1_resp_pd
+
+        else:
+            io.predecode <<= s2_resp_pd
+
+    else:
+        io.predecode <<= 0
+
+    #
+    # Stage 2: Respond
+    #
+    # With a combinational response, the aligned data is returned straight
+    # out of stage 1 instead (I.e. in the cycle after the request). The
+    # response is only meaningful while the cache isn't stalled.
+    #
+
+    if CC.comb_resp:
+        with complete_miss:
+            io.cpu_resp.data <<= miss_data
+        with otherwise:
+            io.cpu_resp.data <<= aligner.result
+
+    else:
+        io.cpu_resp.data <<= s2_resp_data
+
+    io.cpu_resp.pending <<= s2_pending
 
     #
     # Miss Handling
@@ -98,64 +453,277 @@ def Cache(CC : CacheConfig):
     # nothing ever happened.
     #
 
-    about_to_miss <<= ~meta_array.resp.hit & s1_req.valid
-    stall <<= (miss_state != mstates.idle) | about_to_miss
+    if CC.mshrs > 0:
+        mshr = Instance(MissStatusHoldingRegisters(CC))
+
+        about_to_miss <<= False
+
+        #
+        # N.B. A store that hits has to wait while its set has an MSHR (see
+        # cache/mshr.py), and while the arrays are being refilled, since both
+        # need the update port.
+        #
+
+        stall <<= \
+            (s1_req.valid & ~s1_hit & mshr.block) | \
+            (s1_store & s1_hit & (mshr.set_busy | mshr.update.valid))
+
+    else:
+        about_to_miss <<= ~s1_hit & s1_req.valid
+
+        #
+        # N.B. Stores wait for the fill state to end, since the line being
+        # replaced has already been written back and mustn't be stored to.
+        #
+
+        stall <<= \
+            ((miss_state != mstates.idle) & (miss_state != mstates.fill)) | \
+            about_to_miss | \
+            (s1_store & (miss_state == mstates.fill))
 
     evict_way = Reg(Bits(CC.way_addr_width), reset_value=0)
+    evict_addr = Reg(Bits(C['paddr-width']), reset_value=0)
     evict_data = Reg(Bits(CC.line_width), reset_value=0)
 
+    #
+    # The line being evicted is the one held by the way the meta array picked
+    # (in the set of the missed line).
+    #
+
+    victim_addr = Wire(Bits(C['paddr-width']))
+    victim_addr <<= Cat([
+        meta_array.resp.tag,
+        CC.Set(s1_req.addr),
+        Fill(zero, CC.line_index_width)
+    ])
+
+    #
+    # drop_*: the line written back to memory, if dirty, to make room for the
+    # missed line. This is the line being evicted, unless there is a victim
+    # cache to take it (see Victim Cache).
+    #
+
+    drop_dirty = Wire(Bits(1))
+    drop_addr = Wire(Bits(C['paddr-width']))
+    drop_data = Wire(Bits(CC.line_width))
+
+    drop_dirty <<= meta_array.resp.dirty
+    drop_addr <<= victim_addr
+    drop_data <<= s1_way_data
+
+    resp_match <<= CC.LineAddr(refill.addr) == CC.LineAddr(s1_req.addr)
+
+    #
+    # With early restart, fill_addr is the address of the miss whose line is
+    # still arriving (in the fill state).
+    #
+
+    fill_addr = Reg(Bits(C['paddr-width']), reset_value=0)
+
+    fill_match = Wire(Bits(1))
+    fill_match <<= CC.LineAddr(refill.addr) == CC.LineAddr(fill_addr)
+
+    beat_match = Wire(Bits(1))
+    beat_match <<= \
+        refill_beat.valid & \
+        (CC.LineAddr(refill_beat.addr) == CC.LineAddr(s1_req.addr)) & \
+        (CC.Beat(refill_beat.addr) == CC.Beat(s1_req.addr))
+
     #
     # Defaults
     #
 
-    io.mem.read <<= {
-        'valid': False,
-        'addr': 0
-    }
+    #
+    # Prefetch
+    #
+    # When enabled (icache only), every miss retargets the prefetch buffer to
+    # the next few lines. The buffer uses the read port whenever the miss
+    # handler isn't, so the prefetches go out while the missed line is being
+    # refilled and consumed. A miss that finds its line in the buffer is
+    # filled from it directly; one whose line is still in flight skips the
+    # read and waits for that response instead.
+    #
+    # With target prefetching, the hint (a predicted branch target) is checked
+    # against the tags through the meta array's probe port. If the line isn't
+    # in the cache, it is handed to the prefetch buffer a cycle later.
+    #
+
+    meta_array.probe.addr <<= io.prefetch_hint.addr
+
+    if CC.prefetch_slots > 0:
+        prefetcher = Instance(PrefetchBuffer(CC))
+
+        prefetcher.miss.valid <<= (miss_state == mstates.idle) & about_to_miss
+        prefetcher.miss.addr <<= s1_req.addr
+
+        if CC.target_prefetch:
+            hint = Reg(prefetch_hint_bundle, reset_value={
+                'valid': False,
+                'addr': 0
+            })
+
+            hint <<= io.prefetch_hint
+
+            prefetcher.hint.valid <<= hint.valid & ~meta_array.probe_hit
+            prefetcher.hint.addr <<= hint.addr
+
+        else:
+            prefetcher.hint <<= {
+                'valid': False,
+                'addr': 0
+            }
+
+        prefetcher.read_enable <<= \
+            (miss_state != mstates.read) & \
+            ~((miss_state == mstates.idle) & about_to_miss)
+
+        mem.read.valid <<= prefetcher.read.valid
+        mem.read.addr <<= prefetcher.read.addr
+        prefetcher.read.ready <<= mem.read.ready
+
+        prefetcher.resp.valid <<= refill.valid
+        prefetcher.resp.addr <<= refill.addr
+        prefetcher.resp.data <<= refill.data
+
+        io.prefetch_useful <<= prefetcher.useful
+        io.prefetch_useless <<= prefetcher.useless
 
-    io.mem.write <<= {
+    else:
+        mem.read <<= {
+            'valid': False,
+            'addr': 0
+        }
+
+        io.prefetch_useful <<= False
+        io.prefetch_useless <<= 0
+
+    mem.write <<= {
         'valid': False,
         'addr': 0,
         'data': 0
     }
 
-    io.mem.resp.ready <<= False
+    #
+    # N.B. With prefetching, responses for prefetched lines can arrive at any
+    # time, so they are always accepted.
+    #
+
+    mem.resp.ready <<= CC.prefetch_slots > 0
 
     meta_array.update <<= {
         'valid': False,
         'way': evict_way,
-        'set': CC.Set(io.mem.resp.addr),
-        'tag': CC.Tag(io.mem.resp.addr)
+        'set': CC.Set(refill.addr),
+        'tag': CC.Tag(refill.addr),
+        'dirty': False
     }
 
     data_array.update <<= {
         'valid': False,
         'way': evict_way,
-        'set': CC.Set(io.mem.resp.addr),
-        'data': io.mem.resp.data
+        'set': CC.Set(refill.addr),
+        'data': fill_line
     }
 
+    if CC.predecode:
+        pd_array.update <<= {
+            'valid': False,
+            'way': evict_way,
+            'set': CC.Set(refill.addr),
+            'data': predecoder.predecode
+        }
+
     with miss_state == mstates.idle:
         with about_to_miss:
             evict_way <<= meta_array.resp.way
-            evict_data <<= s1_read_data
+            evict_addr <<= drop_addr
+            evict_data <<= drop_data
 
             #
             # Here we are about to take a miss. For the dcache, if the reported
-            # way to evict is valid (in meta data), then the data needs to be
+            # way to evict is dirty (in meta data), then the data needs to be
             # written to memory before new data can be pulled into the cache.
             # In that case, move to the evict state. If this is an icache or the
-            # way does not contain valid data, go immediately to the read state.
+            # way does not contain dirty data, go immediately to the read state.
+            #
+            # With a write-back buffer, the evicted line is handed to the
+            # buffer right here, and the evict state is only needed when the
+            # buffer is full.
             #
 
             if CC.cache_type == 'dcache':
-                with meta_array.resp.valid:
+                with drop_dirty:
                     miss_state <<= mstates.evict
+
+                    if CC.wb_entries > 0:
+                        mem.write <<= {
+                            'valid': True,
+                            'addr': drop_addr,
+                            'data': drop_data
+                        }
+
+                        with mem.write.ready:
+                            miss_state <<= mstates.read
+
                 with otherwise:
                     miss_state <<= mstates.read
             else:
                 miss_state <<= mstates.read
 
+            #
+            # If the prefetch buffer already holds the line, the miss is
+            # serviced right here. If the line was prefetched but hasn't
+            # arrived yet, there's no need to read it again.
+            #
+
+            if CC.prefetch_slots > 0:
+                with prefetcher.lookup.pending:
+                    miss_state <<= mstates.update
+
+                with prefetcher.lookup.valid:
+                    aligner.line <<= prefetcher.lookup.data
+                    miss_data <<= aligner.result
+                    complete_miss <<= True
+
+                    if CC.line_buffer:
+                        lb_valid <<= True
+                        lb_addr <<= CC.LineAddr(s1_req.addr)
+                        lb_line <<= prefetcher.lookup.data
+
+                    meta_array.update <<= {
+                        'valid': True,
+                        'way': meta_array.resp.way,
+                        'set': CC.Set(s1_req.addr),
+                        'tag': CC.Tag(s1_req.addr),
+                        'dirty': False
+                    }
+
+                    data_array.update <<= {
+                        'valid': True,
+                        'way': meta_array.resp.way,
+                        'set': CC.Set(s1_req.addr),
+                        'data': prefetcher.lookup.data
+                    }
+
+                    if CC.predecode:
+                        predecoder.line <<= prefetcher.lookup.data
+
+                        miss_pd <<= PredecodeWord(
+                            CC, predecoder.predecode, s1_req.addr)
+
+                        if CC.line_buffer:
+                            lb_pd <<= predecoder.predecode
+
+                        pd_array.update <<= {
+                            'valid': True,
+                            'way': meta_array.resp.way,
+                            'set': CC.Set(s1_req.addr),
+                            'data': predecoder.predecode
+                        }
+
+                    miss_state <<= mstates.idle
+                    s1_req <<= cpu_cache_req_reset
+
     with miss_state == mstates.evict:
 
         #
@@ -163,13 +731,13 @@ def Cache(CC : CacheConfig):
         # to the memory and move to the read state.
         #
 
-        io.mem.write <<= {
+        mem.write <<= {
             'valid': True,
-            'addr': s1_req.addr,
+            'addr': evict_addr,
             'data': evict_data
         }
 
-        with io.mem.write.ready:
+        with mem.write.ready:
             miss_state <<= mstates.read
 
     with miss_state == mstates.read:
@@ -178,12 +746,12 @@ def Cache(CC : CacheConfig):
         # Here send the request to the memory the missed line of data.
         #
 
-        io.mem.read <<= {
+        mem.read <<= {
             'valid': True,
             'addr': s1_req.addr
         }
 
-        with io.mem.read.ready:
+        with mem.read.ready:
             miss_state <<= mstates.update
 
     with miss_state == mstates.update:
@@ -194,15 +762,311 @@ def Cache(CC : CacheConfig):
         # stall signal can be pulled low.
         #
 
-        io.mem.resp.ready <<= True
-        aligner.line <<= io.mem.resp.data
+        mem.resp.ready <<= True
+        aligner.line <<= refill.data
+
+        #
+        # With early restart, the miss is completed as soon as the beat holding
+        # the missed word arrives. The rest of the line is waited for in the
+        # fill state, while the cache goes on serving hits. A store needs the
+        # whole line, so it waits for it here.
+        #
+
+        if CC.early_restart:
+            with beat_match & s1_req.read:
+                aligner.line <<= refill_beat.data
+                miss_data <<= aligner.result
+                complete_miss <<= True
+
+                fill_addr <<= s1_req.addr
+                miss_state <<= mstates.fill
+                s1_req <<= cpu_cache_req_reset
+
+        #
+        # N.B. With prefetching, the response may be for a prefetched line
+        # rather than the missed one. Those are left to the prefetch buffer.
+        #
 
-        with io.mem.resp.valid:
+        with refill.valid & resp_match:
             miss_data <<= aligner.result
             complete_miss <<= True
+
+            if CC.line_buffer:
+                lb_valid <<= True
+                lb_addr <<= CC.LineAddr(refill.addr)
+                lb_line <<= refill.data
+
             meta_array.update.valid <<= True
+            meta_array.update.dirty <<= s1_store
             data_array.update.valid <<= True
+
+            if CC.predecode:
+                miss_pd <<= PredecodeWord(
+                    CC, predecoder.predecode, s1_req.addr)
+
+                if CC.line_buffer:
+                    lb_pd <<= predecoder.predecode
+
+                pd_array.update.valid <<= True
+
             miss_state <<= mstates.idle
             s1_req <<= cpu_cache_req_reset
 
+    with miss_state == mstates.fill:
+
+        #
+        # Here wait for the rest of the line after an early restart. When it
+        # has arrived, the arrays are updated. A request that missed on the
+        # same line in the meantime is completed along with it.
+        #
+
+        mem.resp.ready <<= True
+
+        with refill.valid & fill_match:
+            if CC.line_buffer:
+                lb_valid <<= True
+                lb_addr <<= CC.LineAddr(refill.addr)
+                lb_line <<= refill.data
+
+            meta_array.update.valid <<= True
+            data_array.update.valid <<= True
+
+            miss_state <<= mstates.idle
+
+            with s1_req.valid & resp_match:
+                aligner.line <<= refill.data
+                miss_data <<= aligner.result
+                complete_miss <<= True
+
+                meta_array.update.dirty <<= s1_store
+
+                s1_req <<= cpu_cache_req_reset
+
+    #
+    # Non-blocking Miss Handling
+    #
+    # With MSHRs (dcache only), misses are handed to the MSHRs instead of the
+    # state machine above, which stays idle. Lines held by an MSHR that is
+    # replaying are hits. A load that misses carries on down the pipeline with
+    # its response marked pending, and its register is written by the MSHRs
+    # once the line arrives (fill_write). The cache only stalls when a miss
+    # can't be taken yet.
+    #
+    # N.B. While stalled (by the cache or the cpu), the arrays are read again
+    # with s1's address rather than held, so the tag check sees lines refilled
+    # in the meantime.
+    #
+
+    if CC.mshrs > 0:
+        mshr.lookup.addr <<= s1_req.addr
+        mshr.lookup.read <<= s1_req.read
+
+        with mshr.hit:
+            s1_hit <<= True
+            s1_read_data <<= mshr.hit_data
+
+        s1_pending <<= s1_req.valid & s1_req.read & ~s1_hit
+
+        alloc = s1_req.valid & ~s1_hit & ~stall & ~io.cpu_stall
+
+        mshr.alloc <<= {
+            'valid': alloc,
+            'addr': s1_req.addr,
+            'read': s1_req.read,
+            'rd': s1_req.rd,
+            'rtype': s1_req.rtype,
+            'data': s1_req.data,
+            'way': meta_array.resp.way,
+            'evict': drop_dirty,
+            'evict_line': CC.LineAddr(drop_addr),
+            'evict_data': drop_data
+        }
+
+        io.miss <<= alloc
+
+        array_hold <<= False
+
+        with stall | io.cpu_stall:
+            array_addr <<= s1_req.addr
+
+        mem.read <<= mshr.read
+        mem.write <<= mshr.write
+        mem.resp.ready <<= True
+
+        mshr.refill <<= {
+            'valid': refill.valid,
+            'addr': refill.addr,
+            'data': refill.data
+        }
+
+        mshr.beat <<= {
+            'valid': refill_beat.valid,
+            'addr': refill_beat.addr,
+            'data': refill_beat.data
+        }
+
+        meta_array.update <<= {
+            'valid': mshr.update.valid,
+            'way': mshr.update.way,
+            'set': mshr.update.set,
+            'tag': mshr.update.tag,
+            'dirty': mshr.update.dirty
+        }
+
+        data_array.update <<= {
+            'valid': mshr.update.valid,
+            'way': mshr.update.way,
+            'set': mshr.update.set,
+            'data': mshr.update.data
+        }
+
+        io.pending_regs <<= mshr.pending
+        io.fill_write <<= mshr.fill_write
+
+    else:
+        s1_pending <<= False
+
+        for r in range(C['reg-count']):
+            io.pending_regs[r] <<= False
+
+        io.fill_write.valid <<= False
+        io.fill_write.rd <<= 0
+        io.fill_write.data <<= 0
+
+    #
+    # Victim Cache
+    #
+    # When enabled (dcache only), lines evicted by misses go into the victim
+    # cache (see cache/victim.py), and the line it drops to make room is
+    # written back in their place. Requests that miss in the arrays are looked
+    # up in the victim cache alongside the tag check. On a hit, the line is
+    # swapped back into the arrays (in place of the line the miss would have
+    # evicted, which goes into the victim cache), and the request is a hit.
+    #
+    # N.B. A swap changes a tag the next request may have already checked, so
+    # a bubble is put into stage 0 (and req_stall raised) while it is done.
+    # Like a store hit, it has to wait for the update port and for any MSHR of
+    # its set (vc_busy), since the line it replaces may be one being refilled.
+    #
+
+    if CC.victim_entries > 0:
+        vc = Instance(VictimCache(CC))
+
+        vc.lookup.addr <<= s1_req.addr
+
+        vc_busy = Wire(Bits(1))
+        vc_lookup = Wire(Bits(1))
+        vc_swap = Wire(Bits(1))
+        vc_swap_go = Wire(Bits(1))
+
+        if CC.mshrs > 0:
+            vc_busy <<= mshr.set_busy | mshr.update.valid
+            vc_miss = alloc & ~mshr.tracked
+        else:
+            vc_busy <<= miss_state != mstates.idle
+            vc_miss = (miss_state == mstates.idle) & about_to_miss
+
+        #
+        # N.B. Only a miss that replaces a valid line puts it into the victim
+        # cache (and has the victim cache drop one). A miss that fills an
+        # invalid way evicts nothing, as without a victim cache.
+        #
+
+        vc_insert = vc_miss & meta_array.resp.valid
+
+        vc_lookup <<= s1_req.valid & ~meta_array.resp.hit & vc.hit
+        vc_swap <<= vc_lookup & ~vc_busy
+        vc_swap_go <<= vc_swap & ~stall & ~io.cpu_stall
+
+        with vc_lookup & vc_busy:
+            stall <<= True
+
+        with vc_swap:
+            s1_hit <<= True
+            s1_read_data <<= vc.hit_data
+
+            s0_req <<= cpu_cache_req_reset
+            s0_fwd <<= False
+            req_stall <<= True
+
+            if CC.sb_entries > 0:
+                sbuf.store.valid <<= False
+                sbuf.drain.ready <<= False
+
+        with meta_array.resp.valid:
+            drop_dirty <<= vc.drop.dirty
+            drop_addr <<= vc.drop.addr
+            drop_data <<= vc.drop.data
+
+        vc.write <<= {
+            'valid': vc_swap_go | vc_insert,
+            'swap': vc_swap_go,
+            'line_valid': meta_array.resp.valid,
+            'dirty': meta_array.resp.dirty,
+            'addr': victim_addr,
+            'data': s1_way_data
+        }
+
+        io.victim_hit <<= vc_swap_go
+        io.victim_miss <<= vc_miss
+
+    else:
+        io.victim_hit <<= False
+        io.victim_miss <<= False
+
+    #
+    # A load forwarded from the store buffer hits on the forwarded word, which
+    # the aligner picks out of the line wherever it is.
+    #
+    # N.B. This comes after the MSHRs, since the buffer holds younger data
+    # than a line being replayed.
+    #
+
+    with s1_fwd:
+        s1_hit <<= True
+        s1_read_data <<= \
+            Cat([s1_fwd_data for _ in range(CC.line_width // C['core-width'])])
+
+    #
+    # Store Hits
+    #
+    # N.B. This comes after the miss handling, which never updates the arrays
+    # in the same cycle as a store hit (see stall). A store that hits in the
+    # victim cache is written into the arrays along with the swap.
+    #
+
+    if CC.victim_entries > 0:
+        with vc_swap_go:
+            meta_array.update <<= {
+                'valid': True,
+                'way': meta_array.resp.way,
+                'set': CC.Set(s1_req.addr),
+                'tag': CC.Tag(s1_req.addr),
+                'dirty': vc.hit_dirty
+            }
+
+            data_array.update <<= {
+                'valid': True,
+                'way': meta_array.resp.way,
+                'set': CC.Set(s1_req.addr),
+                'data': s1_read_data
+            }
+
+    if CC.cache_type == 'dcache':
+        with store_hit:
+            meta_array.update <<= {
+                'valid': True,
+                'way': meta_array.resp.way,
+                'set': CC.Set(s1_req.addr),
+                'tag': CC.Tag(s1_req.addr),
+                'dirty': True
+            }
+
+            data_array.update <<= {
+                'valid': True,
+                'way': meta_array.resp.way,
+                'set': CC.Set(s1_req.addr),
+                'data': merger.result
+            }
+
     NameSignals(locals())
@@ -0,0 +1,296 @@
+from atlas import *
+from ..support import *
+
+from .data import CacheDataArray
+from .meta import CacheMetaArray
+from .refill import LineAssembler
+
+l2_states = Enum(['idle', 'lookup', 'send', 'evict', 'read', 'refill'])
+
+@Module
+def L2Cache(CC : CacheConfig):
+    """Unified L2 cache, shared by the icache and dcache.
+
+    The L2 sits between the L1s (behind a MemArbiter, see cache/arbiter.py)
+    and memory, and serves one request from them at a time:
+
+    idle:   wait for a request. Its set is read from the arrays as it is taken
+    lookup: check the tags. A write that hits (or misses, with a clean line
+            to replace) is written into the arrays right away
+    send:   a read that hit is sent back a beat at a time (see
+            mem_read_response), starting with the beat holding its address
+    evict:  the dirty line being replaced is written back to memory
+    read:   the read for the missed line is sent to memory
+    refill: the beats of the missed line are passed on to the L1 as they
+            arrive, and the line is written into the arrays with its last beat
+
+    Writes from the L1s (evictions) are whole lines, so one that misses takes
+    its place in the L2 without reading the line from memory first. Lines
+    written by the L1s are dirty, and are written back to memory when they are
+    evicted from the L2.
+    """
+
+    beat_bits = CC.line_index_width - CC.beat_index_width
+
+    io = Io({
+        'l1': Input(mem_bundle),
+        'mem': Output(mem_bundle),
+        'hit': Output(Bits(1)),
+        'miss': Output(Bits(1))
+    })
+
+    meta_array = Instance(CacheMetaArray(CC))
+    data_array = Instance(CacheDataArray(CC))
+
+    zero = Wire(Bits(1))
+    zero <<= 0
+
+    state = Reg(Bits(l2_states.bitwidth), reset_value=l2_states.idle)
+
+    req_write = Reg(Bits(1), reset_value=False)
+    req_addr = Reg(Bits(C['paddr-width']), reset_value=0)
+    req_data = Reg(Bits(CC.line_width), reset_value=0)
+
+    #
+    # line_way / line_addr / line_data: the line read out of the arrays by the
+    # lookup, which is sent to the L1 (on a hit) or evicted (on a miss).
+    #
+
+    line_way = Reg(Bits(CC.way_addr_width), reset_value=0)
+    line_addr = Reg(Bits(C['paddr-width']), reset_value=0)
+    line_data = Reg(Bits(CC.line_width), reset_value=0)
+
+    #
+    # Refill
+    #
+    # Lines from memory come back over a number of beats, like they do for the
+    # L1s (see cache/refill.py).
+    #
+
+    resp_take = Wire(Bits(1))
+
+    if CC.refill_beats > 1:
+        assembler = Instance(LineAssembler(CC))
+
+        assembler.resp <<= {
+            'valid': resp_take,
+            'addr': io.mem.resp.addr,
+            'data': io.mem.resp.data
+        }
+
+        refill = assembler.line
+
+    else:
+        refill = io.mem.resp
+
+    #
+    # Idle: Take a request
+    #
+    # N.B. Like the L1s' arrays, the arrays always read, so they are read with
+    # the address of the request being taken and hold that read until the L2
+    # is idle again.
+    #
+
+    idle = Wire(Bits(1))
+    idle <<= state == l2_states.idle
+
+    array_addr = Wire(Bits(C['paddr-width']))
+    array_addr <<= io.l1.read.addr
+
+    with ~io.l1.read.valid:
+        array_addr <<= io.l1.write.addr
+
+    meta_array.read.addr <<= array_addr
+    data_array.read.addr <<= array_addr
+    meta_array.stall <<= ~idle
+    data_array.stall <<= ~idle
+    meta_array.touch <<= state == l2_states.lookup
+    meta_array.probe.addr <<= 0
+
+    io.l1.read.ready <<= idle
+    io.l1.write.ready <<= idle & ~io.l1.read.valid
+
+    with idle & (io.l1.read.valid | io.l1.write.valid):
+        req_write <<= ~io.l1.read.valid
+        req_addr <<= array_addr
+        req_data <<= io.l1.write.data
+        state <<= l2_states.lookup
+
+    #
+    # Defaults
+    #
+
+    io.l1.resp <<= {
+        'valid': False,
+        'addr': 0,
+        'data': 0
+    }
+
+    io.mem.read <<= {
+        'valid': False,
+        'addr': 0
+    }
+
+    io.mem.write <<= {
+        'valid': False,
+        'addr': 0,
+        'data': 0
+    }
+
+    io.mem.resp.ready <<= False
+    resp_take <<= False
+
+    meta_array.update <<= {
+        'valid': False,
+        'way': line_way,
+        'set': CC.Set(req_addr),
+        'tag': CC.Tag(req_addr),
+        'dirty': True
+    }
+
+    data_array.update <<= {
+        'valid': False,
+        'way': line_way,
+        'set': CC.Set(req_addr),
+        'data': req_data
+    }
+
+    def WriteLine(way):
+        meta_array.update.valid <<= True
+        meta_array.update.way <<= way
+        data_array.update.valid <<= True
+        data_array.update.way <<= way
+
+    #
+    # Lookup
+    #
+
+    lookup = Wire(Bits(1))
+    lookup <<= state == l2_states.lookup
+
+    io.hit <<= lookup & ~req_write & meta_array.resp.hit
+    io.miss <<= lookup & ~req_write & ~meta_array.resp.hit
+
+    with lookup:
+        line_way <<= meta_array.resp.way
+        line_data <<= data_array.resp[meta_array.resp.way]
+        line_addr <<= Cat([
+            meta_array.resp.tag,
+            CC.Set(req_addr),
+            Fill(zero, CC.line_index_width)
+        ])
+
+        with meta_array.resp.hit:
+            with req_write:
+                WriteLine(meta_array.resp.way)
+                state <<= l2_states.idle
+
+            with otherwise:
+                line_addr <<= req_addr
+                state <<= l2_states.send
+
+        with otherwise:
+            with meta_array.resp.dirty:
+                state <<= l2_states.evict
+
+            with otherwise:
+                with req_write:
+                    WriteLine(meta_array.resp.way)
+                    state <<= l2_states.idle
+
+                with otherwise:
+                    state <<= l2_states.read
+
+    #
+    # Send
+    #
+    # N.B. On a hit, line_addr is the address of the next beat to send.
+    #
+
+    if CC.refill_beats > 1:
+        sent = Reg(Bits(beat_bits), reset_value=0)
+
+        beats = Wire([Bits(mem_bus_width) for _ in range(CC.refill_beats)])
+
+        for k in range(CC.refill_beats):
+            beats[k] <<= \
+                line_data(mem_bus_width * (k + 1) - 1, mem_bus_width * k)
+
+        next_beat = Wire(Bits(beat_bits))
+        next_beat <<= CC.Beat(line_addr) + 1
+
+    with state == l2_states.send:
+        io.l1.resp.valid <<= True
+        io.l1.resp.addr <<= line_addr
+
+        if CC.refill_beats > 1:
+            io.l1.resp.data <<= beats[CC.Beat(line_addr)]
+
+            with io.l1.resp.ready:
+                sent <<= sent + 1
+                line_addr <<= Cat([
+                    CC.LineAddr(line_addr),
+                    next_beat,
+                    Fill(zero, CC.beat_index_width)
+                ])
+
+                with sent == CC.refill_beats - 1:
+                    state <<= l2_states.idle
+
+        else:
+            io.l1.resp.data <<= line_data
+
+            with io.l1.resp.ready:
+                state <<= l2_states.idle
+
+    #
+    # Evict
+    #
+
+    with state == l2_states.evict:
+        io.mem.write <<= {
+            'valid': True,
+            'addr': line_addr,
+            'data': line_data
+        }
+
+        with io.mem.write.ready:
+            with req_write:
+                WriteLine(line_way)
+                state <<= l2_states.idle
+
+            with otherwise:
+                state <<= l2_states.read
+
+    #
+    # Read
+    #
+
+    with state == l2_states.read:
+        io.mem.read <<= {
+            'valid': True,
+            'addr': req_addr
+        }
+
+        with io.mem.read.ready:
+            state <<= l2_states.refill
+
+    #
+    # Refill
+    #
+
+    with state == l2_states.refill:
+        io.mem.resp.ready <<= io.l1.resp.ready
+        resp_take <<= io.mem.resp.valid & io.l1.resp.ready
+
+        io.l1.resp.valid <<= io.mem.resp.valid
+        io.l1.resp.addr <<= io.mem.resp.addr
+        io.l1.resp.data <<= io.mem.resp.data
+
+        with refill.valid & resp_take:
+            WriteLine(line_way)
+            meta_array.update.dirty <<= False
+            data_array.update.data <<= refill.data
+            state <<= l2_states.idle
+
+    NameSignals(locals())
@@ -0,0 +1,107 @@
+from atlas import *
+from ..support import *
+
+def ByteEnables(byte_index, rtype, num_bytes):
+    """The bytes (of num_bytes) accessed by an access of type rtype at
+    byte_index.
+
+    N.B. The low 2 bits of rtype are log2 of the access size in bytes (see
+    access_rtype), so an access of size 2^k covers byte i when i and
+    byte_index agree above bit k.
+    """
+
+    index_width = Log2Ceil(num_bytes)
+    size_log = rtype(1, 0)
+
+    enables = Wire([Bits(1) for _ in range(num_bytes)])
+
+    for i in range(num_bytes):
+        enables[i] <<= False
+
+        for k in range(4):
+            if k < index_width:
+                covered = \
+                    (size_log == k) & \
+                    (byte_index(index_width - 1, k) == (i >> k))
+            else:
+                covered = size_log == k
+
+            with covered:
+                enables[i] <<= True
+
+    mask = Wire(Bits(num_bytes))
+    mask <<= Cat([enables[i] for i in reversed(range(num_bytes))])
+
+    return mask
+
+def StoreLanes(rtype, data, num_bytes):
+    """The data of a store of type rtype repeated across num_bytes bytes.
+
+    Byte i is byte (i mod size) of the data, so wherever the store lands (see
+    ByteEnables), its bytes are in the right place.
+    """
+
+    size_log = rtype(1, 0)
+
+    lane_bytes = Wire([Bits(8) for _ in range(num_bytes)])
+
+    for i in range(num_bytes):
+        lane_bytes[i] <<= data(7, 0)
+
+        for k in range(4):
+            offset = i % (1 << k)
+
+            with size_log == k:
+                lane_bytes[i] <<= data(8 * offset + 7, 8 * offset)
+
+    lanes = Wire(Bits(8 * num_bytes))
+    lanes <<= Cat([lane_bytes[i] for i in reversed(range(num_bytes))])
+
+    return lanes
+
+def MaskMerge(mask, new, old):
+    """The line old with the bytes set in mask taken from the line new."""
+
+    num_bytes = mask.width
+
+    merged_bytes = Wire([Bits(8) for _ in range(num_bytes)])
+
+    for i in range(num_bytes):
+        merged_bytes[i] <<= old(8 * i + 7, 8 * i)
+
+        with mask(i, i):
+            merged_bytes[i] <<= new(8 * i + 7, 8 * i)
+
+    merged = Wire(Bits(old.width))
+    merged <<= Cat([merged_bytes[i] for i in reversed(range(num_bytes))])
+
+    return merged
+
+@Module
+def StoreMerger(CC : CacheConfig):
+    """Merges the data of a store into a line.
+
+    The bytes a store writes (its byte enables) follow from its rtype and
+    address, the same way the bytes a load reads do in the Aligner. mask has a
+    bit set for each of them, and result is line with those bytes replaced by
+    the store's data.
+    """
+
+    num_bytes = CC.line_width_bytes
+
+    io = Io({
+        'addr': Input(Bits(C['paddr-width'])),
+        'rtype': Input(Bits(access_rtype.bitwidth)),
+        'data': Input(Bits(C['core-width'])),
+        'line': Input(Bits(CC.line_width)),
+        'mask': Output(Bits(num_bytes)),
+        'result': Output(Bits(CC.line_width))
+    })
+
+    mask = ByteEnables(CC.Index(io.addr), io.rtype, num_bytes)
+    lanes = StoreLanes(io.rtype, io.data, num_bytes)
+
+    io.mask <<= mask
+    io.result <<= MaskMerge(mask, lanes, io.line)
+
+    NameSignals(locals())
@@ -8,17 +8,25 @@ def CacheMetaArray(CC : CacheConfig):
             'addr': Bits(C['paddr-width'])
         }),
         'stall': Input(Bits(1)),
+        'touch': Input(Bits(1)),
         'resp': Output({
             'hit': Bits(1),
             'way': Bits(CC.way_addr_width),
-            'valid' : Bits(1)
+            'valid' : Bits(1),
+            'dirty': Bits(1),
+            'tag': Bits(CC.tag_width)
         }),
         'update': Input({
             'valid': Bits(1),
             'set': Bits(CC.set_addr_width),
             'way': Bits(CC.way_addr_width),
-            'tag': Bits(CC.tag_width)
-        })
+            'tag': Bits(CC.tag_width),
+            'dirty': Bits(1)
+        }),
+        'probe': Input({
+            'addr': Bits(C['paddr-width'])
+        }),
+        'probe_hit': Output(Bits(1))
     })
 
     meta_arrays = [
@@ -26,16 +34,17 @@ def CacheMetaArray(CC : CacheConfig):
         for _ in range(CC.num_ways)
     ]
 
-    read_tag = Reg(Bits(CC.tag_width), reset_value=0)
-    read_tag <<= CC.Tag(io.read.addr)
-
     #
-    # When this array reports a miss, evict_way is used to report the way that
-    # should be evicted (if needed).
+    # N.B. While stalled, the arrays hold their last read, so the tag it is
+    # compared against (and the valid and dirty bits) have to be held as well.
     #
 
-    evict_way = Reg(Bits(CC.way_addr_width), reset_value=0)
-    evict_way <<= evict_way + 1
+    read_tag = Reg(Bits(CC.tag_width), reset_value=0)
+    read_set = Reg(Bits(CC.set_addr_width), reset_value=0)
+
+    with ~io.stall:
+        read_tag <<= CC.Tag(io.read.addr)
+        read_set <<= CC.Set(io.read.addr)
 
     valid_bits = [
         ValidSet(CC.num_sets)
@@ -46,9 +55,40 @@ def CacheMetaArray(CC : CacheConfig):
         [Bits(1) for _ in range(CC.num_ways)],
         reset_value=[0 for _ in range(CC.num_ways)])
 
-    io.resp.way <<= evict_way
-    io.resp.hit <<= False
-    io.resp.valid <<= valid_reg[evict_way]
+    #
+    # Dirty Bits
+    #
+    # The dcache writes lines back to memory only once they have been stored
+    # to. A line is dirty if it was written by a store (and clean if it was
+    # written by a refill), see io.update.dirty. The same goes for the L2, whose
+    # lines are dirty once written by the dcache (see cache/l2.py).
+    #
+
+    dirty_reg = Reg(
+        [Bits(1) for _ in range(CC.num_ways)],
+        reset_value=[0 for _ in range(CC.num_ways)])
+
+    if CC.cache_type != 'icache':
+        dirty_bits = [
+            ValidSet(CC.num_sets)
+            for _ in range(CC.num_ways)
+        ]
+
+        #
+        # N.B. A store to the set being read lands in the same cycle as the
+        # read, so the line it dirties is passed on to the read directly. Lines
+        # being made clean aren't, since a line reported dirty when it isn't
+        # only costs an extra write back.
+        #
+
+        for way in range(CC.num_ways):
+            with ~io.stall:
+                dirty_reg[way] <<= dirty_bits[way][CC.Set(io.read.addr)]
+
+                with io.update.valid & io.update.dirty & \
+                        (io.update.way == way) & \
+                        (io.update.set == CC.Set(io.read.addr)):
+                    dirty_reg[way] <<= True
 
     #
     # Read Logic
@@ -59,13 +99,147 @@ def CacheMetaArray(CC : CacheConfig):
         for way in range(CC.num_ways)
     ]
 
+    hit = Wire(Bits(1))
+    hit_way = Wire(Bits(CC.way_addr_width))
+
+    hit <<= False
+    hit_way <<= 0
+
     for way in range(CC.num_ways):
-        valid_reg[way] <<= valid_bits[way][CC.Set(io.read.addr)]
+        with ~io.stall:
+            valid_reg[way] <<= valid_bits[way][CC.Set(io.read.addr)]
 
         with (read_data[way] == read_tag) & valid_reg[way]:
-            io.resp.hit <<= True
-            io.resp.way <<= way
-            io.resp.valid <<= valid_reg[way]
+            hit <<= True
+            hit_way <<= way
+
+    #
+    # Replacement
+    #
+    # When this array reports a miss, victim is the way that should be
+    # replaced (and evicted if valid). It is picked by the replacement policy
+    # of the cache (CC.replacement):
+    #
+    # random: a free running counter
+    # plru:   tree pseudo-LRU (see support/replacement.py)
+    # lru:    true LRU (at most 4 ways)
+    #
+    # With plru and lru, ways that aren't valid are filled first, and the
+    # policy state of a set is updated whenever a request hits in it (touch)
+    # and whenever a line is written into it (update).
+    #
+
+    victim = Wire(Bits(CC.way_addr_width))
+
+    if CC.replacement == 'random':
+        evict_way = Reg(Bits(CC.way_addr_width), reset_value=0)
+        evict_way <<= evict_way + 1
+
+        victim <<= evict_way
+
+    else:
+        if CC.replacement == 'plru':
+            state_bits = CC.num_ways - 1
+            Touch = lambda state, way: PlruTouch(state, way, CC.num_ways)
+            Victim = lambda state: PlruVictim(state, CC.num_ways)
+
+        else:
+            state_bits = CC.num_ways * CC.way_addr_width
+
+            Touch = lambda state, way: \
+                LruPack(LruTouch(LruUnpack(state, CC.num_ways), way))
+
+            Victim = lambda state: LruVictim(LruUnpack(state, CC.num_ways))
+
+        repl_state = Reg(
+            [Bits(state_bits) for _ in range(CC.num_sets)],
+            reset_value=[0 for _ in range(CC.num_sets)])
+
+        read_state = Wire(Bits(state_bits))
+        read_state <<= repl_state[read_set]
+
+        victim <<= Victim(read_state)
+
+        for way in reversed(range(CC.num_ways)):
+            with ~valid_reg[way]:
+                victim <<= way
+
+        #
+        # N.B. A hit and an update can land in the same set in the same
+        # cycle, in which case the update applies on top of the hit.
+        #
+
+        do_touch = io.touch & hit
+
+        touched = Touch(read_state, hit_way)
+
+        update_state = Wire(Bits(state_bits))
+        update_state <<= repl_state[io.update.set]
+
+        with do_touch & (io.update.set == read_set):
+            update_state <<= touched
+
+        updated = Touch(update_state, io.update.way)
+
+        for s in range(CC.num_sets):
+            with do_touch & (read_set == s):
+                repl_state[s] <<= touched
+
+            with io.update.valid & (io.update.set == s):
+                repl_state[s] <<= updated
+
+    #
+    # N.B. resp.tag is the tag held by resp.way, so on a miss it tells the
+    # cache which line is being evicted.
+    #
+
+    io.resp.hit <<= hit
+    io.resp.way <<= victim
+    io.resp.valid <<= valid_reg[victim]
+    io.resp.dirty <<= dirty_reg[victim]
+    io.resp.tag <<= read_data[0]
+
+    for way in range(CC.num_ways):
+        with victim == way:
+            io.resp.tag <<= read_data[way]
+
+    with hit:
+        io.resp.way <<= hit_way
+        io.resp.valid <<= True
+        io.resp.dirty <<= dirty_reg[hit_way]
+        io.resp.tag <<= read_tag
+
+    #
+    # Probe Logic
+    #
+    # The probe port is a second (clocked) tag lookup that never stalls. It is
+    # only built when target prefetching is enabled; it lets the cache check
+    # whether a predicted branch target is present before the fetch of the
+    # target reaches stage 1.
+    #
+
+    io.probe_hit <<= True
+
+    if CC.target_prefetch:
+        probe_tag = Reg(Bits(CC.tag_width), reset_value=0)
+        probe_tag <<= CC.Tag(io.probe.addr)
+
+        probe_data = [
+            meta_arrays[way].Read(CC.Set(io.probe.addr))
+            for way in range(CC.num_ways)
+        ]
+
+        probe_valid = Reg(
+            [Bits(1) for _ in range(CC.num_ways)],
+            reset_value=[0 for _ in range(CC.num_ways)])
+
+        io.probe_hit <<= False
+
+        for way in range(CC.num_ways):
+            probe_valid[way] <<= valid_bits[way][CC.Set(io.probe.addr)]
+
+            with (probe_data[way] == probe_tag) & probe_valid[way]:
+                io.probe_hit <<= True
 
     #
     # Update Logic
@@ -82,4 +256,10 @@ def CacheMetaArray(CC : CacheConfig):
             io.update.tag,
             io.update.valid & (io.update.way == way))
 
+        if CC.cache_type != 'icache':
+            dirty_bits[way].Set(
+                io.update.set,
+                io.update.dirty,
+                io.update.valid & (io.update.way == way))
+
     NameSignals(locals())
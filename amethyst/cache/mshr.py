@@ -0,0 +1,559 @@
+from atlas import *
+from ..support import *
+
+from .aligner import Aligner
+from .merge import MaskMerge, StoreMerger
+
+mshr_states = Enum(['evict', 'read', 'wait', 'replay'])
+
+@Module
+def MissStatusHoldingRegisters(CC : CacheConfig):
+    """Miss status holding registers (MSHRs) for a non-blocking cache.
+
+    Each MSHR tracks one missed line, from the miss until the line has been
+    written into the cache, so the cache can keep serving hits (and take more
+    misses) in the meantime. An MSHR moves through the following states:
+
+    evict:  the line being replaced is written back to memory (with a victim
+            cache, the line it drops instead, which can be from any set)
+    read:   the read for the missed line is sent to memory
+    wait:   the read response is awaited. When it arrives, the line is written
+            into the meta and data arrays
+    replay: the loads waiting on the line are written back to the register
+            file, one per cycle, after which the MSHR is freed
+
+    Loads that miss on a line an MSHR is already tracking are merged into it as
+    extra targets (secondary misses). While an MSHR is replaying, it holds the
+    line, so loads looking it up hit.
+
+    Stores that miss are written into the MSHR of their line (write-allocate),
+    and their bytes are merged into the line when it arrives, making it dirty.
+    To keep loads and stores in order, a store can't be merged into an MSHR
+    that has loads waiting on it (or is replaying), and stores that hit must
+    wait while their set has an MSHR (set_busy), since the line they hit may
+    be the one being replaced.
+
+    When lines are refilled over several beats, a target whose word arrives
+    before the rest of the line is written right away (early restart).
+
+    To keep replacement simple, only one MSHR is allowed per set. A miss that
+    can't be taken (no free MSHR, no free target or a set conflict) blocks
+    until it can.
+    """
+
+    num_mshrs = CC.mshrs
+    num_targets = CC.mshr_targets
+    reg_addr_width = Log2Ceil(C['reg-count'])
+
+    io = Io({
+        'lookup': Input({
+            'addr': Bits(C['paddr-width']),
+            'read': Bits(1)
+        }),
+        'hit': Output(Bits(1)),
+        'hit_data': Output(Bits(CC.line_width)),
+        'block': Output(Bits(1)),
+        'tracked': Output(Bits(1)),
+        'alloc': Input({
+            'valid': Bits(1),
+            'addr': Bits(C['paddr-width']),
+            'read': Bits(1),
+            'rd': Bits(reg_addr_width),
+            'rtype': Bits(access_rtype.bitwidth),
+            'data': Bits(C['core-width']),
+            'way': Bits(CC.way_addr_width),
+            'evict': Bits(1),
+            'evict_line': Bits(CC.line_addr_width),
+            'evict_data': Bits(CC.line_width)
+        }),
+        'set_busy': Output(Bits(1)),
+        'pending': Output([Bits(1) for _ in range(C['reg-count'])]),
+        'read': Output(mem_read_request),
+        'write': Output(mem_write_request),
+        'refill': Input({
+            'valid': Bits(1),
+            'addr': Bits(C['paddr-width']),
+            'data': Bits(CC.line_width)
+        }),
+        'beat': Input({
+            'valid': Bits(1),
+            'addr': Bits(C['paddr-width']),
+            'data': Bits(CC.line_width)
+        }),
+        'update': Output({
+            'valid': Bits(1),
+            'set': Bits(CC.set_addr_width),
+            'way': Bits(CC.way_addr_width),
+            'tag': Bits(CC.tag_width),
+            'dirty': Bits(1),
+            'data': Bits(CC.line_width)
+        }),
+        'fill_write': Output(reg_fill_bundle)
+    })
+
+    aligner = Instance(Aligner(CC))
+    merger = Instance(StoreMerger(CC))
+
+    mshr_valid = Reg(
+        [Bits(1) for _ in range(num_mshrs)],
+        reset_value=[0 for _ in range(num_mshrs)])
+
+    mshr_state = Reg(
+        [Bits(mshr_states.bitwidth) for _ in range(num_mshrs)],
+        reset_value=[mshr_states.evict for _ in range(num_mshrs)])
+
+    mshr_line = Reg(
+        [Bits(CC.line_addr_width) for _ in range(num_mshrs)],
+        reset_value=[0 for _ in range(num_mshrs)])
+
+    mshr_way = Reg(
+        [Bits(CC.way_addr_width) for _ in range(num_mshrs)],
+        reset_value=[0 for _ in range(num_mshrs)])
+
+    mshr_evict_line = Reg(
+        [Bits(CC.line_addr_width) for _ in range(num_mshrs)],
+        reset_value=[0 for _ in range(num_mshrs)])
+
+    #
+    # N.B. The data register holds the evicted line until it has been written
+    # back, and the refilled line after that.
+    #
+
+    mshr_data = Reg(
+        [Bits(CC.line_width) for _ in range(num_mshrs)],
+        reset_value=[0 for _ in range(num_mshrs)])
+
+    #
+    # The bytes written by stores to each MSHR's line, and which bytes they
+    # are.
+    #
+
+    mshr_store_mask = Reg(
+        [Bits(CC.line_width_bytes) for _ in range(num_mshrs)],
+        reset_value=[0 for _ in range(num_mshrs)])
+
+    mshr_store_data = Reg(
+        [Bits(CC.line_width) for _ in range(num_mshrs)],
+        reset_value=[0 for _ in range(num_mshrs)])
+
+    #
+    # Targets: the loads waiting on each MSHR's line.
+    #
+
+    tgt_valid = [
+        Reg(
+            [Bits(1) for _ in range(num_targets)],
+            reset_value=[0 for _ in range(num_targets)])
+        for _ in range(num_mshrs)
+    ]
+
+    tgt_rd = [
+        Reg(
+            [Bits(reg_addr_width) for _ in range(num_targets)],
+            reset_value=[0 for _ in range(num_targets)])
+        for _ in range(num_mshrs)
+    ]
+
+    tgt_rtype = [
+        Reg(
+            [Bits(access_rtype.bitwidth) for _ in range(num_targets)],
+            reset_value=[0 for _ in range(num_targets)])
+        for _ in range(num_mshrs)
+    ]
+
+    tgt_index = [
+        Reg(
+            [Bits(CC.line_index_width) for _ in range(num_targets)],
+            reset_value=[0 for _ in range(num_targets)])
+        for _ in range(num_mshrs)
+    ]
+
+    zero = Wire(Bits(1))
+    zero <<= 0
+
+    lookup_line = CC.LineAddr(io.lookup.addr)
+    lookup_set = CC.Set(io.lookup.addr)
+
+    def LineSet(line):
+        return line(CC.set_addr_width - 1, 0)
+
+    def LineBase(line):
+        return Cat([line, Fill(zero, CC.line_index_width)])
+
+    #
+    # Lookup
+    #
+
+    match = [
+        mshr_valid[i] & (mshr_line[i] == lookup_line)
+        for i in range(num_mshrs)
+    ]
+
+    set_match = [
+        mshr_valid[i] & (LineSet(mshr_line[i]) == lookup_set)
+        for i in range(num_mshrs)
+    ]
+
+    target_free = [Wire(Bits(1)) for _ in range(num_mshrs)]
+    target_used = [Wire(Bits(1)) for _ in range(num_mshrs)]
+
+    for i in range(num_mshrs):
+        target_free[i] <<= False
+        target_used[i] <<= False
+
+        for j in range(num_targets):
+            with ~tgt_valid[i][j]:
+                target_free[i] <<= True
+
+            with tgt_valid[i][j]:
+                target_used[i] <<= True
+
+    hit = Wire(Bits(1))
+    any_match = Wire(Bits(1))
+    any_set_match = Wire(Bits(1))
+    any_free = Wire(Bits(1))
+    can_merge = Wire(Bits(1))
+
+    hit <<= False
+    any_match <<= False
+    any_set_match <<= False
+    any_free <<= False
+    can_merge <<= False
+
+    io.hit_data <<= mshr_data[0]
+
+    for i in range(num_mshrs):
+        replaying = mshr_state[i] == mshr_states.replay
+
+        with match[i]:
+            any_match <<= True
+
+            with replaying & io.lookup.read:
+                hit <<= True
+                io.hit_data <<= mshr_data[i]
+
+            with ~replaying & io.lookup.read:
+                can_merge <<= target_free[i]
+
+            with ~replaying & ~io.lookup.read:
+                can_merge <<= ~target_used[i]
+
+        with set_match[i]:
+            any_set_match <<= True
+
+        with ~mshr_valid[i]:
+            any_free <<= True
+
+    io.hit <<= hit
+    io.tracked <<= any_match
+    io.set_busy <<= any_set_match
+
+    #
+    # A miss on a line an MSHR is tracking blocks if it can't be merged, and
+    # any other miss blocks if it can't get an MSHR of its own.
+    #
+
+    block = Wire(Bits(1))
+    block <<= ~any_free | any_set_match
+
+    with any_match:
+        block <<= ~can_merge
+
+    with hit:
+        block <<= False
+
+    io.block <<= block
+
+    #
+    # Allocate / Merge
+    #
+    # A primary miss takes the first free MSHR. A secondary miss adds a target
+    # to the MSHR of its line. Stores (and loads to x0) don't wait on anything,
+    # so they don't need a target. A store's bytes are merged into the bytes
+    # already stored to the line instead.
+    #
+
+    alloc_line = CC.LineAddr(io.alloc.addr)
+    alloc_target = io.alloc.read & (io.alloc.rd != 0)
+    alloc_store = ~io.alloc.read
+
+    merger.addr <<= io.alloc.addr
+    merger.rtype <<= io.alloc.rtype
+    merger.data <<= io.alloc.data
+    merger.line <<= mshr_store_data[0]
+
+    for i in range(num_mshrs):
+        with match[i]:
+            merger.line <<= mshr_store_data[i]
+
+    alloc_found = Wire(Bits(1))
+    alloc_found <<= False
+
+    for i in range(num_mshrs):
+        take = io.alloc.valid & ~any_match & ~mshr_valid[i] & ~alloc_found
+
+        with take:
+            mshr_valid[i] <<= True
+            mshr_line[i] <<= alloc_line
+            mshr_way[i] <<= io.alloc.way
+            mshr_evict_line[i] <<= io.alloc.evict_line
+            mshr_data[i] <<= io.alloc.evict_data
+
+            with io.alloc.evict:
+                mshr_state[i] <<= mshr_states.evict
+            with otherwise:
+                mshr_state[i] <<= mshr_states.read
+
+            tgt_valid[i][0] <<= alloc_target
+            tgt_rd[i][0] <<= io.alloc.rd
+            tgt_rtype[i][0] <<= io.alloc.rtype
+            tgt_index[i][0] <<= CC.Index(io.alloc.addr)
+
+            mshr_store_data[i] <<= merger.result
+
+            with alloc_store:
+                mshr_store_mask[i] <<= merger.mask
+            with otherwise:
+                mshr_store_mask[i] <<= 0
+
+        next_alloc_found = Wire(Bits(1))
+        next_alloc_found <<= alloc_found | ~mshr_valid[i]
+        alloc_found = next_alloc_found
+
+        with io.alloc.valid & match[i] & alloc_store:
+            mshr_store_mask[i] <<= mshr_store_mask[i] | merger.mask
+            mshr_store_data[i] <<= merger.result
+
+        merge = io.alloc.valid & match[i] & alloc_target
+
+        slot_found = Wire(Bits(1))
+        slot_found <<= False
+
+        for j in range(num_targets):
+            with merge & ~tgt_valid[i][j] & ~slot_found:
+                tgt_valid[i][j] <<= True
+                tgt_rd[i][j] <<= io.alloc.rd
+                tgt_rtype[i][j] <<= io.alloc.rtype
+                tgt_index[i][j] <<= CC.Index(io.alloc.addr)
+
+            next_slot_found = Wire(Bits(1))
+            next_slot_found <<= slot_found | ~tgt_valid[i][j]
+            slot_found = next_slot_found
+
+    #
+    # Pending Registers
+    #
+    # A register is pending while a load waiting on a line is going to write
+    # it. A load allocating (or merging) right now counts too, since the
+    # instruction in decode sees it before the MSHR registers do.
+    #
+
+    io.pending[0] <<= False
+
+    for r in range(1, C['reg-count']):
+        pending = Wire(Bits(1))
+        pending <<= alloc_target & io.alloc.valid & (io.alloc.rd == r)
+
+        for i in range(num_mshrs):
+            for j in range(num_targets):
+                with tgt_valid[i][j] & (tgt_rd[i][j] == r):
+                    pending <<= True
+
+        io.pending[r] <<= pending
+
+    #
+    # Memory Interface
+    #
+    # The write and read ports each serve the first MSHR that needs them. The
+    # read is for the word of the first target, so it arrives first.
+    #
+
+    io.write <<= {
+        'valid': False,
+        'addr': 0,
+        'data': 0
+    }
+
+    io.read <<= {
+        'valid': False,
+        'addr': 0
+    }
+
+    write_found = Wire(Bits(1))
+    read_found = Wire(Bits(1))
+
+    write_found <<= False
+    read_found <<= False
+
+    for i in range(num_mshrs):
+        writing = \
+            mshr_valid[i] & (mshr_state[i] == mshr_states.evict) & ~write_found
+
+        with writing:
+            io.write <<= {
+                'valid': True,
+                'addr': LineBase(mshr_evict_line[i]),
+                'data': mshr_data[i]
+            }
+
+            with io.write.ready:
+                mshr_state[i] <<= mshr_states.read
+
+        next_write_found = Wire(Bits(1))
+        next_write_found <<= write_found | writing
+        write_found = next_write_found
+
+        reading = \
+            mshr_valid[i] & (mshr_state[i] == mshr_states.read) & ~read_found
+
+        with reading:
+            io.read <<= {
+                'valid': True,
+                'addr': Cat([mshr_line[i], tgt_index[i][0]])
+            }
+
+            with io.read.ready:
+                mshr_state[i] <<= mshr_states.wait
+
+        next_read_found = Wire(Bits(1))
+        next_read_found <<= read_found | reading
+        read_found = next_read_found
+
+    #
+    # Refill
+    #
+    # Every refilled line belongs to an MSHR waiting on it. The line goes into
+    # the arrays right away (with the MSHR's stores merged in), and the MSHR
+    # starts replaying its targets.
+    #
+
+    refill_line = CC.LineAddr(io.refill.addr)
+
+    filled_data = [
+        MaskMerge(mshr_store_mask[i], mshr_store_data[i], io.refill.data)
+        for i in range(num_mshrs)
+    ]
+
+    io.update <<= {
+        'valid': False,
+        'set': CC.Set(io.refill.addr),
+        'way': mshr_way[0],
+        'tag': CC.Tag(io.refill.addr),
+        'dirty': False,
+        'data': io.refill.data
+    }
+
+    for i in range(num_mshrs):
+        filling = \
+            io.refill.valid & mshr_valid[i] & \
+            (mshr_state[i] == mshr_states.wait) & (mshr_line[i] == refill_line)
+
+        with filling:
+            io.update.valid <<= True
+            io.update.way <<= mshr_way[i]
+            io.update.dirty <<= mshr_store_mask[i] != 0
+            io.update.data <<= filled_data[i]
+
+            mshr_state[i] <<= mshr_states.replay
+            mshr_data[i] <<= filled_data[i]
+
+    #
+    # Replay
+    #
+    # Targets are written to the register file one per cycle (see
+    # reg_fill_bundle). An MSHR with no targets left is freed.
+    #
+
+    io.fill_write.valid <<= False
+    io.fill_write.rd <<= 0
+    io.fill_write.data <<= aligner.result
+
+    aligner.line <<= mshr_data[0]
+    aligner.addr <<= 0
+    aligner.rtype <<= 0
+
+    #
+    # N.B. A target whose word has just arrived (early restart) takes the
+    # port ahead of the replaying MSHRs.
+    #
+
+    early_found = Wire(Bits(1))
+    early_found <<= False
+
+    if CC.refill_beats > 1:
+        beat_line = CC.LineAddr(io.beat.addr)
+        beat_index = CC.Beat(io.beat.addr)
+
+        beat_data = [
+            MaskMerge(mshr_store_mask[i], mshr_store_data[i], io.beat.data)
+            for i in range(num_mshrs)
+        ]
+
+        for i in range(num_mshrs):
+            arriving = \
+                io.beat.valid & mshr_valid[i] & \
+                (mshr_state[i] == mshr_states.wait) & \
+                (mshr_line[i] == beat_line)
+
+            for j in range(num_targets):
+                early = \
+                    arriving & tgt_valid[i][j] & \
+                    (CC.Beat(tgt_index[i][j]) == beat_index) & ~early_found
+
+                with early:
+                    io.fill_write.valid <<= True
+                    io.fill_write.rd <<= tgt_rd[i][j]
+
+                    aligner.line <<= beat_data[i]
+                    aligner.addr <<= Cat([mshr_line[i], tgt_index[i][j]])
+                    aligner.rtype <<= tgt_rtype[i][j]
+
+                    with io.fill_write.ready:
+                        tgt_valid[i][j] <<= False
+
+                next_early_found = Wire(Bits(1))
+                next_early_found <<= early_found | early
+                early_found = next_early_found
+
+    replay_found = Wire(Bits(1))
+    replay_found <<= early_found
+
+    for i in range(num_mshrs):
+        replaying = mshr_valid[i] & (mshr_state[i] == mshr_states.replay)
+
+        has_target = Wire(Bits(1))
+        has_target <<= False
+
+        target_found = Wire(Bits(1))
+        target_found <<= False
+
+        for j in range(num_targets):
+            with tgt_valid[i][j]:
+                has_target <<= True
+
+            writing = \
+                replaying & tgt_valid[i][j] & ~target_found & ~replay_found
+
+            with writing:
+                io.fill_write.valid <<= True
+                io.fill_write.rd <<= tgt_rd[i][j]
+
+                aligner.line <<= mshr_data[i]
+                aligner.addr <<= Cat([mshr_line[i], tgt_index[i][j]])
+                aligner.rtype <<= tgt_rtype[i][j]
+
+                with io.fill_write.ready:
+                    tgt_valid[i][j] <<= False
+
+            next_target_found = Wire(Bits(1))
+            next_target_found <<= target_found | tgt_valid[i][j]
+            target_found = next_target_found
+
+        with replaying & ~has_target:
+            mshr_valid[i] <<= False
+
+        next_replay_found = Wire(Bits(1))
+        next_replay_found <<= replay_found | (replaying & has_target)
+        replay_found = next_replay_found
+
+    NameSignals(locals())
@@ -0,0 +1,168 @@
+from atlas import *
+from ..support import *
+
+pd_bits = pd_class.bitwidth
+
+def PredecodeHalf(half, next_half):
+    """Classify the instruction that would start at the given halfword.
+
+    next_half is the halfword that follows (it holds rs1 of a 32-bit JALR).
+    Since instruction boundaries aren't known when a line is refilled, every
+    halfword is classified; the frontend picks the ones that turn out to start
+    an instruction.
+    """
+
+    pd = Wire(Bits(pd_bits))
+
+    opcode = half(6, 0)
+    rd = half(11, 7)
+    rs1 = Cat([next_half(3, 0), half(15, 15)])
+
+    link_rd = (rd == 1) | (rd == 5)
+    link_rs1 = (rs1 == 1) | (rs1 == 5)
+
+    #
+    # Compressed control flow: C.J, C.BEQZ / C.BNEZ and C.JR / C.JALR. The
+    # register field of C.JR / C.JALR is rs1 and sits where rd usually does.
+    #
+
+    cquad = half(1, 0)
+    cfunct3 = half(15, 13)
+    cjr = (cquad == 0b10) & (cfunct3 == 0b100) & (half(6, 2) == 0) & (rd != 0)
+
+    pd <<= pd_class.none
+
+    with cquad == 0b11:
+        with opcode == Opcodes.BRANCH:
+            pd <<= pd_class.branch
+
+        with opcode == Opcodes.JAL:
+            with link_rd:
+                pd <<= pd_class.call
+            with otherwise:
+                pd <<= pd_class.jump
+
+        with opcode == Opcodes.JALR:
+            with link_rd:
+                pd <<= pd_class.call
+            with link_rs1 & ~link_rd:
+                pd <<= pd_class.ret
+            with ~link_rs1 & ~link_rd:
+                pd <<= pd_class.indirect
+
+    with (cquad == 0b01) & (cfunct3 == 0b101):
+        pd <<= pd_class.jump
+
+    with (cquad == 0b01) & (cfunct3(2, 1) == 0b11):
+        pd <<= pd_class.branch
+
+    cjalr = half(12, 12)
+
+    with cjr:
+        with cjalr:
+            pd <<= pd_class.call
+        with ~cjalr & link_rd:
+            pd <<= pd_class.ret
+        with ~cjalr & ~link_rd:
+            pd <<= pd_class.indirect
+
+    NameSignals(locals())
+    return pd
+
+def PredecodeWord(CC : CacheConfig, line_pd, addr):
+    """Select the predecode classes of the 32-bit word at addr in a line."""
+
+    words = Wire([
+        Bits(predecode_word_width)
+        for _ in range(CC.line_width // 32)
+    ])
+
+    for i in range(CC.line_width // 32):
+        words[i] <<= line_pd(
+            predecode_word_width * (i + 1) - 1,
+            predecode_word_width * i)
+
+    return words[addr(CC.line_index_width - 1, 2)]
+
+@Module
+def Predecoder(CC : CacheConfig):
+    """Predecoder for refilled icache lines.
+
+    Produces the predecode class (see pd_class) of every halfword in the line.
+    The last halfword of the line can only be partially decoded, since a
+    32-bit instruction starting there continues in the next line.
+    """
+
+    num_halves = CC.line_width // 16
+
+    io = Io({
+        'line': Input(Bits(CC.line_width)),
+        'predecode': Output(Bits(num_halves * pd_bits))
+    })
+
+    zero = Wire(Bits(16))
+    zero <<= 0
+
+    halves = [io.line(16 * i + 15, 16 * i) for i in range(num_halves)]
+
+    classes = [
+        PredecodeHalf(
+            halves[i],
+            halves[i + 1] if i + 1 < num_halves else zero)
+        for i in range(num_halves)
+    ]
+
+    io.predecode <<= Cat(list(reversed(classes)))
+
+    NameSignals(locals())
+
+@Module
+def CachePredecodeArray(CC : CacheConfig):
+    """Predecode array, kept in parallel with (and indexed like) the data
+    array.
+    """
+
+    pd_width = (CC.line_width // 16) * pd_bits
+
+    io = Io({
+        'read': Input({
+            'addr': Bits(C['paddr-width'])
+        }),
+        'stall': Input(Bits(1)),
+        'resp': Output([Bits(pd_width) for _ in range(CC.num_ways)]),
+        'update': Input({
+            'valid': Bits(1),
+            'set': Bits(CC.set_addr_width),
+            'way': Bits(CC.way_addr_width),
+            'data': Bits(pd_width)
+        })
+    })
+
+    pd_arrays = [
+        Mem(pd_width, CC.num_sets)
+        for _ in range(CC.num_ways)
+    ]
+
+    #
+    # Read Logic
+    #
+
+    read_data = [
+        pd_arrays[way].Read(CC.Set(io.read.addr), ~io.stall)
+        for way in range(CC.num_ways)
+    ]
+
+    for way in range(CC.num_ways):
+        io.resp[way] <<= read_data[way]
+
+    #
+    # Update Logic
+    #
+
+    for way in range(CC.num_ways):
+        pd_arrays[way].Write(
+            io.update.set,
+            io.update.data,
+            io.update.valid & (io.update.way == way))
+
+    NameSignals(locals())
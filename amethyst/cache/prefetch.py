@@ -0,0 +1,247 @@
+from atlas import *
+from ..support import *
+
+@Module
+def PrefetchBuffer(CC : CacheConfig):
+    """Prefetch buffer for next-N-line and branch target prefetching.
+
+    On every demand miss, the first N slots (N is the prefetch degree) are
+    retargeted to the N lines following the missed line. When target
+    prefetching is enabled, one more slot holds the line of the most recent
+    hint (a predicted branch target that missed in the cache). Lines the
+    buffer doesn't already hold are requested from memory whenever the cache
+    isn't using the read port, and land in the buffer rather than in the
+    cache. A later demand miss that finds its line in the buffer is filled
+    from it without going to memory.
+
+    Prefetched lines that are dropped without ever being used are reported as
+    useless, and demand misses served by the buffer (or by a prefetch that is
+    still in flight) are reported as useful.
+    """
+
+    degree = CC.prefetch_degree
+    num_slots = CC.prefetch_slots
+    target_slot = degree
+
+    io = Io({
+        'miss': Input({
+            'valid': Bits(1),
+            'addr': Bits(C['paddr-width'])
+        }),
+        'hint': Input(prefetch_hint_bundle),
+        'lookup': Output({
+            'valid': Bits(1),
+            'pending': Bits(1),
+            'data': Bits(CC.line_width)
+        }),
+        'read_enable': Input(Bits(1)),
+        'read': Output(mem_read_request),
+        'resp': Input({
+            'valid': Bits(1),
+            'addr': Bits(C['paddr-width']),
+            'data': Bits(CC.line_width)
+        }),
+        'useful': Output(Bits(1)),
+        'useless': Output(Bits(num_slots))
+    })
+
+    #
+    # Each slot tracks one line:
+    #
+    # valid:  the slot is in use (addr is meaningful)
+    # issued: the read for the line has been sent to memory
+    # ready:  the line's data has arrived
+    #
+
+    slot_valid = Reg(
+        [Bits(1) for _ in range(num_slots)],
+        reset_value=[0 for _ in range(num_slots)])
+
+    slot_issued = Reg(
+        [Bits(1) for _ in range(num_slots)],
+        reset_value=[0 for _ in range(num_slots)])
+
+    slot_ready = Reg(
+        [Bits(1) for _ in range(num_slots)],
+        reset_value=[0 for _ in range(num_slots)])
+
+    slot_addr = Reg(
+        [Bits(CC.line_addr_width) for _ in range(num_slots)],
+        reset_value=[0 for _ in range(num_slots)])
+
+    slot_data = Reg(
+        [Bits(CC.line_width) for _ in range(num_slots)],
+        reset_value=[0 for _ in range(num_slots)])
+
+    zero = Wire(Bits(1))
+    zero <<= 0
+
+    miss_line = CC.LineAddr(io.miss.addr)
+    hint_line = CC.LineAddr(io.hint.addr)
+    resp_line = CC.LineAddr(io.resp.addr)
+
+    #
+    # Lookup
+    #
+    # A slot whose read was never issued doesn't count as a hit: the demand
+    # miss will go to memory itself.
+    #
+
+    io.lookup.valid <<= False
+    io.lookup.pending <<= False
+    io.lookup.data <<= slot_data[0]
+
+    lookup_match = [
+        slot_valid[i] & slot_issued[i] & (slot_addr[i] == miss_line)
+        for i in range(num_slots)
+    ]
+
+    for i in range(num_slots):
+        with lookup_match[i]:
+            io.lookup.valid <<= slot_ready[i]
+            io.lookup.pending <<= ~slot_ready[i]
+            io.lookup.data <<= slot_data[i]
+
+    io.useful <<= io.miss.valid & (io.lookup.valid | io.lookup.pending)
+
+    next_valid = [Wire(Bits(1)) for _ in range(num_slots)]
+    next_issued = [Wire(Bits(1)) for _ in range(num_slots)]
+    next_ready = [Wire(Bits(1)) for _ in range(num_slots)]
+    next_addr = [Wire(Bits(CC.line_addr_width)) for _ in range(num_slots)]
+    next_data = [Wire(Bits(CC.line_width)) for _ in range(num_slots)]
+
+    for i in range(num_slots):
+        next_valid[i] <<= slot_valid[i]
+        next_issued[i] <<= slot_issued[i]
+        next_ready[i] <<= slot_ready[i]
+        next_addr[i] <<= slot_addr[i]
+        next_data[i] <<= slot_data[i]
+
+    dropped = [Wire(Bits(1)) for _ in range(num_slots)]
+
+    for j in range(num_slots):
+        dropped[j] <<= False
+
+    #
+    # Next-Line Retarget
+    #
+    # Slot i is pointed at line (miss + i + 1). If some slot already holds (or
+    # is fetching) that line, its state is carried over. Fetched lines that
+    # aren't carried over (and weren't the line that just missed) are dropped.
+    #
+
+    targets = [Wire(Bits(CC.line_addr_width)) for _ in range(degree)]
+    kept = [Wire(Bits(1)) for _ in range(degree)]
+
+    for i in range(degree):
+        targets[i] <<= miss_line + (i + 1)
+
+        with io.miss.valid:
+            next_valid[i] <<= True
+            next_issued[i] <<= False
+            next_ready[i] <<= False
+            next_addr[i] <<= targets[i]
+
+            for j in range(num_slots):
+                with slot_valid[j] & (slot_addr[j] == targets[i]):
+                    next_issued[i] <<= slot_issued[j]
+                    next_ready[i] <<= slot_ready[j]
+                    next_data[i] <<= slot_data[j]
+
+    for j in range(degree):
+        kept[j] <<= False
+
+        for i in range(degree):
+            with slot_valid[j] & (slot_addr[j] == targets[i]):
+                kept[j] <<= True
+
+        dropped[j] <<= io.miss.valid & slot_valid[j] & slot_issued[j] & \
+            ~kept[j] & ~lookup_match[j]
+
+    #
+    # Target Retarget
+    #
+    # A hint replaces the target slot, unless some slot already holds (or is
+    # fetching) the hinted line. The target slot is also freed once a demand
+    # miss has used its line, since that line is now in the cache.
+    #
+
+    if CC.target_prefetch:
+        hint_present = Wire(Bits(1))
+        hint_present <<= False
+
+        for j in range(num_slots):
+            with slot_valid[j] & (slot_addr[j] == hint_line):
+                hint_present <<= True
+
+        hint_take = Wire(Bits(1))
+        hint_take <<= io.hint.valid & ~hint_present
+
+        with io.miss.valid & lookup_match[target_slot]:
+            next_valid[target_slot] <<= False
+
+        with hint_take:
+            next_valid[target_slot] <<= True
+            next_issued[target_slot] <<= False
+            next_ready[target_slot] <<= False
+            next_addr[target_slot] <<= hint_line
+
+        dropped[target_slot] <<= \
+            hint_take & slot_valid[target_slot] & slot_issued[target_slot] & \
+            ~(io.miss.valid & lookup_match[target_slot])
+
+    io.useless <<= Cat(list(reversed(dropped)))
+
+    #
+    # Issue
+    #
+    # The first slot that still needs its line is sent to memory whenever the
+    # cache isn't using the read port. The target slot goes first, since its
+    # line is about to be fetched.
+    #
+
+    issue_order = list(range(num_slots))
+
+    if CC.target_prefetch:
+        issue_order = [target_slot] + list(range(degree))
+
+    issue = [Wire(Bits(1)) for _ in range(num_slots)]
+    issue_found = Wire(Bits(1))
+    issue_found <<= False
+
+    io.read.valid <<= False
+    io.read.addr <<= 0
+
+    for i in issue_order:
+        issue[i] <<= \
+            io.read_enable & next_valid[i] & ~next_issued[i] & ~issue_found
+
+        with issue[i]:
+            io.read.valid <<= True
+            io.read.addr <<= Cat([next_addr[i], Fill(zero, CC.line_index_width)])
+
+        next_issue_found = Wire(Bits(1))
+        next_issue_found <<= issue_found | (next_valid[i] & ~next_issued[i])
+        issue_found = next_issue_found
+
+    #
+    # Fill
+    #
+
+    for i in range(num_slots):
+        slot_valid[i] <<= next_valid[i]
+        slot_issued[i] <<= next_issued[i]
+        slot_ready[i] <<= next_ready[i]
+        slot_addr[i] <<= next_addr[i]
+        slot_data[i] <<= next_data[i]
+
+        with issue[i] & io.read.ready:
+            slot_issued[i] <<= True
+
+        with io.resp.valid & next_valid[i] & next_issued[i] & \
+            (next_addr[i] == resp_line):
+
+            slot_ready[i] <<= True
+            slot_data[i] <<= io.resp.data
+
+    NameSignals(locals())
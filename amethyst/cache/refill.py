@@ -0,0 +1,81 @@
+from atlas import *
+from ..support import *
+
+@Module
+def LineAssembler(CC : CacheConfig):
+    """Assembles lines refilled from memory over a bus narrower than a line.
+
+    A line arrives as CC.refill_beats beats, one per response (see
+    mem_read_response). The beats of one line are never interleaved with those
+    of another, so the assembler only has to count them.
+
+    Every beat is passed on as it arrives, placed at its offset in the line, so
+    the cache can align the word it is waiting for as soon as the beat holding
+    it arrives (early restart). The rest of that line comes from earlier beats
+    (or older lines) and is meaningless. The whole line is passed on along with
+    its last beat.
+    """
+
+    num_beats = CC.refill_beats
+
+    io = Io({
+        'resp': Input({
+            'valid': Bits(1),
+            'addr': Bits(C['paddr-width']),
+            'data': Bits(mem_bus_width)
+        }),
+        'beat': Output({
+            'valid': Bits(1),
+            'addr': Bits(C['paddr-width']),
+            'data': Bits(CC.line_width)
+        }),
+        'line': Output({
+            'valid': Bits(1),
+            'addr': Bits(C['paddr-width']),
+            'data': Bits(CC.line_width)
+        })
+    })
+
+    slots = Reg(
+        [Bits(mem_bus_width) for _ in range(num_beats)],
+        reset_value=[0 for _ in range(num_beats)])
+
+    #
+    # N.B. The number of beats is a power of 2, so count wraps back to 0 with
+    # the last beat of each line.
+    #
+
+    count = Reg(Bits(Log2Ceil(num_beats)), reset_value=0)
+
+    beat_index = CC.Beat(io.resp.addr)
+
+    merged = Wire([Bits(mem_bus_width) for _ in range(num_beats)])
+
+    for k in range(num_beats):
+        merged[k] <<= slots[k]
+
+        with beat_index == k:
+            merged[k] <<= io.resp.data
+
+    line_data = Wire(Bits(CC.line_width))
+    line_data <<= Cat([merged[k] for k in reversed(range(num_beats))])
+
+    with io.resp.valid:
+        count <<= count + 1
+
+        for k in range(num_beats):
+            slots[k] <<= merged[k]
+
+    io.beat <<= {
+        'valid': io.resp.valid,
+        'addr': io.resp.addr,
+        'data': line_data
+    }
+
+    io.line <<= {
+        'valid': io.resp.valid & (count == num_beats - 1),
+        'addr': io.resp.addr,
+        'data': line_data
+    }
+
+    NameSignals(locals())
@@ -0,0 +1,173 @@
+from atlas import *
+from ..support import *
+
+from .merge import ByteEnables, StoreLanes
+
+@Module
+def StoreBuffer(CC : CacheConfig):
+    """Store buffer between the pipeline and the dcache.
+
+    Stores don't wait for the cache: they are put in the buffer, in order, and
+    written into the cache from there (drained) whenever the pipeline isn't
+    using the cache's port for a load. The pipeline only has to wait for a
+    store when the buffer is full.
+
+    Loads are looked up in the buffer on their way into the cache. A load
+    whose bytes were all written by buffered stores is forwarded them (the
+    youngest store to each byte wins) instead of reading the cache. A load
+    whose bytes are only partly in the buffer has to wait (forward.wait) until
+    the stores to them have drained.
+
+    Entry 0 is the oldest store, and the rest move down when it drains, so
+    the entries in use are always the first few.
+    """
+
+    num_entries = CC.sb_entries
+    word_bytes = C['core-width'] // 8
+    word_index_width = Log2Ceil(word_bytes)
+
+    io = Io({
+        'store': Input({
+            'valid': Bits(1),
+            'addr': Bits(C['paddr-width']),
+            'rtype': Bits(access_rtype.bitwidth),
+            'data': Bits(C['core-width'])
+        }),
+        'full': Output(Bits(1)),
+        'drain': Output({
+            'valid': Bits(1),
+            'ready': Flip(Bits(1)),
+            'addr': Bits(C['paddr-width']),
+            'rtype': Bits(access_rtype.bitwidth),
+            'data': Bits(C['core-width'])
+        }),
+        'lookup': Input({
+            'addr': Bits(C['paddr-width']),
+            'rtype': Bits(access_rtype.bitwidth)
+        }),
+        'forward': Output({
+            'hit': Bits(1),
+            'wait': Bits(1),
+            'data': Bits(C['core-width'])
+        })
+    })
+
+    entry_valid = Reg(
+        [Bits(1) for _ in range(num_entries)],
+        reset_value=[0 for _ in range(num_entries)])
+
+    entry_addr = Reg(
+        [Bits(C['paddr-width']) for _ in range(num_entries)],
+        reset_value=[0 for _ in range(num_entries)])
+
+    entry_rtype = Reg(
+        [Bits(access_rtype.bitwidth) for _ in range(num_entries)],
+        reset_value=[0 for _ in range(num_entries)])
+
+    entry_data = Reg(
+        [Bits(C['core-width']) for _ in range(num_entries)],
+        reset_value=[0 for _ in range(num_entries)])
+
+    def Word(addr):
+        return addr(C['paddr-width'] - 1, word_index_width)
+
+    def WordIndex(addr):
+        return addr(word_index_width - 1, 0)
+
+    io.full <<= entry_valid[num_entries - 1]
+
+    #
+    # Drain
+    #
+
+    io.drain.valid <<= entry_valid[0]
+    io.drain.addr <<= entry_addr[0]
+    io.drain.rtype <<= entry_rtype[0]
+    io.drain.data <<= entry_data[0]
+
+    drain = Wire(Bits(1))
+    drain <<= entry_valid[0] & io.drain.ready
+
+    #
+    # shifted_valid: which entries are in use once the drain (if any) is done.
+    # A new store goes into the first entry that isn't.
+    #
+
+    shifted_valid = Wire([Bits(1) for _ in range(num_entries)])
+
+    for i in range(num_entries):
+        shifted_valid[i] <<= entry_valid[i]
+
+        with drain:
+            if i + 1 < num_entries:
+                shifted_valid[i] <<= entry_valid[i + 1]
+            else:
+                shifted_valid[i] <<= False
+
+    for i in range(num_entries):
+        entry_valid[i] <<= shifted_valid[i]
+
+        if i + 1 < num_entries:
+            with drain:
+                entry_addr[i] <<= entry_addr[i + 1]
+                entry_rtype[i] <<= entry_rtype[i + 1]
+                entry_data[i] <<= entry_data[i + 1]
+
+        if i == 0:
+            at_tail = ~shifted_valid[i]
+        else:
+            at_tail = ~shifted_valid[i] & shifted_valid[i - 1]
+
+        with io.store.valid & at_tail:
+            entry_valid[i] <<= True
+            entry_addr[i] <<= io.store.addr
+            entry_rtype[i] <<= io.store.rtype
+            entry_data[i] <<= io.store.data
+
+    #
+    # Forwarding
+    #
+    # The bytes of the looked up word written by buffered stores are gathered
+    # oldest first, so younger stores overwrite older ones.
+    #
+
+    load_mask = ByteEnables(
+        WordIndex(io.lookup.addr), io.lookup.rtype, word_bytes)
+
+    entry_mask = [
+        ByteEnables(WordIndex(entry_addr[i]), entry_rtype[i], word_bytes)
+        for i in range(num_entries)
+    ]
+
+    entry_lanes = [
+        StoreLanes(entry_rtype[i], entry_data[i], word_bytes)
+        for i in range(num_entries)
+    ]
+
+    fwd_valid = Wire([Bits(1) for _ in range(word_bytes)])
+    fwd_bytes = Wire([Bits(8) for _ in range(word_bytes)])
+
+    for b in range(word_bytes):
+        fwd_valid[b] <<= False
+        fwd_bytes[b] <<= 0
+
+    for i in range(num_entries):
+        live = entry_valid[i] & (Word(entry_addr[i]) == Word(io.lookup.addr))
+
+        for b in range(word_bytes):
+            with live & entry_mask[i](b, b):
+                fwd_valid[b] <<= True
+                fwd_bytes[b] <<= entry_lanes[i](8 * b + 7, 8 * b)
+
+    fwd_mask = Wire(Bits(word_bytes))
+    fwd_mask <<= Cat([fwd_valid[b] for b in reversed(range(word_bytes))])
+
+    covered = Wire(Bits(word_bytes))
+    covered <<= load_mask & fwd_mask
+
+    io.forward.hit <<= (covered != 0) & (covered == load_mask)
+    io.forward.wait <<= (covered != 0) & (covered != load_mask)
+    io.forward.data <<= \
+        Cat([fwd_bytes[b] for b in reversed(range(word_bytes))])
+
+    NameSignals(locals())
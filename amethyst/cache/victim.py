@@ -0,0 +1,125 @@
+from atlas import *
+from ..support import *
+
+@Module
+def VictimCache(CC : CacheConfig):
+    """A small fully associative cache of lines evicted from the dcache.
+
+    Lines replaced in the dcache's arrays are put here rather than dropped, so
+    a line lost to a conflict can be brought back without going to memory. A
+    line keeps its dirty bit while it is here: it is only written back once the
+    victim cache drops it to make room for another (see drop).
+
+    The victim cache is looked up with the tag check. On a hit, the line
+    swaps places with the line being replaced in the arrays, which takes the
+    entry it leaves (write.swap). Lines evicted by misses go into the first
+    free entry, or else replace the entries in turn (write.swap is low).
+    """
+
+    num_entries = CC.victim_entries
+
+    io = Io({
+        'lookup': Input({
+            'addr': Bits(C['paddr-width'])
+        }),
+        'hit': Output(Bits(1)),
+        'hit_dirty': Output(Bits(1)),
+        'hit_data': Output(Bits(CC.line_width)),
+        'drop': Output({
+            'dirty': Bits(1),
+            'addr': Bits(C['paddr-width']),
+            'data': Bits(CC.line_width)
+        }),
+        'write': Input({
+            'valid': Bits(1),
+            'swap': Bits(1),
+            'line_valid': Bits(1),
+            'dirty': Bits(1),
+            'addr': Bits(C['paddr-width']),
+            'data': Bits(CC.line_width)
+        })
+    })
+
+    entry_valid = Reg(
+        [Bits(1) for _ in range(num_entries)],
+        reset_value=[0 for _ in range(num_entries)])
+
+    entry_dirty = Reg(
+        [Bits(1) for _ in range(num_entries)],
+        reset_value=[0 for _ in range(num_entries)])
+
+    entry_line = Reg(
+        [Bits(CC.line_addr_width) for _ in range(num_entries)],
+        reset_value=[0 for _ in range(num_entries)])
+
+    entry_data = Reg(
+        [Bits(CC.line_width) for _ in range(num_entries)],
+        reset_value=[0 for _ in range(num_entries)])
+
+    zero = Wire(Bits(1))
+    zero <<= 0
+
+    def LineBase(line):
+        return Cat([line, Fill(zero, CC.line_index_width)])
+
+    #
+    # Lookup
+    #
+
+    lookup_line = CC.LineAddr(io.lookup.addr)
+
+    hit = Wire(Bits(1))
+    hit_index = Wire(Bits(Log2Ceil(num_entries)))
+
+    hit <<= False
+    hit_index <<= 0
+
+    io.hit_dirty <<= entry_dirty[0]
+    io.hit_data <<= entry_data[0]
+
+    for i in range(num_entries):
+        with entry_valid[i] & (entry_line[i] == lookup_line):
+            hit <<= True
+            hit_index <<= i
+            io.hit_dirty <<= entry_dirty[i]
+            io.hit_data <<= entry_data[i]
+
+    io.hit <<= hit
+
+    #
+    # Insert
+    #
+    # slot is the entry the next evicted line goes into, and drop is the line
+    # it holds (which has to be written back if it is dirty).
+    #
+
+    next_slot = Reg(Bits(Log2Ceil(num_entries)), reset_value=0)
+
+    slot = Wire(Bits(Log2Ceil(num_entries)))
+    slot <<= next_slot
+
+    for i in reversed(range(num_entries)):
+        with ~entry_valid[i]:
+            slot <<= i
+
+    io.drop.dirty <<= entry_valid[slot] & entry_dirty[slot]
+    io.drop.addr <<= LineBase(entry_line[slot])
+    io.drop.data <<= entry_data[slot]
+
+    write_index = Wire(Bits(Log2Ceil(num_entries)))
+    write_index <<= slot
+
+    with io.write.swap:
+        write_index <<= hit_index
+
+    with io.write.valid & ~io.write.swap:
+        next_slot <<= slot + 1
+
+    for i in range(num_entries):
+        with io.write.valid & (write_index == i):
+            entry_valid[i] <<= io.write.line_valid
+            entry_dirty[i] <<= io.write.dirty
+            entry_line[i] <<= CC.LineAddr(io.write.addr)
+            entry_data[i] <<= io.write.data
+
+    NameSignals(locals())
@@ -0,0 +1,235 @@
+from atlas import *
+from ..support import *
+
+@Module
+def WriteBackBuffer(CC : CacheConfig):
+    """Write-back buffer for lines evicted from the dcache.
+
+    The buffer sits between the cache and memory. Evicted lines written by the
+    cache are parked in the buffer (which takes them right away when it has a
+    free entry) and drained to memory in the background, whenever the cache
+    isn't sending a read. This way a miss that evicts a line only waits for
+    its refill read, not for the write as well.
+
+    Reads for a line the buffer still holds are answered by the buffer instead
+    of memory, so the line is reclaimed without a memory access (and without
+    reading stale data from memory). A line written again while it is still in
+    the buffer replaces the old copy, so the buffer never holds a line twice.
+    """
+
+    num_entries = CC.wb_entries
+
+    io = Io({
+        'cache': Input(mem_bundle),
+        'mem': Output(mem_bundle),
+        'reclaim': Output(Bits(1))
+    })
+
+    entry_valid = Reg(
+        [Bits(1) for _ in range(num_entries)],
+        reset_value=[0 for _ in range(num_entries)])
+
+    entry_line = Reg(
+        [Bits(CC.line_addr_width) for _ in range(num_entries)],
+        reset_value=[0 for _ in range(num_entries)])
+
+    entry_data = Reg(
+        [Bits(CC.line_width) for _ in range(num_entries)],
+        reset_value=[0 for _ in range(num_entries)])
+
+    zero = Wire(Bits(1))
+    zero <<= 0
+
+    def LineBase(line):
+        return Cat([line, Fill(zero, CC.line_index_width)])
+
+    write_line = CC.LineAddr(io.cache.write.addr)
+    read_line = CC.LineAddr(io.cache.read.addr)
+
+    #
+    # Reclaim
+    #
+    # A read that hits in the buffer is answered from the reclaim register
+    # rather than memory. The entry stays in the buffer until it drains.
+    #
+
+    rc_valid = Reg(Bits(1), reset_value=False)
+    rc_addr = Reg(Bits(C['paddr-width']), reset_value=0)
+    rc_data = Reg(Bits(CC.line_width), reset_value=0)
+
+    read_hit = Wire(Bits(1))
+    read_hit <<= False
+
+    hit_data = Wire(Bits(CC.line_width))
+    hit_data <<= entry_data[0]
+
+    for i in range(num_entries):
+        with entry_valid[i] & (entry_line[i] == read_line):
+            read_hit <<= True
+            hit_data <<= entry_data[i]
+
+    reclaim = Wire(Bits(1))
+    reclaim <<= io.cache.read.valid & read_hit & ~rc_valid
+
+    io.reclaim <<= reclaim
+
+    #
+    # Reads that miss in the buffer go to memory. Responses from memory are
+    # passed straight through, and a reclaimed line is sent while memory isn't
+    # responding. Like a line from memory, it is sent a beat at a time (see
+    # mem_read_response), starting with the beat holding the requested
+    # address.
+    #
+
+    mem_read = Wire(Bits(1))
+    mem_read <<= io.cache.read.valid & ~read_hit
+
+    io.mem.read.valid <<= mem_read
+    io.mem.read.addr <<= io.cache.read.addr
+
+    with read_hit:
+        io.cache.read.ready <<= ~rc_valid
+    with otherwise:
+        io.cache.read.ready <<= io.mem.read.ready
+
+    rc_send = Wire(Bits(1))
+    rc_last = Wire(Bits(1))
+    rc_beat = Wire(Bits(mem_bus_width))
+
+    if CC.refill_beats > 1:
+        beat_bits = CC.line_index_width - CC.beat_index_width
+
+        #
+        # rc_sent:  beats of the reclaimed line sent so far
+        # mem_sent: beats of the current line from memory passed on so far
+        #
+        # N.B. The beats of two lines must never be mixed (see
+        # cache/refill.py). Once started, the reclaimed line holds off memory
+        # until its last beat is sent, and it isn't started in the middle of a
+        # line from memory.
+        #
+
+        rc_sent = Reg(Bits(beat_bits), reset_value=0)
+        mem_sent = Reg(Bits(beat_bits), reset_value=0)
+
+        rc_beats = Wire([Bits(mem_bus_width) for _ in range(CC.refill_beats)])
+
+        for k in range(CC.refill_beats):
+            rc_beats[k] <<= \
+                rc_data(mem_bus_width * (k + 1) - 1, mem_bus_width * k)
+
+        rc_beat <<= rc_beats[CC.Beat(rc_addr)]
+        rc_last <<= rc_sent == CC.refill_beats - 1
+
+        rc_send <<= rc_valid & (
+            (rc_sent != 0) | (~io.mem.resp.valid & (mem_sent == 0)))
+
+        rc_next_beat = Wire(Bits(beat_bits))
+        rc_next_beat <<= CC.Beat(rc_addr) + 1
+
+        with io.mem.resp.valid & ~rc_send & io.cache.resp.ready:
+            mem_sent <<= mem_sent + 1
+
+        with rc_send & io.cache.resp.ready:
+            rc_sent <<= rc_sent + 1
+            rc_addr <<= Cat([
+                CC.LineAddr(rc_addr),
+                rc_next_beat,
+                Fill(zero, CC.beat_index_width)
+            ])
+
+    else:
+        rc_beat <<= rc_data
+        rc_last <<= True
+        rc_send <<= rc_valid & ~io.mem.resp.valid
+
+    io.mem.resp.ready <<= ~rc_send & io.cache.resp.ready
+
+    with rc_send:
+        io.cache.resp.valid <<= True
+        io.cache.resp.addr <<= rc_addr
+        io.cache.resp.data <<= rc_beat
+
+        with io.cache.resp.ready & rc_last:
+            rc_valid <<= False
+
+    with otherwise:
+        io.cache.resp.valid <<= io.mem.resp.valid
+        io.cache.resp.addr <<= io.mem.resp.addr
+        io.cache.resp.data <<= io.mem.resp.data
+
+    with reclaim:
+        rc_valid <<= True
+        rc_addr <<= io.cache.read.addr
+        rc_data <<= hit_data
+
+    #
+    # Drain
+    #
+    # The first entry in use is written to memory whenever the cache isn't
+    # reading from it.
+    #
+
+    io.mem.write <<= {
+        'valid': False,
+        'addr': 0,
+        'data': 0
+    }
+
+    drain_found = Wire(Bits(1))
+    drain_found <<= mem_read
+
+    for i in range(num_entries):
+        draining = entry_valid[i] & ~drain_found
+
+        with draining:
+            io.mem.write <<= {
+                'valid': True,
+                'addr': LineBase(entry_line[i]),
+                'data': entry_data[i]
+            }
+
+            with io.mem.write.ready:
+                entry_valid[i] <<= False
+
+        next_drain_found = Wire(Bits(1))
+        next_drain_found <<= drain_found | entry_valid[i]
+        drain_found = next_drain_found
+
+    #
+    # Evict
+    #
+    # An evicted line replaces the buffer's copy of the same line if it has
+    # one, or else takes the first free entry. The cache has to wait when
+    # neither exists.
+    #
+    # N.B. This comes after the drain logic so an entry that drains in the
+    # same cycle it is written again stays valid (with the new data).
+    #
+
+    write_match = Wire(Bits(1))
+    write_match <<= False
+
+    for i in range(num_entries):
+        with entry_valid[i] & (entry_line[i] == write_line):
+            write_match <<= True
+
+    free_found = Wire(Bits(1))
+    free_found <<= False
+
+    for i in range(num_entries):
+        same_line = entry_valid[i] & (entry_line[i] == write_line)
+        take = ~write_match & ~entry_valid[i] & ~free_found
+
+        with io.cache.write.valid & (same_line | take):
+            entry_valid[i] <<= True
+            entry_line[i] <<= write_line
+            entry_data[i] <<= io.cache.write.data
+
+        next_free_found = Wire(Bits(1))
+        next_free_found <<= free_found | ~entry_valid[i]
+        free_found = next_free_found
+
+    io.cache.write.ready <<= write_match | free_found
+
+    NameSignals(locals())
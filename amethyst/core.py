@@ -3,8 +3,10 @@ from dataclasses import dataclass
 from atlas import *
 from .support import *
 
-from .frontend.ifetch import IFetchStage
+from .frontend.frontend import Frontend
+from .cache.arbiter import MemArbiter
 from .cache.cache import Cache, CacheConfig
+from .cache.l2 import L2Cache
 from .backend.decode import DecodeStage
 from .backend.execute import ExecuteStage
 from .backend.mem import MemStage
@@ -36,29 +38,65 @@ def PipelineUpdate(pipe_reg, next_value, flush_signal, reset_value, stall_signal
 
 @Module
 def Amethyst():
+    if has_l2:
+        mem_ports = {
+            'mem': Output(mem_bundle)
+        }
+
+    else:
+        mem_ports = {
+            'imem': Output(mem_bundle),
+            'dmem': Output(mem_bundle)
+        }
+
     io = Io({
-        'imem': Output(mem_bundle),
-        'dmem': Output(mem_bundle),
+        **mem_ports,
         'debug': Output(debug_bundle)
     })
 
-    pc = Reg(Bits(C['paddr-width']), reset_value=C['reset-addr'])
-
     #
     # Instruction and Data Caches
     #
 
-    icache = Instance(Cache(CacheConfig.FromCacheType('icache')))
-    io.imem <<= icache.mem
+    icache_config = CacheConfig.FromCacheType('icache')
+    dcache_config = CacheConfig.FromCacheType('dcache')
 
-    dcache = Instance(Cache(CacheConfig.FromCacheType('dcache')))
-    io.dmem <<= dcache.mem
+    icache = Instance(Cache(icache_config))
+    dcache = Instance(Cache(dcache_config))
+
+    #
+    # L2 Cache
+    #
+    # When enabled, the misses (and evictions) of both L1s go through the
+    # arbiter (see cache/arbiter.py) to the L2 (see cache/l2.py), which has the
+    # only memory port. Otherwise, each L1 has a memory port of its own.
+    #
+
+    if has_l2:
+        l2_config = CacheConfig.FromCacheType('l2')
+
+        assert l2_config.line_width == C['mem-width'] and \
+            icache_config.line_width == C['mem-width'] and \
+            dcache_config.line_width == C['mem-width'], \
+            f'the L1s and L2 need lines of {C["mem-width"]} bits (mem-width)'
+
+        arbiter = Instance(MemArbiter(l2_config))
+        arbiter.icache <<= icache.mem
+        arbiter.dcache <<= dcache.mem
+
+        l2 = Instance(L2Cache(l2_config))
+        l2.l1 <<= arbiter.mem
+        io.mem <<= l2.mem
+
+    else:
+        io.imem <<= icache.mem
+        io.dmem <<= dcache.mem
 
     #
     # Pipeline Stages
     #
 
-    ifetch_stage = Instance(IFetchStage())
+    frontend = Instance(Frontend())
     idecode_stage = Instance(DecodeStage())
     execute_stage = Instance(ExecuteStage())
     mem_stage = Instance(MemStage())
@@ -68,28 +106,30 @@ def Amethyst():
     # Pipeline Registers
     #
 
-    if1_if2_reg = Reg(if_bundle, reset_value=if_bundle_reset)
-    if2_if3_reg = Reg(if_bundle, reset_value=if_bundle_reset)
-    if_id_reg = Reg(if_bundle, reset_value=if_bundle_reset)
     id_ex_reg = Reg(id_ex_bundle, reset_value=id_ex_bundle_reset)
     ex_mem_reg = Reg(ex_mem_bundle, reset_value=ex_mem_bundle_reset)
     mem_wb_reg = Reg(mem_wb_bundle, reset_value=mem_wb_bundle_reset)
 
+    reg_write = Wire(reg_write_bundle)
+
     #
     # Probes
     #
 
-    Probe(pc, 'if1_pc')
+    Probe(frontend.trace.if1_pc, 'if1_pc')
 
-    Probe(if1_if2_reg.valid, 'if2_valid')
-    Probe(if1_if2_reg.pc, 'if2_pc')
+    Probe(frontend.trace.if2.valid, 'if2_valid')
+    Probe(frontend.trace.if2.pc, 'if2_pc')
 
-    Probe(if2_if3_reg.valid, 'if3_valid')
-    Probe(if2_if3_reg.pc, 'if3_pc')
+    Probe(frontend.trace.if3.valid, 'if3_valid')
+    Probe(frontend.trace.if3.pc, 'if3_pc')
 
-    Probe(if_id_reg.valid, 'id_valid')
-    Probe(if_id_reg.pc, 'id_pc')
-    Probe(icache.cpu_resp.data(31, 0), 'id_inst')
+    Probe(frontend.trace.fq_count, 'fq_count')
+    Probe(frontend.trace.lb_supply, 'loop_buffer_supply')
+
+    Probe(frontend.if_id.valid, 'id_valid')
+    Probe(frontend.if_id.pc, 'id_pc')
+    Probe(frontend.inst, 'id_inst')
 
     Probe(id_ex_reg.ctrl.valid, 'ex_valid')
     Probe(id_ex_reg.ctrl.pc, 'ex_pc')
@@ -107,6 +147,20 @@ def Amethyst():
 
     Probe(icache.miss_stall, 'icache_stall')
     Probe(dcache.miss_stall, 'dcache_stall')
+    Probe(dcache.miss, 'dcache_miss')
+    Probe(dcache.wb_reclaim, 'dcache_wb_reclaim')
+    Probe(dcache.req_stall, 'dcache_req_stall')
+    Probe(dcache.store_forward, 'dcache_store_forward')
+    Probe(dcache.victim_hit, 'dcache_victim_hit')
+    Probe(dcache.victim_miss, 'dcache_victim_miss')
+    Probe(icache.array_access, 'icache_access')
+    Probe(icache.miss, 'icache_miss')
+    Probe(icache.prefetch_useful, 'icache_prefetch_useful')
+    Probe(icache.prefetch_useless, 'icache_prefetch_useless')
+
+    if has_l2:
+        Probe(l2.hit, 'l2_hit')
+        Probe(l2.miss, 'l2_miss')
 
     #
     # Forward, Hazard, and Branch Units
@@ -127,116 +181,168 @@ def Amethyst():
     hzd.ex_rd <<= Rd(id_ex_reg.ctrl.inst)
     hzd.id_rs1 <<= Rs1(idecode_stage.id_ex.ctrl.inst)
     hzd.id_rs2 <<= Rs2(idecode_stage.id_ex.ctrl.inst)
+    hzd.id_rd <<= Rd(idecode_stage.id_ex.ctrl.inst)
+    hzd.id_reg_write <<= idecode_stage.id_ex.ctrl.wb.write_reg
+    hzd.pending <<= dcache.pending_regs
     Probe(hzd.data_hazard, 'data_hazard')
 
+    #
+    # N.B. A misprediction is held while the frontend is stalled, so it is only
+    # counted in the cycle the redirect actually happens.
+    #
+
+    #
+    # Execute (and everything before it) also stalls when the dcache can't
+    # take its request (see the store buffer in cache/cache.py). Mem and
+    # writeback carry on in that case.
+    #
+
+    ex_stall = dcache.miss_stall | dcache.req_stall
+
     bru = Instance(BranchUnit())
-    bru.ex_pc <<= id_ex_reg.ctrl.pc
-    bru.mem_pc <<= ex_mem_reg.ctrl.pc
-    bru.branch <<= mem_stage.branch
+    bru.branch <<= execute_stage.branch
+    bru.stall <<= ex_stall
+    bru.frontend_stall <<= icache.miss_stall
+
+    redirect = bru.mispred.valid & ~icache.miss_stall
 
+    Probe(bru.resolve.valid, 'branch_resolve')
+    Probe(redirect, 'mispred')
+    Probe(redirect & bru.mispred.is_return, 'return_mispred')
+    Probe(bru.resolve.valid & bru.resolve.indirect, 'indirect_resolve')
+    Probe(redirect & bru.mispred.is_indirect, 'indirect_mispred')
+
+    #
+    # IF1 - IF3: Frontend
     #
-    # IF1: IFetch 1
+    # The frontend only stalls on its own (icache misses, or the fetch queue
+    # filling up). Decode is stalled by dcache misses and data hazards.
     #
 
-    ifetch_stage.pc <<= pc
-    ifetch_stage.mispred <<= bru.mispred
+    backend_stall = ex_stall | hzd.data_hazard
 
-    PipelineUpdate(
-        pipe_reg=if1_if2_reg,
-        next_value=ifetch_stage.if1_if2,
-        flush_signal=bru.mispred.valid,
-        reset_value=if_bundle_reset,
-        stall_signal=dcache.miss_stall | icache.miss_stall | hzd.data_hazard)
+    frontend.mispred <<= bru.mispred
+    frontend.resolve <<= bru.resolve
+    frontend.backend_stall <<= backend_stall
 
-    PipelineUpdate(
-        pipe_reg=pc,
-        next_value=ifetch_stage.next_pc,
-        flush_signal=None,
-        reset_value=None,
-        stall_signal=dcache.miss_stall | icache.miss_stall | hzd.data_hazard)
+    icache.cpu_req <<= frontend.icache.cpu_req
+    icache.cpu_stall <<= frontend.icache.cpu_stall
+    icache.prefetch_hint <<= frontend.icache.prefetch_hint
+    frontend.icache.miss_stall <<= icache.miss_stall
+    frontend.icache.cpu_resp <<= icache.cpu_resp
+    frontend.icache.predecode <<= icache.predecode
 
     #
-    # IF2: IFetch 2
+    # B1: Decode Stage
     #
 
-    icache.cpu_stall <<= dcache.miss_stall | hzd.data_hazard
+    idecode_stage.if_id <<= frontend.if_id
+    idecode_stage.inst <<= frontend.inst
+    idecode_stage.next <<= frontend.next
+    idecode_stage.reg_write <<= reg_write
+    idecode_stage.stall <<= ex_stall
+    idecode_stage.ras_checkpoint <<= frontend.ras_checkpoint
 
-    icache.cpu_req <<= {
-        'valid': if1_if2_reg.valid,
-        'addr': if1_if2_reg.pc,
-        'rtype': access_rtype.w,
-        'read': True
-    }
+    #
+    # The RAS is only updated once per decoded instruction: not while decode
+    # is stalled (and will see the same instruction again) and not when it is
+    # being flushed.
+    #
 
-    next_if2_if3 = {
-        'valid': if1_if2_reg.valid & ~icache.miss_stall,
-        'pc': if1_if2_reg.pc
-    }
+    ras_ctrl_en = ~backend_stall & ~bru.mispred.valid
 
-    PipelineUpdate(
-        pipe_reg=if2_if3_reg,
-        next_value=next_if2_if3,
-        flush_signal=bru.mispred.valid,
-        reset_value=if_bundle_reset,
-        stall_signal=dcache.miss_stall | icache.miss_stall | hzd.data_hazard)
+    frontend.ras_ctrl <<= {
+        'push': idecode_stage.ras_ctrl.push & ras_ctrl_en,
+        'pop': idecode_stage.ras_ctrl.pop & ras_ctrl_en,
+        'pc': idecode_stage.ras_ctrl.pc,
+        'rvc': idecode_stage.ras_ctrl.rvc
+    }
 
     #
-    # IF3: IFetch 3
+    # Likewise, a decode redirect only happens once the instruction leaves
+    # decode, and not when decode is being flushed.
     #
 
-    next_if_id = {
-        'valid': if2_if3_reg.valid & ~icache.miss_stall,
-        'pc': if2_if3_reg.pc
+    decode_redirect = idecode_stage.redirect.valid & ras_ctrl_en
+
+    frontend.decode_redirect <<= {
+        'valid': decode_redirect,
+        'pc': idecode_stage.redirect.pc,
+        'target': idecode_stage.redirect.target
     }
 
-    PipelineUpdate(
-        pipe_reg=if_id_reg,
-        next_value=next_if_id,
-        flush_signal=bru.mispred.valid,
-        reset_value=if_bundle_reset,
-        stall_signal=dcache.miss_stall | hzd.data_hazard)
+    Probe(decode_redirect, 'decode_redirect')
 
     #
-    # B1: Decode Stage
+    # The frontend drops the second instruction of a fused pair along with the
+    # first, once they leave decode.
     #
 
-    idecode_stage.if_id <<= if_id_reg
-    idecode_stage.inst <<= icache.cpu_resp.data(31, 0)
-    idecode_stage.reg_write <<= writeback_stage.reg_write
-    idecode_stage.stall <<= dcache.miss_stall
+    frontend.fused <<= idecode_stage.fused
+
+    Probe(idecode_stage.fusion.lui_addi & ras_ctrl_en, 'fuse_lui_addi')
+    Probe(idecode_stage.fusion.auipc_addi & ras_ctrl_en, 'fuse_auipc_addi')
+    Probe(idecode_stage.fusion.slli_srli & ras_ctrl_en, 'fuse_slli_srli')
+    Probe(idecode_stage.fusion.auipc_jalr & ras_ctrl_en, 'fuse_auipc_jalr')
 
-    Probe(writeback_stage.reg_write.w_en, 'reg_w_en')
-    Probe(writeback_stage.reg_write.w_addr, 'reg_w_addr')
-    Probe(writeback_stage.reg_write.w_data, 'reg_w_data')
+    Probe(reg_write.w_en, 'reg_w_en')
+    Probe(reg_write.w_addr, 'reg_w_addr')
+    Probe(reg_write.w_data, 'reg_w_data')
+
+    #
+    # N.B. A misprediction is only seen for one cycle unless the frontend is
+    # stalled, and the dcache can be stalled in that cycle (by a store drained
+    # from the store buffer) even though the branch has left execute. The
+    # flush takes priority over that stall, otherwise the wrong path
+    # instruction in execute would be kept and run once the stall clears. It
+    # doesn't send its dcache request in the meantime (see ExecuteStage).
+    #
 
     PipelineUpdate(
         pipe_reg=id_ex_reg,
         next_value=idecode_stage.id_ex,
         flush_signal=bru.mispred.valid | hzd.data_hazard,
         reset_value=id_ex_bundle_reset,
-        stall_signal=dcache.miss_stall)
+        stall_signal=ex_stall & ~bru.mispred.valid)
 
     #
     # B2: Execute Stage
     #
 
     execute_stage.id_ex <<= id_ex_reg
+
+    Probe(
+        id_ex_reg.ctrl.valid & id_ex_reg.ctrl.is_return & \
+            ~bru.mispred.valid & ~ex_stall,
+        'return_resolve')
+
     execute_stage.rs1_data <<= idecode_stage.rs1_data
     execute_stage.rs2_data <<= idecode_stage.rs2_data
     execute_stage.fwd.select1 <<= fwd.fwd1_select
     execute_stage.fwd.select2 <<= fwd.fwd2_select
     execute_stage.fwd.mem_data <<= ex_mem_reg.alu_result
     execute_stage.fwd.wb_data <<= writeback_stage.reg_write.w_data
-    execute_stage.mispred <<= bru.mispred_ex_bypass
+    execute_stage.mispred <<= bru.mispred.valid
 
     dcache.cpu_req <<= execute_stage.dcache.cpu_req
+    dcache.prefetch_hint <<= {
+        'valid': False,
+        'addr': 0
+    }
     Probe(execute_stage.dcache.cpu_req.valid, 'dcache_cpu_req_valid')
     Probe(execute_stage.dcache.cpu_req.addr, 'dcache_cpu_req_addr')
     Probe(execute_stage.dcache.cpu_req.read, 'dcache_cpu_req_read')
 
+    next_ex_mem = Wire(ex_mem_bundle)
+
+    with dcache.req_stall:
+        next_ex_mem <<= ex_mem_bundle_reset
+    with otherwise:
+        next_ex_mem <<= execute_stage.ex_mem
+
     PipelineUpdate(
         pipe_reg=ex_mem_reg,
-        next_value=execute_stage.ex_mem,
+        next_value=next_ex_mem,
         flush_signal=bru.mispred.valid,
         reset_value=ex_mem_bundle_reset,
         stall_signal=dcache.miss_stall)
@@ -254,10 +360,15 @@ def Amethyst():
     with otherwise:
         next_mem_wb <<= mem_stage.mem_wb
 
+    #
+    # N.B. Branches resolve in execute, so by the time a misprediction flushes
+    # the pipeline the branch itself is in this stage and must not be flushed.
+    #
+
     PipelineUpdate(
         pipe_reg=mem_wb_reg,
         next_value=next_mem_wb,
-        flush_signal=bru.mispred.valid,
+        flush_signal=None,
         reset_value=mem_wb_bundle_reset,
         stall_signal=dcache.miss_stall)
 
@@ -267,6 +378,33 @@ def Amethyst():
 
     writeback_stage.mem_wb <<= mem_wb_reg
     writeback_stage.mem_read_data <<= dcache.cpu_resp.data
+    writeback_stage.mem_pending <<= dcache.cpu_resp.pending
+
+    #
+    # Register File Write
+    #
+    # Writeback doesn't write while the dcache is stalled, since it will see
+    # the same instruction again. The dcache writes loads that missed (see
+    # cache/mshr.py) whenever writeback doesn't.
+    #
+
+    wb_write = writeback_stage.reg_write.w_en & ~dcache.miss_stall
+
+    dcache.fill_write.ready <<= ~wb_write
+
+    with dcache.fill_write.valid & ~wb_write:
+        reg_write <<= {
+            'w_addr': dcache.fill_write.rd,
+            'w_data': dcache.fill_write.data,
+            'w_en': True
+        }
+
+    with otherwise:
+        reg_write <<= {
+            'w_addr': writeback_stage.reg_write.w_addr,
+            'w_data': writeback_stage.reg_write.w_data,
+            'w_en': wb_write
+        }
 
     #
     # Debug Signals
@@ -2,4 +2,7 @@ from . import bpred
 from . import btb
 from . import frontend
 from . import ifetch
+from . import indirect
+from . import loopbuf
 from . import ras
+from . import realign
@@ -1,21 +1,547 @@
+from dataclasses import dataclass
+
 from atlas import *
 from ..support import *
 
-@Module
-def BranchPredictor():
-    io = Io({
+bpred_type = C['bpred']['type']
+bpred_size = C['bpred']['size']
+index_bits = Log2Ceil(bpred_size)
+history_bits = C['bpred']['history-length']
+
+assert bpred_type in ['bimodal', 'gshare', 'tage']
+
+if bpred_type == 'gshare':
+    assert history_bits <= index_bits
+
+#
+# All predictor tables are built from n-bit saturating counters. The msb of the
+# counter is the predicted direction. For the 2-bit counters used by the
+# bimodal / gshare tables:
+#
+# 0b00: strongly not taken
+# 0b01: weakly not taken
+# 0b10: weakly taken
+# 0b11: strongly taken
+#
+
+CounterTaken = lambda ctr: ctr(ctr.width - 1, ctr.width - 1)
+
+def CounterUpdate(ctr, taken):
+    """Produce the next value of a saturating counter."""
+
+    ctr_max = (1 << ctr.width) - 1
+
+    next_ctr = Wire(Bits(ctr.width))
+    next_ctr <<= ctr
+
+    with taken & (ctr != ctr_max):
+        next_ctr <<= ctr + 1
+
+    with ~taken & (ctr != 0):
+        next_ctr <<= ctr - 1
+
+    NameSignals(locals())
+    return next_ctr
+
+def BpredIo():
+    return Io({
         'cur_pc': Input(Bits(C['paddr-width'])),
         'pred': Output({
-            'taken': Bits(1)
+            'taken': Bits(1),
+            'history': Bits(bpred_history_width)
         }),
         'update': Input({
             'valid': Bits(1),
             'pc': Bits(C['paddr-width']),
-            'taken': Bits(1)
+            'taken': Bits(1),
+            'pred_taken': Bits(1),
+            'history': Bits(bpred_history_width)
         })
     })
 
-    io.pred.taken <<= True
+def ShiftHistory(ghr, taken):
+    """Shift a resolved branch outcome into the lsb of a history register."""
+
+    if ghr.width == 1:
+        return taken
+
+    return Cat([ghr(ghr.width - 2, 0), taken])
+
+def BpredHashFunction(pc, ghr):
+    #
+    # PCs are always 4-byte aligned so the lowest two bits carry no information
+    # and are dropped. In gshare mode, the global history is folded into the
+    # low order bits of the index.
+    #
+
+    pc_index = pc(index_bits + 1, 2)
+
+    if bpred_type != 'gshare':
+        return pc_index
+
+    if history_bits == index_bits:
+        return pc_index ^ ghr
+
+    zero = Wire(Bits(1))
+    zero <<= 0
+
+    return pc_index ^ Cat([Fill(zero, index_bits - history_bits), ghr])
+
+@Module
+def CounterPredictor():
+    """Bimodal / gshare branch direction predictor.
+
+    This is a table of 2-bit saturating counters indexed by the pc (bimodal) or
+    by the pc XOR'd with a global history register (gshare). The mode, table
+    size and history length are set by the 'bpred' section of the config.
+    """
+
+    io = BpredIo()
+
+    counters = Mem(2, bpred_size)
+
+    #
+    # N.B. The global history is only updated when branches resolve (I.e. it is
+    # not speculative), so it can change while a branch is in flight. The
+    # history a branch was predicted with (pred.history) travels with it down
+    # the pipeline and comes back with the update, so the branch trains the
+    # same counter it was predicted by. No repair is needed on a
+    # misprediction.
+    #
+
+    ghr = Reg(Bits(history_bits), reset_value=0)
+
+    #
+    # Prediction
+    #
+    # Like the BTB, the table is read with the pc of the _next_ cycle so the
+    # (clocked) result lines up with the pc in IF1. The history it was read
+    # with is latched alongside.
+    #
+
+    pred_ctr = counters.Read(BpredHashFunction(io.cur_pc, ghr))
+    io.pred.taken <<= CounterTaken(pred_ctr)
+
+    pred_history = Reg(Bits(history_bits), reset_value=0)
+    pred_history <<= ghr
+    io.pred.history <<= pred_history
+
+    #
+    # Update
+    #
+    # Updating a counter is a read-modify-write so it takes two cycles: the
+    # first reads the current counter value and the second writes back the
+    # incremented / decremented counter. Two back to back updates to the same
+    # entry can lose one of the updates, which only costs a little accuracy.
+    #
+
+    update_index = BpredHashFunction(io.update.pc, io.update.history)
+    update_ctr = counters.Read(update_index)
+
+    update_reg = Reg({
+        'valid': Bits(1),
+        'index': Bits(index_bits),
+        'taken': Bits(1)
+    }, reset_value={
+        'valid': False,
+        'index': 0,
+        'taken': False
+    })
+
+    update_reg <<= {
+        'valid': io.update.valid,
+        'index': update_index,
+        'taken': io.update.taken
+    }
+
+    counters.Write(
+        update_reg.index,
+        CounterUpdate(update_ctr, update_reg.taken),
+        update_reg.valid)
+
+    if bpred_type == 'gshare':
+        with io.update.valid:
+            ghr <<= ShiftHistory(ghr, io.update.taken)
+
+    NameSignals(locals())
+
+#
+# TAGE Predictor
+#
+# The TAGE predictor is made up of a bimodal base table (sized by the 'size'
+# parameter above) and a set of tagged tables, each indexed by a hash of the pc
+# and an increasingly long (geometric) slice of the global history. The
+# prediction comes from the tagged table with the longest history that hits
+# (the "provider"), falling back to the base table.
+#
+# Each tagged entry has the following layout:
+#
+# msb                        lsb
+# | ---- tag ---- | -- ctr -- |
+#
+# The useful bit of each entry is kept in a separate array so it can be aged
+# without touching the tag or counter, and each table has a valid bit per entry
+# so that an entry only hits once it has been allocated.
+#
+
+tage_tables = C['bpred']['tage']['tables'] if bpred_type == 'tage' else []
+tage_ctr_bits = 3
+tage_reset_period = \
+    C['bpred']['tage']['useful-reset-period'] if bpred_type == 'tage' else 0
+
+@dataclass(frozen=True)
+class TageTableConfig(object):
+    size : int
+    tag_bits : int
+    history_length : int
+
+    @property
+    def index_bits(self):
+        return Log2Ceil(self.size)
+
+    @property
+    def entry_bits(self):
+        return self.tag_bits + tage_ctr_bits
+
+    @staticmethod
+    def FromConfig(table):
+        return TageTableConfig(
+            size=table['size'],
+            tag_bits=table['tag-bits'],
+            history_length=table['history-length'])
+
+tage_configs = [TageTableConfig.FromConfig(table) for table in tage_tables]
+
+for (shorter, longer) in zip(tage_configs, tage_configs[1:]):
+    assert shorter.history_length < longer.history_length
+
+EntryCtr = lambda entry: entry(tage_ctr_bits - 1, 0)
+EntryTag = lambda entry: entry(entry.width - 1, tage_ctr_bits)
+
+def FoldHistory(ghr, length, width):
+    """XOR-fold the most recent length bits of history down to width bits."""
+
+    return XorFold(ghr(length - 1, 0), width)
+
+def TageIndex(TC : TageTableConfig, pc, ghr):
+    return pc(TC.index_bits + 1, 2) ^ \
+        FoldHistory(ghr, TC.history_length, TC.index_bits)
+
+def TageTag(TC : TageTableConfig, pc, ghr):
+    #
+    # The tag uses a second, differently aligned fold of the history so that
+    # two branches that alias in the index are unlikely to also alias in the
+    # tag.
+    #
+
+    zero = Wire(Bits(1))
+    zero <<= 0
+
+    return pc(TC.tag_bits + 1, 2) ^ \
+        FoldHistory(ghr, TC.history_length, TC.tag_bits) ^ \
+        Cat([FoldHistory(ghr, TC.history_length, TC.tag_bits - 1), zero])
+
+def TageSelect(hits, ctrs, base_ctr):
+    """Select the provider and alternate predictions.
+
+    The provider is the hitting table with the longest history and the
+    alternate prediction is what would have been predicted without it. Each
+    table level produces its own wires so the chain is purely combinational.
+    """
+
+    pred = Wire(Bits(1))
+    alt = Wire(Bits(1))
+
+    pred <<= CounterTaken(base_ctr)
+    alt <<= CounterTaken(base_ctr)
+
+    for i in range(len(hits)):
+        next_pred = Wire(Bits(1))
+        next_alt = Wire(Bits(1))
+
+        with hits[i]:
+            next_pred <<= CounterTaken(ctrs[i])
+            next_alt <<= pred
+        with otherwise:
+            next_pred <<= pred
+            next_alt <<= alt
+
+        pred = next_pred
+        alt = next_alt
+
+    NameSignals(locals())
+    return pred, alt
+
+@Module
+def TagePredictor():
+    """TAGE-lite branch direction predictor.
+
+    See the description above. The base table size, the tagged table sizes, tag
+    widths and history lengths and the useful bit reset period are all set by
+    the 'bpred' section of the config.
+    """
+
+    io = BpredIo()
+
+    num_tables = len(tage_configs)
+    ghr_bits = tage_configs[-1].history_length
+
+    base = Mem(2, bpred_size)
+    tables = [Mem(TC.entry_bits, TC.size) for TC in tage_configs]
+    useful = [Mem(1, TC.size) for TC in tage_configs]
+    valid_bits = [ValidSet(TC.size) for TC in tage_configs]
+
+    #
+    # As with gshare, the global history is only updated by resolved branches,
+    # and each branch is trained with the history it was predicted with.
+    #
+
+    ghr = Reg(Bits(ghr_bits), reset_value=0)
+
+    with io.update.valid:
+        ghr <<= ShiftHistory(ghr, io.update.taken)
+
+    #
+    # Prediction
+    #
+    # All tables are read in parallel with the pc of the next cycle. The tags to
+    # compare against, and the history they were read with, are latched
+    # alongside the (clocked) reads.
+    #
+
+    pred_history = Reg(Bits(ghr_bits), reset_value=0)
+    pred_history <<= ghr
+    io.pred.history <<= pred_history
+
+    pred_tags = [
+        Reg(Bits(TC.tag_bits), reset_value=0)
+        for TC in tage_configs
+    ]
+
+    pred_valid = Reg(
+        [Bits(1) for _ in tage_configs],
+        reset_value=[0 for _ in tage_configs])
+
+    pred_entries = []
+
+    for i, TC in enumerate(tage_configs):
+        pred_index = TageIndex(TC, io.cur_pc, ghr)
+        pred_tags[i] <<= TageTag(TC, io.cur_pc, ghr)
+        pred_valid[i] <<= valid_bits[i][pred_index]
+        pred_entries.append(tables[i].Read(pred_index))
+
+    pred_base_ctr = base.Read(io.cur_pc(index_bits + 1, 2))
+
+    pred_hits = [
+        pred_valid[i] & (EntryTag(pred_entries[i]) == pred_tags[i])
+        for i in range(num_tables)
+    ]
+
+    pred_taken, _ = TageSelect(
+        pred_hits,
+        [EntryCtr(entry) for entry in pred_entries],
+        pred_base_ctr)
+
+    io.pred.taken <<= pred_taken
+
+    #
+    # Update
+    #
+    # Like the counter predictor, updates take two cycles. The first re-reads
+    # every table for the resolved branch and the second recomputes the
+    # provider / alternate predictions and writes back the changes.
+    #
+    # N.B. The tables can have changed since the branch was predicted, so
+    # whether it mispredicted is taken from the prediction that was actually
+    # made (pred_taken) rather than from the re-read.
+    #
+
+    update_reg = Reg({
+        'valid': Bits(1),
+        'pc': Bits(C['paddr-width']),
+        'taken': Bits(1),
+        'pred_taken': Bits(1),
+        'indices': [Bits(TC.index_bits) for TC in tage_configs],
+        'tags': [Bits(TC.tag_bits) for TC in tage_configs]
+    }, reset_value={
+        'valid': False,
+        'pc': 0,
+        'taken': False,
+        'pred_taken': False,
+        'indices': [0 for _ in tage_configs],
+        'tags': [0 for _ in tage_configs]
+    })
+
+    update_reg.valid <<= io.update.valid
+    update_reg.pc <<= io.update.pc
+    update_reg.taken <<= io.update.taken
+    update_reg.pred_taken <<= io.update.pred_taken
+
+    update_entries = []
+    update_useful = []
+
+    for i, TC in enumerate(tage_configs):
+        update_index = TageIndex(TC, io.update.pc, io.update.history)
+        update_reg.indices[i] <<= update_index
+        update_reg.tags[i] <<= TageTag(TC, io.update.pc, io.update.history)
+        update_entries.append(tables[i].Read(update_index))
+        update_useful.append(useful[i].Read(update_index))
+
+    update_base_index = io.update.pc(index_bits + 1, 2)
+    update_base_ctr = base.Read(update_base_index)
+
+    update_base_index_reg = Reg(Bits(index_bits), reset_value=0)
+    update_base_index_reg <<= update_base_index
+
+    taken = update_reg.taken
+
+    update_hits = [
+        valid_bits[i][update_reg.indices[i]] &
+            (EntryTag(update_entries[i]) == update_reg.tags[i])
+        for i in range(num_tables)
+    ]
+
+    update_pred, update_alt = TageSelect(
+        update_hits,
+        [EntryCtr(entry) for entry in update_entries],
+        update_base_ctr)
+
+    mispredicted = update_reg.pred_taken != taken
+
+    #
+    # provider[i] is set when table i is the provider. longer[i] is set when
+    # table i uses a longer history than the provider (or there is no provider)
+    # and so is a candidate for allocation.
+    #
+
+    provider = [Wire(Bits(1)) for _ in range(num_tables)]
+    longer = [Wire(Bits(1)) for _ in range(num_tables)]
+
+    any_longer_hit = Wire(Bits(1))
+    any_longer_hit <<= False
+
+    for i in reversed(range(num_tables)):
+        provider[i] <<= update_hits[i] & ~any_longer_hit
+        longer[i] <<= ~update_hits[i] & ~any_longer_hit
+
+        next_any_longer_hit = Wire(Bits(1))
+        next_any_longer_hit <<= any_longer_hit | update_hits[i]
+        any_longer_hit = next_any_longer_hit
+
+    any_hit = any_longer_hit
+
+    #
+    # On a misprediction, a new entry is allocated in the shortest longer table
+    # whose entry is not useful. If there is no such entry, all candidate
+    # entries have their useful bits cleared so that a later allocation can
+    # succeed.
+    #
+
+    alloc = [Wire(Bits(1)) for _ in range(num_tables)]
+
+    alloc_found = Wire(Bits(1))
+    alloc_found <<= False
+
+    for i in range(num_tables):
+        candidate = longer[i] & ~update_useful[i]
+        alloc[i] <<= update_reg.valid & mispredicted & candidate & ~alloc_found
+
+        next_alloc_found = Wire(Bits(1))
+        next_alloc_found <<= alloc_found | candidate
+        alloc_found = next_alloc_found
+
+    alloc_failed = update_reg.valid & mispredicted & ~alloc_found
+
+    #
+    # Useful bit aging: every useful-reset-period cycles, sweep through the
+    # tables clearing one useful bit per cycle. Entries written by an update in
+    # the same cycle are skipped by the sweep.
+    #
+
+    sweep_bits = max(TC.index_bits for TC in tage_configs)
+
+    age_counter = Reg(Bits(Log2Ceil(tage_reset_period)), reset_value=0)
+    sweeping = Reg(Bits(1), reset_value=False)
+    sweep_index = Reg(Bits(sweep_bits), reset_value=0)
+
+    age_counter <<= age_counter + 1
+
+    with age_counter == tage_reset_period - 1:
+        age_counter <<= 0
+        sweeping <<= True
+
+    with sweeping:
+        sweep_index <<= sweep_index + 1
+
+        with sweep_index == (1 << sweep_bits) - 1:
+            sweeping <<= False
+
+    #
+    # Table Writes
+    #
+
+    weak_ctr = Cat([taken, ~taken, ~taken])
+
+    for i, TC in enumerate(tage_configs):
+        entry_write = Wire(Bits(TC.entry_bits))
+        entry_write_en = Wire(Bits(1))
+
+        useful_write = Wire(Bits(1))
+        useful_write_en = Wire(Bits(1))
+        useful_write_index = Wire(Bits(TC.index_bits))
+        useful_update = Wire(Bits(1))
+
+        entry_write <<= Cat([
+            update_reg.tags[i],
+            CounterUpdate(EntryCtr(update_entries[i]), taken)
+        ])
+
+        entry_write_en <<= update_reg.valid & provider[i]
+
+        with alloc[i]:
+            entry_write <<= Cat([update_reg.tags[i], weak_ctr])
+            entry_write_en <<= True
+
+        tables[i].Write(update_reg.indices[i], entry_write, entry_write_en)
+        valid_bits[i].Set(update_reg.indices[i], True, alloc[i])
+
+        #
+        # A provider becomes useful when it disagrees with the alternate
+        # prediction and is right, and stops being useful when it disagrees and
+        # is wrong. Newly allocated entries always start out not useful.
+        #
+
+        provider_useful = \
+            update_reg.valid & provider[i] & (update_pred != update_alt)
+
+        useful_update <<= \
+            provider_useful | alloc[i] | (alloc_failed & longer[i])
+
+        useful_write <<= provider_useful & (update_pred == taken)
+        useful_write_en <<= useful_update | sweeping
+        useful_write_index <<= update_reg.indices[i]
+
+        with ~useful_update:
+            useful_write_index <<= sweep_index(TC.index_bits - 1, 0)
+
+        useful[i].Write(useful_write_index, useful_write, useful_write_en)
+
+    #
+    # The base table is only trained when no tagged table provided the
+    # prediction.
+    #
+
+    base.Write(
+        update_base_index_reg,
+        CounterUpdate(update_base_ctr, taken),
+        update_reg.valid & ~any_hit)
 
     NameSignals(locals())
 
+def BranchPredictor():
+    """Instantiate the branch predictor selected by the config."""
+
+    if bpred_type == 'tage':
+        return TagePredictor()
+    else:
+        return CounterPredictor()
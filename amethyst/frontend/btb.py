@@ -1,96 +1,263 @@
 from atlas import *
 from ..support import *
 
-C['paddr-width'] = C['paddr-width']
-btb_size = C['btb']['size']
-hash_bits = Log2Ceil(btb_size)
-tag_bits = C['paddr-width'] - hash_bits
-flag_bits = 1
+btb_sets = C['btb']['num-sets']
+btb_ways = C['btb']['num-ways']
+
+set_bits = Log2Ceil(btb_sets)
+way_bits = Log2Ceil(btb_ways)
+
+assert btb_sets > 1 and btb_ways > 1
+
+#
+# Branches are looked up by the aligned 32-bit word holding their last halfword
+# (the unit the frontend fetches), so the two lowest bits are never used for
+# the set index or the tag. Instead, each entry records which halfword of the
+# word the branch ends in. A "tag-bits" of 0 stores the full tag, otherwise the
+# full tag is hashed down to a partial tag of the given width.
+#
+
+full_tag_bits = C['paddr-width'] - set_bits - 2
+tag_bits = C['btb']['tag-bits'] if C['btb']['tag-bits'] > 0 else full_tag_bits
+flag_bits = 3
+
+assert tag_bits <= full_tag_bits
 
 entry_size = tag_bits + flag_bits + C['paddr-width']
 
 Tag = lambda btb_entry: btb_entry(entry_size - 1, entry_size - tag_bits)
-IsReturn = lambda btb_entry: btb_entry(entry_size - tag_bits - 1, C['paddr-width'])
+Half = lambda btb_entry: btb_entry(entry_size - tag_bits - 1, C['paddr-width'] + 2)
+IsReturn = lambda btb_entry: btb_entry(C['paddr-width'] + 1, C['paddr-width'] + 1)
+IsIndirect = lambda btb_entry: btb_entry(C['paddr-width'], C['paddr-width'])
 Target = lambda btb_entry: btb_entry(C['paddr-width'] - 1, 0)
 
 def BtbHashFunction(pc):
-    return pc(hash_bits - 1, 0)
+    return pc(set_bits + 1, 2)
+
+def BtbTag(pc):
+    full_tag = pc(C['paddr-width'] - 1, set_bits + 2)
+
+    if tag_bits == full_tag_bits:
+        return full_tag
+
+    return XorFold(full_tag, tag_bits)
+
+def LruBypass(read_state, read_index, write):
+    """Bypass an LRU state write made in the same cycle as a (clocked) read.
+
+    N.B. This is the same trick the register file uses for its read ports.
+    """
+
+    bypass = Reg(Bits(1), reset_value=False)
+    bypass_state = Reg(Bits(btb_ways * way_bits), reset_value=0)
+
+    bypass <<= write.valid & (write.index == read_index)
+    bypass_state <<= write.state
+
+    state = Wire(Bits(btb_ways * way_bits))
+
+    with bypass:
+        state <<= bypass_state
+    with otherwise:
+        state <<= read_state
+
+    NameSignals(locals())
+    return state
 
 @Module
 def BranchTargetBuffer():
+    """N-way set associative branch target buffer.
+
+    Each way is a separate table of entries, indexed by BtbHashFunction. The
+    ways of a set are replaced in LRU order, preferring ways that are not yet
+    valid. The number of sets, ways and tag bits are set by the 'btb' section
+    of the config.
+    """
+
     io = Io({
         'cur_pc': Input(Bits(C['paddr-width'])),
         'pred': Output({
             'valid': Bits(1),
+            'half': Bits(1),
             'is_return': Bits(1),
+            'is_indirect': Bits(1),
             'target': Bits(C['paddr-width'])
         }),
         'update': Input({
             'valid': Bits(1),
+            'clear': Bits(1),
             'pc': Bits(C['paddr-width']),
             'target': Bits(C['paddr-width']),
-            'is_return': Bits(1)
+            'is_return': Bits(1),
+            'is_indirect': Bits(1)
         })
     })
 
-    valid_bits = ValidSet(btb_size)
-    valid_reg = Reg(Bits(1), reset_value=False)
-
-    tag_match = Wire(Bits(1))
-    table = Mem(entry_size, btb_size)
-
-    last_pc = Reg(Bits(C['paddr-width']))
-    last_pc <<= io.cur_pc
+    tables = [Mem(entry_size, btb_sets) for _ in range(btb_ways)]
+    valid_bits = [ValidSet(btb_sets) for _ in range(btb_ways)]
+    lru_state = Mem(btb_ways * way_bits, btb_sets)
 
     #
     # Each entry in the BTB has the following layout:
     #
-    # msb                                             lsb
-    # | ---- tag ---- | flags | ---- target addr ---- |
+    # msb                                                                   lsb
+    # | ---- tag ---- | half | is_return | is_indirect | ---- target addr ---- |
     #
 
-    read_entry = Wire(Bits(entry_size))
+    lru_write = Wire({
+        'valid': Bits(1),
+        'index': Bits(set_bits),
+        'state': Bits(btb_ways * way_bits)
+    })
 
     #
-    # The entry to read is based off the has of the current pc. This hash
-    # realisitcally could be anything that can be produced combinationally but
-    # (above) is implemented by extracting the lower order bits of the pc.
+    # Lookup
     #
+    # Every way of the set is read in parallel (clocked) and the tags are
+    # compared against the latched pc in the following cycle.
+    #
+
+    last_pc = Reg(Bits(C['paddr-width']))
+    last_pc <<= io.cur_pc
+
+    read_index = BtbHashFunction(io.cur_pc)
+    last_index = BtbHashFunction(last_pc)
 
-    table_index = BtbHashFunction(io.cur_pc)
-    read_entry <<= table.Read(table_index)
-    valid_reg <<= valid_bits[table_index]
+    read_entries = [tables[way].Read(read_index) for way in range(btb_ways)]
 
-    tag_match <<= Tag(read_entry) == last_pc(C['paddr-width'] - 1, hash_bits)
+    read_valid = Reg(
+        [Bits(1) for _ in range(btb_ways)],
+        reset_value=[0 for _ in range(btb_ways)])
+
+    for way in range(btb_ways):
+        read_valid[way] <<= valid_bits[way][read_index]
+
+    read_lru = LruBypass(lru_state.Read(read_index), read_index, lru_write)
+
+    hit = Wire(Bits(1))
+    hit_way = Wire(Bits(way_bits))
+    hit_entry = Wire(Bits(entry_size))
+
+    hit <<= False
+    hit_way <<= 0
+    hit_entry <<= read_entries[0]
 
     #
     # The prediction is only valid when the read tag matches _and_ the entry is
-    # valid. This prevents the BTB from ever producing a false positive branch
-    # instruction. This is important because the pipeline assumes a non-branch
-    # will never be predicted as a branch.
+    # valid. With full tags, this prevents the BTB from ever producing a false
+    # positive. With partial tags, a non-branch can alias with a branch; that
+    # case is caught by the branch unit, which then clears the entry.
     #
 
-    io.pred.valid <<= valid_reg & tag_match
-    io.pred.is_return <<= IsReturn(read_entry)
-    io.pred.target <<= Target(read_entry)
+    for way in range(btb_ways):
+        with read_valid[way] & (Tag(read_entries[way]) == BtbTag(last_pc)):
+            hit <<= True
+            hit_way <<= way
+            hit_entry <<= read_entries[way]
+
+    io.pred.valid <<= hit
+    io.pred.half <<= Half(hit_entry)
+    io.pred.is_return <<= IsReturn(hit_entry)
+    io.pred.is_indirect <<= IsIndirect(hit_entry)
+    io.pred.target <<= Target(hit_entry)
 
     #
-    # Handle BTB update requests. The BTB is effectively a direct mapped cache
-    # so all that happens is a simple overwrite of the update_index.
+    # Update
     #
-    # The entry to be written (upon an update) is simply the tag of the current
-    # pc, flags, and target concatenated together.
+    # Updates take two cycles. The first reads the set of the updated pc. The
+    # second either rewrites the way that already holds the pc or replaces the
+    # first invalid (or least recently used) way. A clear request only
+    # invalidates the way that holds the pc, if there is one.
     #
 
+    update_reg = Reg({
+        'valid': Bits(1),
+        'clear': Bits(1),
+        'pc': Bits(C['paddr-width']),
+        'target': Bits(C['paddr-width']),
+        'is_return': Bits(1),
+        'is_indirect': Bits(1)
+    }, reset_value={
+        'valid': False,
+        'clear': False,
+        'pc': 0,
+        'target': 0,
+        'is_return': False,
+        'is_indirect': False
+    })
+
+    update_reg <<= io.update
+
+    update_index = BtbHashFunction(io.update.pc)
+    update_entries = [tables[way].Read(update_index) for way in range(btb_ways)]
+
+    update_valid = Reg(
+        [Bits(1) for _ in range(btb_ways)],
+        reset_value=[0 for _ in range(btb_ways)])
+
+    for way in range(btb_ways):
+        update_valid[way] <<= valid_bits[way][update_index]
+
+    update_lru = LruBypass(lru_state.Read(update_index), update_index, lru_write)
+    write_index = BtbHashFunction(update_reg.pc)
+
+    match = Wire(Bits(1))
+    write_way = Wire(Bits(way_bits))
+
+    match <<= False
+    write_way <<= LruVictim(LruUnpack(update_lru, btb_ways))
+
+    for way in reversed(range(btb_ways)):
+        with ~update_valid[way]:
+            write_way <<= way
+
+    for way in range(btb_ways):
+        with update_valid[way] & \
+            (Tag(update_entries[way]) == BtbTag(update_reg.pc)):
+
+            match <<= True
+            write_way <<= way
+
     write_entry = Cat([
-        io.update.pc(C['paddr-width'] - 1, hash_bits),
-        io.update.is_return,
-        io.update.target
+        BtbTag(update_reg.pc),
+        update_reg.pc(1, 1),
+        update_reg.is_return,
+        update_reg.is_indirect,
+        update_reg.target
     ])
 
-    update_index = BtbHashFunction(io.update.pc)
-    table.Write(update_index, write_entry, io.update.valid)
+    do_write = update_reg.valid & ~update_reg.clear
+    do_clear = update_reg.valid & update_reg.clear & match
+
+    for way in range(btb_ways):
+        tables[way].Write(
+            write_index,
+            write_entry,
+            do_write & (write_way == way))
+
+        valid_bits[way].Set(
+            write_index,
+            ~update_reg.clear,
+            (do_write | do_clear) & (write_way == way))
+
+    #
+    # LRU Update
+    #
+    # Both a lookup hit and a write make a way the most recently used. There is
+    # one write port for the LRU state, so a write takes priority over a hit
+    # in the same cycle.
+    #
+
+    lru_write.valid <<= hit
+    lru_write.index <<= last_index
+    lru_write.state <<= LruPack(LruTouch(LruUnpack(read_lru, btb_ways), hit_way))
+
+    with do_write:
+        lru_write.valid <<= True
+        lru_write.index <<= write_index
+        lru_write.state <<= LruPack(
+            LruTouch(LruUnpack(update_lru, btb_ways), write_way))
 
-    valid_bits.Set(update_index, io.update.valid, io.update.valid)
+    lru_state.Write(lru_write.index, lru_write.state, lru_write.valid)
 
-    NameSignals(locals())
\ No newline at end of file
+    NameSignals(locals())
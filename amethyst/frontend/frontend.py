@@ -1,119 +1,409 @@
 from atlas import *
 from ..support import *
 
-from .bpred import BranchPredictor
-from .btb import BranchTargetBuffer
-from .ras import ReturnAddressStack
+from .ifetch import IFetchStage
+from .loopbuf import LoopBuffer, lb_size
+from .realign import Realigner
+
+fq_depth = C['frontend']['fetch-queue-depth']
+fq_index_width = max(Log2Ceil(fq_depth), 1)
+fq_count_width = max(Log2Ceil(fq_depth + 1), 1)
+
+fetch_stages = C['frontend'].get('fetch-stages', 3)
+assert fetch_stages in [2, 3]
+
+def FetchQueueAdvance(ptr):
+    next_ptr = Wire(Bits(fq_index_width))
+
+    with ptr == fq_depth - 1:
+        next_ptr <<= 0
+    with otherwise:
+        next_ptr <<= ptr + 1
+
+    NameSignals(locals())
+    return next_ptr
 
 @Module
 def Frontend():
     """The frontend (instruction fetch) pipeline for Amethyst
 
-    This stage contains the program counter register for the pipeline and
-    produces imem accesses to retrieve instructions.
+    This module contains the program counter register for the pipeline, the
+    IFetch stage (branch prediction) and produces imem accesses to retrieve
+    instructions.
+
+    The frontend contains 3 pipeline stages - and so there is a 3 cycle latency
+    in producing a valid instruction (assuming a cache hit). Optionally (set by
+    fetch-stages in the frontend config), IF3 is dropped and the icache checks
+    tags and selects the fetched word in the same cycle, which takes a cycle
+    off of the mispredict penalty at the cost of a longer icache path.
+
+    The frontend fetches aligned 32-bit words, which are split into (possibly
+    compressed) instructions by the realigner (see frontend/realign.py).
+    Fetched instructions are handed to decode through a fetch queue, which
+    decouples the two: the frontend keeps fetching (and predicting) while
+    decode is stalled, until the queue fills up, and decode keeps draining
+    buffered instructions while the frontend is stalled on an icache miss. The
+    frontend is flushed on a misprediction, and on a redirect from decode
+    (which leaves decode and everything older alone).
 
-    This frontend contains 3 pipeline stages - and so there is a 3 cycle latency
-    in producing a valid instruction (assuming a cache hit). This frontend will
-    stall on a miss, and flush on a misprediction.
+    Optionally, a loop buffer replays short loops in place of IF1 - IF3 (see
+    frontend/loopbuf.py).
     """
 
     io = Io({
-        'if_id': Output(if_id_bundle),
+        'if_id': Output(if_bundle),
         'inst': Output(Bits(32)),
+        'next': Output(fetch_entry),
+        'fused': Input(Bits(1)),
         'icache': Output({
             'cpu_req': cpu_cache_req,
             'cpu_stall': Bits(1),
             'miss_stall': Flip(Bits(1)),
-            'cpu_resp': Flip(cpu_cache_resp)
+            'cpu_resp': Flip(cpu_cache_resp),
+            'predecode': Flip(Bits(predecode_word_width)),
+            'prefetch_hint': prefetch_hint_bundle
         }),
         'mispred': Input(mispred_bundle),
+        'decode_redirect': Input(decode_redirect_bundle),
+        'resolve': Input(branch_resolve_bundle),
         'ras_ctrl': Input(ras_ctrl_bundle),
-        'frontend_stall': Input(Bits(1))
+        'ras_checkpoint': Output(ras_checkpoint_bundle),
+        'backend_stall': Input(Bits(1)),
+        'trace': Output({
+            'if1_pc': Bits(C['paddr-width']),
+            'if2': if_bundle,
+            'if3': if_bundle,
+            'fq_count': Bits(fq_count_width),
+            'lb_supply': Bits(1)
+        })
     })
 
-    bpred = Instance(BranchPredictor())
-    btb = Instance(BranchTargetBuffer())
-    ras = Instance(ReturnAddressStack())
-
-    ras.ctrl <<= io.ras_ctrl
+    ifetch_stage = Instance(IFetchStage())
+    realigner = Instance(Realigner())
 
     pc = Reg(Bits(C['paddr-width']), reset_value=C['reset-addr'])
-    next_pc = Wire(Bits(C['paddr-width']))
 
-    if1_pc = Wire(Bits(C['paddr-width']))
+    if1_if2_reg = Reg(if_bundle, reset_value=if_bundle_reset)
 
-    if2_pc = Reg(Bits(C['paddr-width']), reset_value=0)
-    if2_valid = Reg(Bits(1), reset_value=False)
+    #
+    # frontend_stall is raised when the word at the end of the frontend can't
+    # be moved on from: the realigner still has instructions in it to hand
+    # off, or the queue is full and decode is stalled (output_ready is low).
+    # A misprediction or decode redirect (restart) flushes everything younger
+    # than decode, so it never waits on the backend.
+    #
+
+    restart = io.mispred.valid | io.decode_redirect.valid
+
+    frontend_stall = Wire(Bits(1))
+    output_ready = Wire(Bits(1))
+    fetch_stall = io.icache.miss_stall | frontend_stall
 
-    with ~io.icache.miss_stall & ~io.frontend_stall:
-        pc <<= next_pc
-        if2_pc <<= if1_pc
-        if2_valid <<= ~io.mispred.valid
+    #
+    # fetch_idle is raised while the loop buffer is supplying instructions.
+    # IF1 - IF3 are then emptied and the pc is held until the misprediction
+    # that ends the loop redirects it.
+    #
 
-    btb.cur_pc <<= next_pc
-    bpred.cur_pc <<= next_pc
+    fetch_idle = Wire(Bits(1))
 
     #
-    # Misprediction Update Handling
+    # Redirects restart fetch at a new pc without going through the backend.
+    # Decode redirects direct jumps (and backward branches) the BTB didn't
+    # know about. The realigner redirects fetch when a word's prediction
+    # turns out not to line up with an instruction. Like a misprediction, a
+    # redirect is held while the icache is stalled on a miss.
     #
 
-    btb.update.valid <<= io.mispred.valid
-    btb.update.pc <<= io.mispred.pc
-    btb.update.target <<= io.mispred.target
-    btb.update.is_return <<= io.mispred.is_return
+    redirect_held = Reg(
+        fetch_redirect_bundle,
+        reset_value=fetch_redirect_bundle_reset)
+
+    redirect = Wire(fetch_redirect_bundle)
+    redirect <<= redirect_held
+
+    with realigner.redirect.valid:
+        redirect <<= realigner.redirect
+
+    with io.decode_redirect.valid:
+        redirect.valid <<= True
+        redirect.target <<= io.decode_redirect.target
+
+    redirect_now = \
+        redirect.valid & ~io.icache.miss_stall & ~io.mispred.valid & ~fetch_idle
 
-    bpred.update.valid <<= io.mispred.valid
-    bpred.update.pc <<= io.mispred.pc
-    bpred.update.taken <<= io.mispred.taken
+    redirect_held.valid <<= \
+        redirect.valid & io.icache.miss_stall & ~io.mispred.valid
+    redirect_held.target <<= redirect.target
+
+    flush = io.mispred.valid | fetch_idle | redirect_now
 
     #
-    # Stage IF1: Next PC prediction and selection
+    # IF1: IFetch 1
     #
 
+    ifetch_stage.pc <<= pc
+    ifetch_stage.mispred <<= io.mispred
+    ifetch_stage.redirect.valid <<= redirect_now
+    ifetch_stage.redirect.target <<= redirect.target
+    ifetch_stage.decode_redirect <<= io.decode_redirect
+    ifetch_stage.btb_clear.valid <<= realigner.btb_clear.valid & ~restart
+    ifetch_stage.btb_clear.pc <<= realigner.btb_clear.pc
+    ifetch_stage.resolve <<= io.resolve
+    ifetch_stage.ras_ctrl <<= io.ras_ctrl
+    io.ras_checkpoint <<= ifetch_stage.ras_checkpoint
+
+    with ~fetch_stall:
+        with ~fetch_idle:
+            pc <<= ifetch_stage.next_pc
+
+        with flush:
+            if1_if2_reg <<= if_bundle_reset
+        with otherwise:
+            if1_if2_reg <<= ifetch_stage.if1_if2
+
     #
-    # The predicted next PC comes from either the next sequential PC or the
-    # predicted target address in the BTB. Note that pred_pc _can_ be wrong and
-    # that's ok because the misspeculation will be caught later in the pipeline.
+    # IF2: Send icache request
     #
 
-    if1_pc <<= pc
+    io.icache.cpu_stall <<= frontend_stall
+    io.icache.prefetch_hint.valid <<= \
+        ifetch_stage.target_prefetch.valid & ~fetch_idle & ~redirect_now
+    io.icache.prefetch_hint.addr <<= ifetch_stage.target_prefetch.addr
+
+    io.icache.cpu_req <<= {
+        'valid': if1_if2_reg.valid,
+        'addr': if1_if2_reg.pc,
+        'rtype': access_rtype.w,
+        'read': True,
+        'rd': 0,
+        'data': 0
+    }
+
+    fetched = Wire(fetch_entry)
+
+    if fetch_stages == 3:
+        if2_if3_reg = Reg(if_bundle, reset_value=if_bundle_reset)
+        if3_out_reg = Reg(if_bundle, reset_value=if_bundle_reset)
+
+        with ~fetch_stall:
+            with flush:
+                if2_if3_reg <<= if_bundle_reset
+            with otherwise:
+                if2_if3_reg <<= {
+                    'valid': if1_if2_reg.valid,
+                    'pc': if1_if2_reg.pc,
+                    'pred': if1_if2_reg.pred
+                }
+
+        #
+        # IF3: icache will latch read data.
+        #
+        # N.B. The cache latches the output data it generates, so the
+        # instruction becomes available in the cycle after IF3, alongside
+        # if3_out_reg. That pair is the output of the frontend.
+        #
 
-    with bpred.pred.taken & btb.pred.valid & ~btb.pred.is_return:
-        if1_pc <<= btb.pred.target
+        with ~frontend_stall:
+            with flush:
+                if3_out_reg <<= if_bundle_reset
+            with otherwise:
+                if3_out_reg <<= {
+                    'valid': if2_if3_reg.valid & ~io.icache.miss_stall,
+                    'pc': if2_if3_reg.pc,
+                    'pred': if2_if3_reg.pred
+                }
 
-    with btb.pred.valid & btb.pred.is_return:
-        if1_pc <<= ras.top
+        fetched.if_id <<= if3_out_reg
+
+    else:
+        if2_out_reg = Reg(if_bundle, reset_value=if_bundle_reset)
+
+        #
+        # With 2 stages, the icache responds in the cycle after the request,
+        # alongside if2_out_reg (see cache/cache.py). That cycle is also when
+        # the icache finds out it missed, so the word is held in if2_out_reg
+        # (and isn't valid) until the miss is serviced.
+        #
+
+        with ~fetch_stall:
+            with flush:
+                if2_out_reg <<= if_bundle_reset
+            with otherwise:
+                if2_out_reg <<= {
+                    'valid': if1_if2_reg.valid,
+                    'pc': if1_if2_reg.pc,
+                    'pred': if1_if2_reg.pred
+                }
+
+        fetched.if_id <<= if2_out_reg
+        fetched.if_id.valid <<= if2_out_reg.valid & ~io.icache.miss_stall
+
+    fetched.inst <<= io.icache.cpu_resp.data(31, 0)
 
     #
-    # The actual next PC is either the prediction, a value from the return
-    # address stack (RAS) or the correct PC (correction from a misspeculation).
+    # Realign
     #
 
-    with io.mispred.valid:
-        next_pc <<= io.mispred.target
-    with otherwise:
-        next_pc <<= if1_pc + 4
+    realigner.word <<= fetched
+    realigner.predecode <<= io.icache.predecode
+    realigner.accept <<= output_ready
+    realigner.flush <<= restart | fetch_idle
+
+    frontend_stall <<= fetched.if_id.valid & ~realigner.word_done & ~restart
 
+    fetch_out = Wire(fetch_entry)
+
+    #
+    # Loop Buffer
     #
-    # Stage IF2: Send icache request
+    # The loop buffer watches the instructions the frontend hands off. Once it
+    # has captured a loop, it takes over as the output of the frontend.
     #
 
-    io.icache.cpu_req.valid <<= ~io.mispred.valid
-    io.icache.cpu_req.addr <<= if1_pc
-    io.icache.cpu_req.rtype <<= access_rtype.w
-    io.icache.cpu_req.read <<= True
-    io.icache.cpu_stall <<= io.frontend_stall
+    if lb_size > 0:
+        loop_buffer = Instance(LoopBuffer())
 
+        loop_buffer.observe.if_id.valid <<= \
+            realigner.out.if_id.valid & output_ready & ~loop_buffer.streaming
+        loop_buffer.observe.if_id.pc <<= realigner.out.if_id.pc
+        loop_buffer.observe.if_id.pred <<= realigner.out.if_id.pred
+        loop_buffer.observe.inst <<= realigner.out.inst
+
+        loop_buffer.accept <<= output_ready
+        loop_buffer.flush <<= restart
+        loop_buffer.history <<= ifetch_stage.if1_if2.pred.history
+        loop_buffer.path <<= ifetch_stage.if1_if2.pred.path
+
+        fetch_idle <<= (loop_buffer.streaming | loop_buffer.start) & ~restart
+
+        with loop_buffer.streaming:
+            fetch_out <<= loop_buffer.out
+        with otherwise:
+            fetch_out <<= realigner.out
+
+        io.trace.lb_supply <<= loop_buffer.streaming & output_ready
+
+    else:
+        fetch_idle <<= False
+        fetch_out <<= realigner.out
+
+        io.trace.lb_supply <<= False
+
+    #
+    # Fetch Queue
     #
-    # Stage IF3: icache will latch read data.
+    # A circular buffer of fetched instructions. When the queue is empty and
+    # decode isn't stalled, the frontend output bypasses the queue so that it
+    # adds no latency. Otherwise the output is enqueued and decode is fed from
+    # the head of the queue. A restart empties the queue.
     #
-    # N.B. The cache latches the output data it generates, which needs to
-    # bypass the if_id register to keep from introducing an extra pipeline
-    # stage.
+    # Decode is also shown the instruction behind the one it is given (the
+    # next queue entry, or the frontend output when there is just one), so it
+    # can fuse the two. A fused pair leaves the queue together.
     #
 
-    io.if_id.pc <<= if2_pc
-    io.if_id.valid <<= if2_valid & ~io.mispred.valid & ~io.icache.miss_stall
-    io.inst <<= io.icache.cpu_resp.data(31, 0)
+    if fq_depth > 0:
+        queue = Reg([fetch_entry for _ in range(fq_depth)])
+
+        head = Reg(Bits(fq_index_width), reset_value=0)
+        tail = Reg(Bits(fq_index_width), reset_value=0)
+        count = Reg(Bits(fq_count_width), reset_value=0)
+
+        empty = count == 0
+        full = count == fq_depth
+
+        head_entry = Wire(fetch_entry)
+        head_entry <<= queue[0]
+
+        for i in range(fq_depth):
+            with head == i:
+                head_entry <<= queue[i]
+
+        head_next = FetchQueueAdvance(head)
+        head_next_two = FetchQueueAdvance(head_next)
+
+        next_entry = Wire(fetch_entry)
+        next_entry <<= fetch_out
+
+        for i in range(fq_depth):
+            with (count != 1) & (head_next == i):
+                next_entry <<= queue[i]
+
+        io.next.if_id.valid <<= next_entry.if_id.valid & ~empty
+        io.next.if_id.pc <<= next_entry.if_id.pc
+        io.next.if_id.pred <<= next_entry.if_id.pred
+        io.next.inst <<= next_entry.inst
+
+        bypass = empty & ~io.backend_stall
+        accept = ~full | ~io.backend_stall
+
+        deq = ~empty & ~io.backend_stall
+        deq_out = deq & io.fused & (count == 1)
+        deq_two = deq & io.fused & (count != 1)
+
+        enq = fetch_out.if_id.valid & accept & ~bypass & ~deq_out
+
+        output_ready <<= accept | restart
+
+        with empty:
+            io.if_id <<= fetch_out.if_id
+            io.inst <<= fetch_out.inst
+        with otherwise:
+            io.if_id <<= head_entry.if_id
+            io.inst <<= head_entry.inst
+
+        for i in range(fq_depth):
+            with enq & (tail == i):
+                queue[i] <<= fetch_out
+
+        with enq:
+            tail <<= FetchQueueAdvance(tail)
+
+        with deq:
+            head <<= head_next
+
+        with deq_two:
+            head <<= head_next_two
+
+        with enq & ~deq:
+            count <<= count + 1
+
+        with deq & ~enq:
+            count <<= count - 1
+
+        with deq_two & enq:
+            count <<= count - 1
+
+        with deq_two & ~enq:
+            count <<= count - 2
+
+        with restart:
+            head <<= 0
+            tail <<= 0
+            count <<= 0
+
+        io.trace.fq_count <<= count
+
+    else:
+        output_ready <<= ~io.backend_stall | restart
+
+        io.if_id <<= fetch_out.if_id
+        io.inst <<= fetch_out.inst
+
+        io.next <<= {
+            'if_id': if_bundle_reset,
+            'inst': 0
+        }
+
+        io.trace.fq_count <<= 0
+
+    io.trace.if1_pc <<= pc
+    io.trace.if2 <<= if1_if2_reg
+
+    if fetch_stages == 3:
+        io.trace.if3 <<= if2_if3_reg
+    else:
+        io.trace.if3 <<= if_bundle_reset
 
-    NameSignals(locals())
\ No newline at end of file
+    NameSignals(locals())
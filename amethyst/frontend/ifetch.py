@@ -3,6 +3,7 @@ from ..support import *
 
 from .bpred import BranchPredictor
 from .btb import BranchTargetBuffer
+from .indirect import IndirectPredictor
 from .ras import ReturnAddressStack
 
 @Module
@@ -15,62 +16,186 @@ def IFetchStage():
     io = Io({
         'pc': Input(Bits(C['core-width'])),
         'mispred': Input(mispred_bundle),
+        'redirect': Input(fetch_redirect_bundle),
+        'decode_redirect': Input(decode_redirect_bundle),
+        'btb_clear': Input({
+            'valid': Bits(1),
+            'pc': Bits(C['paddr-width'])
+        }),
+        'resolve': Input(branch_resolve_bundle),
         'ras_ctrl': Input(ras_ctrl_bundle),
+        'ras_checkpoint': Output(ras_checkpoint_bundle),
         'next_pc': Output(Bits(C['core-width'])),
-        'if1_if2': Output(if_bundle)
+        'if1_if2': Output(if_bundle),
+        'target_prefetch': Output(prefetch_hint_bundle)
     })
 
     bpred = Instance(BranchPredictor())
     btb = Instance(BranchTargetBuffer())
     ras = Instance(ReturnAddressStack())
+    indirect = Instance(IndirectPredictor())
+
+    #
+    # The RAS is updated by decode and checkpointed with each instruction. A
+    # misprediction restores the checkpoint of the mispredicted instruction.
+    #
 
     ras.ctrl <<= io.ras_ctrl
+    ras.repair.valid <<= io.mispred.valid
+    ras.repair.checkpoint <<= io.mispred.ras
+    io.ras_checkpoint <<= ras.checkpoint
 
     next_pc = Wire(Bits(C['paddr-width']))
-    if1_pc = Wire(Bits(C['paddr-width']))
+    pred_pc = Wire(Bits(C['paddr-width']))
 
     btb.cur_pc <<= next_pc
     bpred.cur_pc <<= next_pc
+    indirect.cur_pc <<= next_pc
 
     #
     # Misprediction Update Handling
     #
+    # The BTB only needs to learn the targets of taken branches. A not-taken
+    # misprediction is corrected by the direction predictor, not by replacing
+    # the (still useful) target in the BTB with pc + 4. The exception is an
+    # instruction that is not a branch at all (a partial tag alias), whose
+    # entry is cleared.
+    #
+    # A decode redirect also teaches the BTB its target, since it was only
+    # redirected from decode because the BTB didn't know about it. A
+    # misprediction takes priority, since it flushes the redirecting
+    # instruction anyway.
+    #
+    # Partial tag aliases are also caught in the frontend, using the icache
+    # predecode bits. Those entries are cleared when the update port is free.
+    #
+
+    btb.update.valid <<= \
+        (io.mispred.valid & (io.mispred.taken | ~io.mispred.is_branch)) | \
+        io.decode_redirect.valid | io.btb_clear.valid
+
+    btb.update.clear <<= True
+    btb.update.pc <<= io.btb_clear.pc
+    btb.update.target <<= 0
+    btb.update.is_return <<= False
+    btb.update.is_indirect <<= False
+
+    with io.decode_redirect.valid:
+        btb.update.clear <<= False
+        btb.update.pc <<= io.decode_redirect.pc
+        btb.update.target <<= io.decode_redirect.target
+
+    with io.mispred.valid:
+        btb.update.clear <<= ~io.mispred.is_branch
+        btb.update.pc <<= io.mispred.pc
+        btb.update.target <<= io.mispred.target
+        btb.update.is_return <<= io.mispred.is_return
+        btb.update.is_indirect <<= io.mispred.is_indirect
+
+    #
+    # The direction predictor trains on every resolved branch, not just the
+    # mispredicted ones, so its counters are reinforced by correct predictions.
+    # Each branch trains with the history it was predicted with, and with the
+    # direction that was predicted for it.
+    #
+
+    bpred.update <<= {
+        'valid': io.resolve.valid,
+        'pc': io.resolve.pc,
+        'taken': io.resolve.taken,
+        'pred_taken': io.resolve.pred_taken,
+        'history': io.resolve.history
+    }
+
+    #
+    # The indirect predictor learns the target of a mispredicted indirect jump.
+    # A misprediction can be held for a few cycles (see BranchUnit), so only
+    # its first cycle (when it is also resolved) is used, along with the path
+    # history the jump was predicted with. The path history shifts in the
+    # target of every resolved indirect jump.
+    #
 
-    btb.update.valid <<= io.mispred.valid
-    btb.update.pc <<= io.mispred.pc
-    btb.update.target <<= io.mispred.target
-    btb.update.is_return <<= io.mispred.is_return
+    indirect.update.valid <<= \
+        io.mispred.valid & io.mispred.is_indirect & io.resolve.valid
+    indirect.update.pc <<= io.mispred.pc
+    indirect.update.target <<= io.mispred.target
+    indirect.update.path <<= io.resolve.path
 
-    bpred.update.valid <<= io.mispred.valid
-    bpred.update.pc <<= io.mispred.pc
-    bpred.update.taken <<= io.mispred.taken
+    indirect.resolve.valid <<= io.resolve.valid & io.resolve.indirect
+    indirect.resolve.target <<= io.resolve.target
 
     #
-    # The predicted next PC comes from either the next sequential PC or the
-    # predicted target address in the BTB. Note that pred_pc _can_ be wrong and
-    # that's ok because the misspeculation will be caught later in the pipeline.
+    # The BTB and predictor are read with next_pc so their (clocked) lookups
+    # line up with the pc in IF1. A BTB hit means the instruction at pc is a
+    # branch; the predicted next PC is then either the BTB target (if predicted
+    # taken), the top of the RAS (for returns, unless the RAS is empty), the
+    # indirect predictor's target (for other JALRs, falling back on the BTB) or
+    # the next sequential PC. Note that pred_pc _can_ be wrong and that's ok
+    # because the misspeculation will be caught later in the pipeline.
+    #
+    # The frontend fetches aligned 32-bit words, so the next sequential PC is
+    # the following word. After a redirect to the upper halfword of a word, a
+    # branch that ends in the (skipped) lower halfword doesn't count.
     #
 
-    if1_pc <<= io.pc
+    zero = Wire(Bits(1))
+    zero <<= 0
+
+    word_pc = Cat([io.pc(C['paddr-width'] - 1, 2), Fill(zero, 2)])
+    btb_valid = btb.pred.valid & (btb.pred.half | ~io.pc(1, 1))
+
+    pred_pc <<= word_pc + 4
+
+    with bpred.pred.taken & btb_valid & ~btb.pred.is_return:
+        pred_pc <<= btb.pred.target
+
+    with btb_valid & btb.pred.is_indirect:
+        pred_pc <<= btb.pred.target
 
-    with bpred.pred.taken & btb.pred.valid & ~btb.pred.is_return:
-        if1_pc <<= btb.pred.target
+        with indirect.pred.valid:
+            pred_pc <<= indirect.pred.target
 
-    with btb.pred.valid & btb.pred.is_return:
-        if1_pc <<= ras.top
+    with btb_valid & btb.pred.is_return:
+        pred_pc <<= btb.pred.target
+
+        with ~ras.empty:
+            pred_pc <<= ras.top
 
     #
-    # The actual next PC is either the prediction, a value from the return
-    # address stack (RAS) or the correct PC (correction from a misspeculation).
+    # The actual next PC is either the prediction or the correct PC (correction
+    # from a misspeculation, or a redirect from within the frontend).
     #
 
+    next_pc <<= pred_pc
+
+    with io.redirect.valid:
+        next_pc <<= io.redirect.target
+
     with io.mispred.valid:
         next_pc <<= io.mispred.target
-    with otherwise:
-        next_pc <<= if1_pc + 4
 
     io.next_pc <<= next_pc
     io.if1_if2.valid <<= True
-    io.if1_if2.pc <<= if1_pc
+    io.if1_if2.pc <<= io.pc
+    pred_taken = btb_valid & \
+        (bpred.pred.taken | btb.pred.is_return | btb.pred.is_indirect)
+    io.if1_if2.pred.taken <<= pred_taken
+    io.if1_if2.pred.target <<= pred_pc
+    io.if1_if2.pred.half <<= btb.pred.half
+    io.if1_if2.pred.hit <<= btb_valid
+    io.if1_if2.pred.direction <<= bpred.pred.taken
+    io.if1_if2.pred.history <<= bpred.pred.history
+    io.if1_if2.pred.path <<= indirect.pred.path
+
+    #
+    # A predicted taken branch in IF1 gives the icache a hint about the line
+    # that will be fetched next, well before the fetch of the target reaches
+    # the point where it would miss. The icache uses it to prefetch the target
+    # line if it isn't present.
+    #
+
+    io.target_prefetch.valid <<= \
+        pred_taken & ~io.mispred.valid & ~io.redirect.valid
+    io.target_prefetch.addr <<= pred_pc
 
     NameSignals(locals())
\ No newline at end of file
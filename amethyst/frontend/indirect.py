@@ -0,0 +1,131 @@
+from atlas import *
+from ..support import *
+
+ind_size = C['indirect']['size']
+ind_index_bits = Log2Ceil(ind_size)
+ind_tag_bits = C['indirect']['tag-bits']
+path_bits = C['indirect']['history-length']
+
+#
+# Each target shifts this many (folded) bits into the path history.
+#
+
+path_bits_per_target = 2
+
+assert path_bits >= path_bits_per_target
+
+ind_entry_size = ind_tag_bits + C['paddr-width']
+
+IndTag = lambda entry: entry(ind_entry_size - 1, C['paddr-width'])
+IndTarget = lambda entry: entry(C['paddr-width'] - 1, 0)
+
+def ShiftPath(path, target):
+    """Shift (a fold of) a resolved indirect jump target into a path history.
+    """
+
+    folded = XorFold(target(C['paddr-width'] - 1, 1), path_bits_per_target)
+
+    if path.width == path_bits_per_target:
+        return folded
+
+    return Cat([path(path.width - path_bits_per_target - 1, 0), folded])
+
+def IndirectHashFunction(pc, path):
+    #
+    # Like the BTB, the table is indexed by the aligned word holding the jump.
+    # The path history is folded into the index so the same jump can hold a
+    # different target for each path leading up to it.
+    #
+
+    return pc(ind_index_bits + 1, 2) ^ XorFold(path, ind_index_bits)
+
+def IndirectTag(pc):
+    return XorFold(pc(C['paddr-width'] - 1, 2), ind_tag_bits)
+
+@Module
+def IndirectPredictor():
+    """Path history indexed indirect target predictor.
+
+    A direct mapped, tagged table of targets for indirect jumps (JALR that
+    aren't returns), indexed by a hash of the pc and the targets of the last
+    few indirect jumps. This lets a jump that goes to many places (a switch,
+    a virtual call) be predicted from how it was reached, which the BTB (one
+    target per pc) can't do. The size, tag bits and history length are set by
+    the 'indirect' section of the config.
+    """
+
+    io = Io({
+        'cur_pc': Input(Bits(C['paddr-width'])),
+        'pred': Output({
+            'valid': Bits(1),
+            'target': Bits(C['paddr-width']),
+            'path': Bits(path_bits)
+        }),
+        'update': Input({
+            'valid': Bits(1),
+            'pc': Bits(C['paddr-width']),
+            'target': Bits(C['paddr-width']),
+            'path': Bits(path_bits)
+        }),
+        'resolve': Input({
+            'valid': Bits(1),
+            'target': Bits(C['paddr-width'])
+        })
+    })
+
+    table = Mem(ind_entry_size, ind_size)
+    valid_bits = ValidSet(ind_size)
+
+    #
+    # N.B. Like the global history of the direction predictor, the path
+    # history is only updated when indirect jumps resolve, so it can change
+    # while a jump is in flight. The path a jump was predicted with
+    # (pred.path) travels with it and comes back with the update.
+    #
+
+    path = Reg(Bits(path_bits), reset_value=0)
+
+    with io.resolve.valid:
+        path <<= ShiftPath(path, io.resolve.target)
+
+    #
+    # Lookup
+    #
+    # The table is read with the pc of the _next_ cycle so the (clocked) result
+    # lines up with the pc in IF1. The path it was read with is latched
+    # alongside.
+    #
+
+    last_pc = Reg(Bits(C['paddr-width']))
+    last_pc <<= io.cur_pc
+
+    read_index = IndirectHashFunction(io.cur_pc, path)
+    read_entry = table.Read(read_index)
+
+    read_valid = Reg(Bits(1), reset_value=False)
+    read_valid <<= valid_bits[read_index]
+
+    io.pred.valid <<= read_valid & (IndTag(read_entry) == IndirectTag(last_pc))
+    io.pred.target <<= IndTarget(read_entry)
+
+    pred_path = Reg(Bits(path_bits), reset_value=0)
+    pred_path <<= path
+    io.pred.path <<= pred_path
+
+    #
+    # Update
+    #
+    # A mispredicted indirect jump writes its target to the entry for its pc
+    # and the path that led to it.
+    #
+
+    update_index = IndirectHashFunction(io.update.pc, io.update.path)
+
+    table.Write(
+        update_index,
+        Cat([IndirectTag(io.update.pc), io.update.target]),
+        io.update.valid)
+
+    valid_bits.Set(update_index, True, io.update.valid)
+
+    NameSignals(locals())
@@ -0,0 +1,171 @@
+from atlas import *
+from ..support import *
+
+lb_size = C['frontend'].get('loop-buffer-size', 0)
+lb_index_width = Log2Ceil(lb_size) if lb_size > 0 else 0
+
+assert lb_size == 0 or (lb_size > 1 and (lb_size & (lb_size - 1)) == 0)
+
+@Module
+def LoopBuffer():
+    """Loop buffer.
+
+    Watches the instructions leaving the frontend for a predicted taken
+    backward branch whose loop body fits in the buffer. The following
+    iteration is then captured. If it was fetched straight through (no other
+    taken branch and no redirect) and ends at the same branch, predicted taken
+    to the same target, the buffer starts streaming the loop body in place of
+    the frontend, leaving the icache idle.
+
+    While streaming, the back edge is always predicted taken, so leaving the
+    loop (or taking any branch inside it) is a misprediction. A misprediction
+    stops the buffer and the frontend resumes from the redirect.
+    """
+
+    io = Io({
+        'observe': Input(fetch_entry),
+        'accept': Input(Bits(1)),
+        'flush': Input(Bits(1)),
+        'history': Input(Bits(bpred_history_width)),
+        'path': Input(Bits(ind_path_width)),
+        'start': Output(Bits(1)),
+        'streaming': Output(Bits(1)),
+        'out': Output(fetch_entry)
+    })
+
+    lbstates = Enum(['idle', 'capture', 'stream'])
+    state = Reg(Bits(lbstates.bitwidth), reset_value=lbstates.idle)
+
+    insts = Reg([Bits(32) for _ in range(lb_size)])
+
+    loop_start = Reg(Bits(C['paddr-width']), reset_value=0)
+    loop_end = Reg(Bits(C['paddr-width']), reset_value=0)
+
+    index = Reg(Bits(lb_index_width), reset_value=0)
+    cur_pc = Reg(Bits(C['paddr-width']), reset_value=0)
+
+    obs = io.observe.if_id
+    obs_valid = obs.valid & ~io.flush
+
+    #
+    # Detect
+    #
+    # A predicted taken branch is a candidate when its target is behind it and
+    # the loop body (target through branch) is no more than lb_size 32-bit
+    # instructions long. With compressed instructions, the body can hold more
+    # than lb_size instructions; that is caught while capturing.
+    #
+
+    distance = obs.pc - obs.pred.target
+    short_backward = \
+        LessThan(obs.pred.target, obs.pc) & \
+        (distance(C['paddr-width'] - 1, lb_index_width + 2) == 0)
+
+    candidate = obs_valid & obs.pred.taken & short_backward
+
+    #
+    # Capture
+    #
+    # Instructions are captured in order starting at loop_start. cur_pc is the
+    # pc of the next instruction expected. Capture is abandoned if the buffer
+    # fills up before the end of the loop is reached.
+    #
+
+    at_end = obs.pc == loop_end
+    closes = at_end & obs.pred.taken & (obs.pred.target == loop_start)
+
+    io.start <<= False
+
+    with state == lbstates.idle:
+        with candidate:
+            state <<= lbstates.capture
+            loop_start <<= obs.pred.target
+            loop_end <<= obs.pc
+            cur_pc <<= obs.pred.target
+            index <<= 0
+
+    with state == lbstates.capture:
+        with obs_valid:
+            for i in range(lb_size):
+                with index == i:
+                    insts[i] <<= io.observe.inst
+
+            cur_pc <<= NextPc(cur_pc, IsCompressed(io.observe.inst))
+            index <<= index + 1
+
+            with (obs.pc != cur_pc) | (obs.pred.taken & ~at_end):
+                state <<= lbstates.idle
+
+            with (index == lb_size - 1) & ~at_end:
+                state <<= lbstates.idle
+
+            with (obs.pc == cur_pc) & at_end:
+                with closes:
+                    io.start <<= True
+                    state <<= lbstates.stream
+                    cur_pc <<= loop_start
+                    index <<= 0
+
+                with otherwise:
+                    state <<= lbstates.idle
+
+    #
+    # Stream
+    #
+
+    streaming = state == lbstates.stream
+    stream_end = cur_pc == loop_end
+
+    stream_inst = Wire(Bits(32))
+    stream_inst <<= insts[0]
+
+    for i in range(lb_size):
+        with index == i:
+            stream_inst <<= insts[i]
+
+    stream_rvc = IsCompressed(stream_inst)
+    stream_next = NextPc(cur_pc, stream_rvc)
+
+    io.streaming <<= streaming
+
+    io.out.if_id.valid <<= streaming
+    io.out.if_id.pc <<= cur_pc
+    io.out.if_id.pred.taken <<= stream_end
+    io.out.if_id.pred.half <<= cur_pc(1, 1) ^ ~stream_rvc
+
+    #
+    # The loop buffer stands in for the BTB while streaming, so every
+    # instruction it supplies counts as predicted. This keeps decode from
+    # second guessing the branches inside the loop (see backend/decode.py).
+    #
+
+    io.out.if_id.pred.hit <<= True
+    io.out.inst <<= stream_inst
+
+    #
+    # The predictors aren't read for the streamed instructions, so they carry
+    # the histories the predictors currently hold (history, path) to train
+    # with, and the loop buffer's own prediction as the predicted direction.
+    #
+
+    io.out.if_id.pred.direction <<= stream_end
+    io.out.if_id.pred.history <<= io.history
+    io.out.if_id.pred.path <<= io.path
+
+    with stream_end:
+        io.out.if_id.pred.target <<= loop_start
+    with otherwise:
+        io.out.if_id.pred.target <<= stream_next
+
+    with streaming & io.accept:
+        with stream_end:
+            cur_pc <<= loop_start
+            index <<= 0
+        with otherwise:
+            cur_pc <<= stream_next
+            index <<= index + 1
+
+    with io.flush:
+        state <<= lbstates.idle
+
+    NameSignals(locals())
@@ -3,41 +3,139 @@ from ..support import *
 
 ras_size = C['ras']['size']
 ras_index_width = Log2Ceil(ras_size)
+ras_count_width = Log2Ceil(ras_size + 1)
 
 @Module
 def ReturnAddressStack():
+    """Speculative return address stack.
+
+    The RAS is pushed / popped by calls and returns in decode, which means it
+    is updated speculatively. The state after every push / pop is reported on
+    the checkpoint output so it can travel down the pipeline with the
+    instruction. When that instruction mispredicts, its checkpoint is fed back
+    on the repair input to undo any changes made by the wrong path.
+    """
+
     io = Io({
         'ctrl': Input(ras_ctrl_bundle),
-        'top': Output(Bits(C['paddr-width']))
+        'repair': Input({
+            'valid': Bits(1),
+            'checkpoint': ras_checkpoint_bundle
+        }),
+        'top': Output(Bits(C['paddr-width'])),
+        'empty': Output(Bits(1)),
+        'checkpoint': Output(ras_checkpoint_bundle)
     })
 
     rstack = Mem(C['paddr-width'], ras_size)
 
     #
     # The return address stack is implemented as a circular buffer so values
-    # don't need to be shifted around wasting energy.
+    # don't need to be shifted around wasting energy. On overflow, the oldest
+    # entry is silently overwritten. count tracks how many entries are valid
+    # (saturating at ras_size) so that popping an empty stack (underflow) can
+    # be ignored instead of wrapping around to stale entries.
     #
 
     push_address = Reg(Bits(ras_index_width), reset_value=0)
+    count = Reg(Bits(ras_count_width), reset_value=0)
+
     top_address = Wire(Bits(ras_index_width))
+    top = Wire(Bits(C['paddr-width']))
+
+    next_push_address = Wire(Bits(ras_index_width))
+    next_count = Wire(Bits(ras_count_width))
+    next_top = Wire(Bits(C['paddr-width']))
+
     write_address = Wire(Bits(ras_index_width))
+    write_data = Wire(Bits(C['paddr-width']))
+    write_en = Wire(Bits(1))
 
     top_address <<= push_address - 1
-    pc_plus_4 = io.ctrl.pc + 4
+    return_addr = NextPc(io.ctrl.pc, io.ctrl.rvc)
+
+    empty = count == 0
+    full = count == ras_size
+
+    push = io.ctrl.push
+    pop = io.ctrl.pop & ~empty
 
-    with io.ctrl.push & io.ctrl.pop:
+    next_push_address <<= push_address
+    next_count <<= count
+    next_top <<= top
+
+    write_address <<= push_address
+    write_data <<= return_addr
+    write_en <<= push
+
+    with push & pop:
         write_address <<= top_address
+        next_top <<= return_addr
 
-    with otherwise:
-        write_address <<= push_address
+    with push & ~pop:
+        next_push_address <<= push_address + 1
+        next_top <<= return_addr
+
+        with ~full:
+            next_count <<= count + 1
+
+    with pop & ~push:
+        next_push_address <<= push_address - 1
+        next_count <<= count - 1
+
+    #
+    # Repair
+    #
+    # A checkpoint holds the pointer, count and top entry as they were right
+    # after the mispredicted instruction updated the stack. The wrong path
+    # only ran for a couple of instructions, so the only entry it can have
+    # clobbered is the top one (by a pop followed by a push). Restoring the
+    # pointer and rewriting the top entry undoes it.
+    #
+    # N.B. The top entry after a pop isn't known in decode, so a checkpoint
+    # taken by a pop only restores the pointer.
+    #
+
+    with io.repair.valid:
+        next_push_address <<= io.repair.checkpoint.ptr
+        next_count <<= io.repair.checkpoint.count
+
+        write_address <<= io.repair.checkpoint.ptr - 1
+        write_data <<= io.repair.checkpoint.top
+        write_en <<= ~io.repair.checkpoint.pop
+
+    push_address <<= next_push_address
+    count <<= next_count
+
+    rstack.Write(write_address, write_data, write_en)
 
-        with io.ctrl.push:
-            push_address <<= push_address + 1
+    #
+    # The top entry is read with the _next_ pointer so that the (clocked) read
+    # lines up with the pointer in the following cycle. A write to the same
+    # entry in this cycle is bypassed.
+    #
+
+    read_address = Wire(Bits(ras_index_width))
+    read_address <<= next_push_address - 1
+    read_data = rstack.Read(read_address)
+
+    bypass = Reg(Bits(1), reset_value=False)
+    bypass_data = Reg(Bits(C['paddr-width']), reset_value=0)
+
+    bypass <<= write_en & (write_address == read_address)
+    bypass_data <<= write_data
+
+    with bypass:
+        top <<= bypass_data
+    with otherwise:
+        top <<= read_data
 
-        with io.ctrl.pop:
-            push_address <<= push_address - 1
+    io.top <<= top
+    io.empty <<= empty
 
-    rstack.Write(write_address, pc_plus_4(C['core-width'] - 1, 0), io.ctrl.push)
-    io.top <<= rstack.Read(top_address)
+    io.checkpoint.ptr <<= next_push_address
+    io.checkpoint.count <<= next_count
+    io.checkpoint.top <<= next_top
+    io.checkpoint.pop <<= pop
 
-    NameSignals(locals())
\ No newline at end of file
+    NameSignals(locals())
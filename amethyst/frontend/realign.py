@@ -0,0 +1,207 @@
+from atlas import *
+from ..support import *
+
+@Module
+def Realigner():
+    """Instruction realigner.
+
+    The frontend fetches aligned 32-bit words. With the C extension, a word can
+    hold two compressed instructions, the second half of a 32-bit instruction
+    that started in the previous word (and the first half of another), or any
+    mix of these. The realigner splits words into instructions and hands them
+    off one per cycle, holding the word (stalling fetch) while it has more than
+    one instruction to hand off.
+
+    The upper halfword of a 32-bit instruction that starts in the upper half of
+    a word is kept until the following word arrives. Since the next word is
+    fetched sequentially, this is how instructions that straddle a word (and so
+    possibly a cache line) boundary are handled.
+
+    The word's prediction (if any) belongs to the instruction that ends in the
+    predicted halfword, and the halfwords after it are dropped. A prediction
+    for a halfword where no instruction ends (a stale BTB entry) is ignored and
+    the frontend is redirected to the word that follows.
+
+    With icache predecode bits, a prediction for an instruction that isn't a
+    branch or jump at all (a partial tag alias in the BTB) is treated the same
+    way, and the BTB entry is cleared.
+    """
+
+    io = Io({
+        'word': Input(fetch_entry),
+        'predecode': Input(Bits(predecode_word_width)),
+        'accept': Input(Bits(1)),
+        'flush': Input(Bits(1)),
+        'word_done': Output(Bits(1)),
+        'redirect': Output(fetch_redirect_bundle),
+        'btb_clear': Output({
+            'valid': Bits(1),
+            'pc': Bits(C['paddr-width'])
+        }),
+        'out': Output(fetch_entry)
+    })
+
+    #
+    # pend_valid: the upper halfword of the previous word started a 32-bit
+    #             instruction (pend_half) at pend_pc.
+    #
+    # lo_done:    the instruction in the lower halfword of the current word was
+    #             handed off already.
+    #
+
+    pend_valid = Reg(Bits(1), reset_value=False)
+    pend_pc = Reg(Bits(C['paddr-width']), reset_value=0)
+    pend_half = Reg(Bits(16), reset_value=0)
+    pend_pd = Reg(Bits(pd_class.bitwidth), reset_value=pd_class.none)
+    lo_done = Reg(Bits(1), reset_value=False)
+
+    zero = Wire(Bits(1))
+    zero <<= 0
+
+    word = io.word.if_id
+    pred = word.pred
+    data = io.word.inst
+
+    w_lo = data(15, 0)
+    w_hi = data(31, 16)
+    c_lo = IsCompressed(w_lo)
+    c_hi = IsCompressed(w_hi)
+
+    word_pc = Wire(Bits(C['paddr-width']))
+    hi_pc = Wire(Bits(C['paddr-width']))
+
+    word_pc <<= Cat([word.pc(C['paddr-width'] - 1, 2), Fill(zero, 2)])
+    hi_pc <<= word_pc + 2
+
+    #
+    # Work out which halfwords of the word an instruction ends in. An
+    # instruction starts in the upper halfword when fetch started there, or
+    # when one ended in the lower halfword.
+    #
+
+    start_hi = word.pc(1, 1) | lo_done
+    ends_lo = ~start_hi & (pend_valid | c_lo)
+    starts_hi = start_hi | ends_lo
+    ends_hi = (starts_hi & c_hi) | (~start_hi & ~pend_valid & ~c_lo)
+    pend_next = starts_hi & ~c_hi
+
+    #
+    # The predecode class of the instruction ending in each halfword. The one
+    # ending in the upper half starts there unless it is a 32-bit instruction
+    # starting in the lower half.
+    #
+
+    pd_lo = io.predecode(pd_class.bitwidth - 1, 0)
+    pd_hi = io.predecode(2 * pd_class.bitwidth - 1, pd_class.bitwidth)
+
+    end_pd_lo = Wire(Bits(pd_class.bitwidth))
+    end_pd_hi = Wire(Bits(pd_class.bitwidth))
+
+    with pend_valid:
+        end_pd_lo <<= pend_pd
+    with otherwise:
+        end_pd_lo <<= pd_lo
+
+    with start_hi:
+        end_pd_hi <<= pd_hi
+    with otherwise:
+        end_pd_hi <<= pd_lo
+
+    if CacheConfig.FromCacheType('icache').predecode:
+        alias_lo = end_pd_lo == pd_class.none
+        alias_hi = end_pd_hi == pd_class.none
+    else:
+        alias_lo = zero
+        alias_hi = zero
+
+    hit_lo = pred.hit & ~pred.half & ends_lo & ~alias_lo
+    hit_hi = pred.hit & pred.half & ends_hi & ~alias_hi
+    taken_lo = pred.taken & ~pred.half & ends_lo & ~alias_lo
+    taken_hi = pred.taken & pred.half & ends_hi & ~alias_hi
+    bogus = pred.taken & ~taken_lo & ~taken_hi
+
+    #
+    # Both halfwords end an instruction (and the first isn't a predicted taken
+    # branch): the lower one is handed off now and the upper one next cycle.
+    #
+
+    two_step = ends_lo & ~taken_lo & ends_hi
+
+    out_valid = word.valid & (ends_lo | ends_hi)
+    consume = ~out_valid | io.accept
+    word_done = word.valid & consume & ~two_step
+
+    io.word_done <<= word_done
+
+    out_pc = Wire(Bits(C['paddr-width']))
+    out_rvc = Wire(Bits(1))
+    out_taken = Wire(Bits(1))
+
+    with ends_lo:
+        with pend_valid:
+            io.out.inst <<= Cat([w_lo, pend_half])
+            out_pc <<= pend_pc
+            out_rvc <<= False
+
+        with otherwise:
+            io.out.inst <<= Cat([Fill(zero, 16), w_lo])
+            out_pc <<= word_pc
+            out_rvc <<= True
+
+        out_taken <<= taken_lo
+        io.out.if_id.pred.half <<= 0
+        io.out.if_id.pred.hit <<= hit_lo
+
+    with otherwise:
+        with start_hi:
+            io.out.inst <<= Cat([Fill(zero, 16), w_hi])
+            out_pc <<= hi_pc
+            out_rvc <<= True
+
+        with otherwise:
+            io.out.inst <<= data
+            out_pc <<= word_pc
+            out_rvc <<= False
+
+        out_taken <<= taken_hi
+        io.out.if_id.pred.half <<= 1
+        io.out.if_id.pred.hit <<= hit_hi
+
+    io.out.if_id.valid <<= out_valid
+    io.out.if_id.pc <<= out_pc
+    io.out.if_id.pred.taken <<= out_taken
+    io.out.if_id.pred.direction <<= pred.direction
+    io.out.if_id.pred.history <<= pred.history
+    io.out.if_id.pred.path <<= pred.path
+
+    with out_taken:
+        io.out.if_id.pred.target <<= pred.target
+    with otherwise:
+        io.out.if_id.pred.target <<= NextPc(out_pc, out_rvc)
+
+    io.redirect.valid <<= word_done & bogus
+    io.redirect.target <<= word_pc + 4
+
+    io.btb_clear.valid <<= word.valid & consume & pred.hit & (
+        (~pred.half & ends_lo & alias_lo) |
+        (pred.half & ends_hi & alias_hi))
+
+    io.btb_clear.pc <<= Cat([word.pc(C['paddr-width'] - 1, 2), pred.half, zero])
+
+    with word.valid & consume:
+        with two_step:
+            lo_done <<= True
+            pend_valid <<= False
+
+        with otherwise:
+            lo_done <<= False
+            pend_valid <<= pend_next & ~taken_lo
+            pend_pc <<= hi_pc
+            pend_half <<= w_hi
+            pend_pd <<= pd_hi
+
+    with io.flush:
+        lo_done <<= False
+        pend_valid <<= False
+
+    NameSignals(locals())
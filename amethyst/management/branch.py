@@ -4,38 +4,78 @@ from ..support import *
 @Module
 def BranchUnit():
     io = Io({
-        'mem_pc': Input(Bits(C['paddr-width'])),
-        'ex_pc': Input(Bits(C['paddr-width'])),
-        'branch': Input({
-            'valid': Bits(1),
-            'taken': Bits(1),
-            'target': Bits(C['paddr-width']),
-            'is_return': Bits(1),
-        }),
-        'mispred_ex_bypass': Output(Bits(1)),
-        'mispred': Output(mispred_bundle)
+        'branch': Input(branch_bundle),
+        'stall': Input(Bits(1)),
+        'frontend_stall': Input(Bits(1)),
+        'mispred': Output(mispred_bundle),
+        'resolve': Output(branch_resolve_bundle)
     })
 
     mispred = Reg(mispred_bundle, reset_value=mispred_bundle_reset)
+    resolve = Reg(branch_resolve_bundle, reset_value=branch_resolve_bundle_reset)
 
-    io.mispred_ex_bypass <<= False
     mispred.valid <<= False
 
+    #
+    # Branches are resolved in the execute stage. A branch is only reported
+    # once, in the cycle it leaves execute (I.e. not while the backend is
+    # stalled and it will be seen again).
+    #
+
+    branch_valid = io.branch.valid & ~io.stall & ~mispred.valid
+
+    #
+    # The BTB and direction predictor are keyed by the pc of the last halfword
+    # of a branch (see frontend/frontend.py), which is the branch pc itself for
+    # a compressed branch.
+    #
+
+    end_pc = EndPc(io.branch.pc, io.branch.rvc)
+
+    #
+    # Every resolved branch (correctly predicted or not) is reported on the
+    # resolve port so the direction predictor can train on it. A branch that
+    # follows a misprediction is on the wrong path and must not be reported.
+    #
+
+    resolve.valid <<= branch_valid & io.branch.is_branch
+    resolve.pc <<= end_pc
+    resolve.taken <<= io.branch.taken
+    resolve.indirect <<= io.branch.is_indirect
+    resolve.target <<= io.branch.target
+    resolve.pred_taken <<= io.branch.pred_taken
+    resolve.history <<= io.branch.history
+    resolve.path <<= io.branch.path
+
+    #
+    # A branch mispredicted when the PC the frontend fetched after it doesn't
+    # match its actual next PC.
     #
     # N.B. It'll never be the case that back to back mispredictions are
     # consumed since the following instruction (branch or not) is to be
     # flushed.
     #
 
-    with (io.branch.target != io.ex_pc) & io.branch.valid & ~mispred.valid:
-        io.mispred_ex_bypass <<= True
+    with (io.branch.target != io.branch.pred_target) & branch_valid:
         mispred.valid <<= True
-        mispred.pc <<= io.mem_pc
+        mispred.pc <<= end_pc
         mispred.target <<= io.branch.target
         mispred.taken <<= io.branch.taken
+        mispred.is_branch <<= io.branch.is_branch
+        mispred.is_call <<= io.branch.is_call
         mispred.is_return <<= io.branch.is_return
+        mispred.is_indirect <<= io.branch.is_indirect
+        mispred.ras <<= io.branch.ras
+
+    #
+    # The frontend can't take the redirect while it is stalled (on an icache
+    # miss), so the misprediction is held until it can.
+    #
+
+    with mispred.valid & io.frontend_stall:
+        mispred.valid <<= True
 
     io.mispred <<= mispred
+    io.resolve <<= resolve
 
     NameSignals(locals())
-
@@ -8,6 +8,9 @@ def HazardUnit():
         'ex_rd': Input(Bits(Log2Ceil(C['reg-count']))),
         'id_rs1': Input(Bits(Log2Ceil(C['reg-count']))),
         'id_rs2': Input(Bits(Log2Ceil(C['reg-count']))),
+        'id_rd': Input(Bits(Log2Ceil(C['reg-count']))),
+        'id_reg_write': Input(Bits(1)),
+        'pending': Input([Bits(1) for _ in range(C['reg-count'])]),
         'data_hazard': Output(Bits(1))
     })
 
@@ -23,4 +26,26 @@ def HazardUnit():
         with (io.ex_rd == io.id_rs1) | (io.ex_rd == io.id_rs2):
             io.data_hazard <<= 1
 
+    #
+    # With a non-blocking dcache, a load that missed writes its register some
+    # time after it has left the pipeline (see cache/mshr.py). Until then, the
+    # register is pending and nothing may read it or (since the load's write
+    # would land on top) write it.
+    #
+    # N.B. A register only becomes pending once the load has missed, in the
+    # mem stage, by which time the instruction behind it would already be in
+    # execute. So an instruction that writes the register a load in execute
+    # is going to write is held in decode as well, until it is known whether
+    # the load's write will come late.
+    #
+
+    with io.ex_mem_read & io.id_reg_write & (io.ex_rd == io.id_rd):
+        io.data_hazard <<= 1
+
+    with io.pending[io.id_rs1] | io.pending[io.id_rs2]:
+        io.data_hazard <<= 1
+
+    with io.id_reg_write & io.pending[io.id_rd]:
+        io.data_hazard <<= 1
+
     NameSignals(locals())
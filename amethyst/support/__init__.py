@@ -1,4 +1,5 @@
 from .config import *
 from .instructions import *
 from .interfaces import *
-from .ops import *
\ No newline at end of file
+from .ops import *
+from .replacement import *
\ No newline at end of file
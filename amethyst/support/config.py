@@ -1,9 +1,70 @@
 import json
+import os
 from dataclasses import dataclass
 from atlas import *
 
+#
+# The default config (config.json) has all of the optional features turned
+# off. The configs in configs/ each turn a feature on, by overriding the
+# settings they name. One is picked with AMETHYST_CONFIG (see the Makefile).
+#
+
+def MergeConfig(config, overrides):
+    for key, value in overrides.items():
+        if isinstance(value, dict) and isinstance(config.get(key), dict):
+            MergeConfig(config[key], value)
+        else:
+            config[key] = value
+
 C = json.load(open('config.json', 'r'))
 
+if os.environ.get('AMETHYST_CONFIG'):
+    MergeConfig(C, json.load(open(os.environ['AMETHYST_CONFIG'], 'r')))
+
+#
+# Lines are written to memory whole (mem-width), but read responses come back
+# over a bus that may be narrower (mem-bus-width), a beat at a time.
+#
+
+mem_bus_width = C.get('mem-bus-width', C['mem-width'])
+
+#
+# The global history a branch was predicted with travels down the pipeline
+# with it (see frontend/bpred.py), as does the path history of the indirect
+# predictor (see frontend/indirect.py). TAGE keeps as much history as its
+# longest table uses.
+#
+
+bpred_history_width = \
+    C['bpred']['tage']['tables'][-1]['history-length'] \
+    if C['bpred']['type'] == 'tage' else C['bpred']['history-length']
+
+ind_path_width = C['indirect']['history-length']
+
+#
+# The L2 is optional, and is enabled by giving it a section ('l2') of its own.
+# It is shared by the icache and dcache, and has the only memory port (see
+# cache/l2.py).
+#
+
+has_l2 = 'l2' in C
+
+#
+# A cache can return its response in stage 1 (the tag check), rather than
+# latching it for stage 2, when the way mux is small enough to fit in the same
+# cycle as the tag compare. This is how the 2-stage frontend is built.
+#
+
+comb_resp_max_ways = 4
+
+#
+# Cache replacement policies (see cache/meta.py). True LRU keeps a full age
+# per way, so it is only offered for small sets.
+#
+
+replacement_policies = ['random', 'plru', 'lru']
+lru_max_ways = 4
+
 #
 # Since this code is used for both the I+D caches, some disambiguation between
 # the parameter sets is needed. The CacheConfig class holds all the relevant
@@ -21,6 +82,17 @@ class CacheConfig(object):
     num_sets : int
     num_ways : int
     line_width : int
+    line_buffer : bool = False
+    prefetch_degree : int = 0
+    target_prefetch : bool = False
+    predecode : bool = False
+    comb_resp : bool = False
+    mshrs : int = 0
+    mshr_targets : int = 4
+    wb_entries : int = 0
+    sb_entries : int = 0
+    victim_entries : int = 0
+    replacement : str = 'plru'
 
     #
     # Parameters computed from above.
@@ -32,6 +104,11 @@ class CacheConfig(object):
     line_index_width : int = None
     untag_width : int = None
     tag_width : int = None
+    line_addr_width : int = None
+    prefetch_slots : int = None
+    refill_beats : int = None
+    beat_index_width : int = None
+    early_restart : bool = None
 
     def __post_init__(self):
         self.set_addr_width = Log2Ceil(self.num_sets)
@@ -40,6 +117,77 @@ class CacheConfig(object):
         self.line_index_width = Log2Ceil(self.line_width_bytes)
         self.untag_width = self.set_addr_width + self.line_index_width
         self.tag_width = C['paddr-width'] - self.untag_width
+        self.line_addr_width = C['paddr-width'] - self.line_index_width
+        self.prefetch_slots = \
+            self.prefetch_degree + (1 if self.target_prefetch else 0)
+        self.refill_beats = self.line_width // mem_bus_width
+        self.beat_index_width = Log2Ceil(mem_bus_width // 8)
+
+        #
+        # A miss can restart as soon as the beat holding its word arrives,
+        # except with predecode, which needs the whole line. N.B. A blocking
+        # cache with a victim cache doesn't restart early either, since a line
+        # can only be swapped back into it while no miss is in progress.
+        #
+
+        self.early_restart = \
+            (self.refill_beats > 1) and not self.predecode and \
+            not (self.victim_entries > 0 and self.mshrs == 0)
+
+        assert self.line_width % mem_bus_width == 0, \
+            f'{self.cache_type}: lines must be a whole number of bus beats'
+
+        assert self.refill_beats == 1 << Log2Ceil(self.refill_beats), \
+            f'{self.cache_type}: the number of beats per line must be a ' \
+            f'power of 2'
+
+        assert mem_bus_width >= C['core-width'], \
+            f'the memory bus must be at least {C["core-width"]} bits wide'
+
+        assert (not self.comb_resp) or (self.num_ways <= comb_resp_max_ways), \
+            f'{self.cache_type}: a combinational response needs at most ' \
+            f'{comb_resp_max_ways} ways'
+
+        #
+        # N.B. The line buffer and prefetch buffer hold copies of lines that
+        # stores don't update, so only the icache can have them.
+        #
+
+        assert (not self.line_buffer) or (self.cache_type == 'icache'), \
+            f'{self.cache_type}: only the icache can have a line buffer'
+
+        assert (self.prefetch_slots == 0) or (self.cache_type == 'icache'), \
+            f'{self.cache_type}: only the icache can prefetch'
+
+        assert (self.mshrs == 0) or (self.cache_type == 'dcache'), \
+            f'{self.cache_type}: only the dcache can have MSHRs'
+
+        assert (self.wb_entries == 0) or (self.cache_type == 'dcache'), \
+            f'{self.cache_type}: only the dcache can have a write-back buffer'
+
+        assert (self.sb_entries == 0) or (self.cache_type == 'dcache'), \
+            f'{self.cache_type}: only the dcache can have a store buffer'
+
+        assert (self.victim_entries == 0) or (self.cache_type == 'dcache'), \
+            f'{self.cache_type}: only the dcache can have a victim cache'
+
+        assert (self.victim_entries == 0) or \
+            ((self.victim_entries > 1) and
+                (self.victim_entries == 1 << Log2Ceil(self.victim_entries))), \
+            f'{self.cache_type}: the victim cache needs a power of 2 ' \
+            f'(and at least 2) entries'
+
+        assert self.replacement in replacement_policies, \
+            f'{self.cache_type}: unknown replacement policy ' \
+            f'{self.replacement}'
+
+        assert (self.replacement != 'plru') or \
+            (self.num_ways == 1 << self.way_addr_width), \
+            f'{self.cache_type}: plru needs a power of 2 ways'
+
+        assert (self.replacement != 'lru') or \
+            (self.num_ways <= lru_max_ways), \
+            f'{self.cache_type}: lru needs at most {lru_max_ways} ways'
 
     def Tag(self, addr):
         return addr(C['paddr-width'] - 1, self.untag_width)
@@ -50,10 +198,28 @@ class CacheConfig(object):
     def Index(self, addr):
         return addr(self.line_index_width - 1, 0)
 
+    def LineAddr(self, addr):
+        return addr(C['paddr-width'] - 1, self.line_index_width)
+
+    def Beat(self, addr):
+        return addr(self.line_index_width - 1, self.beat_index_width)
+
     @staticmethod
     def FromCacheType(cache_type : str):
         return CacheConfig(
             cache_type=cache_type,
             num_sets=C[cache_type]['num-sets'],
             num_ways=C[cache_type]['num-ways'],
-            line_width=C[cache_type]['line-width'])
\ No newline at end of file
+            line_width=C[cache_type]['line-width'],
+            line_buffer=C[cache_type].get('line-buffer', False),
+            prefetch_degree=C[cache_type].get('prefetch-degree', 0),
+            target_prefetch=C[cache_type].get('target-prefetch', False),
+            predecode=C[cache_type].get('predecode', False),
+            comb_resp=(cache_type == 'icache') and \
+                (C['frontend'].get('fetch-stages', 3) == 2),
+            mshrs=C[cache_type].get('mshrs', 0),
+            mshr_targets=C[cache_type].get('mshr-targets', 4),
+            wb_entries=C[cache_type].get('writeback-buffer', 0),
+            sb_entries=C[cache_type].get('store-buffer', 0),
+            victim_entries=C[cache_type].get('victim-cache', 0),
+            replacement=C[cache_type].get('replacement', 'plru'))
\ No newline at end of file
@@ -19,6 +19,7 @@ Rs1 = lambda inst: inst(19, 15)
 Rs2 = lambda inst: inst(24, 20)
 Funct3 = lambda inst: inst(14, 12)
 Funct7 = lambda inst: inst(31, 25)
+IsCompressed = lambda inst: inst(1, 0) != 0b11
 
 class Opcodes(object):
     LOAD = 0b0000011
@@ -273,12 +274,13 @@ instructions = {
     #
 
     'lui': Inst.U(Pattern(Opcodes.LUI, None, None), ExCtrl(AluSrc.RS2, 0b00, True), MemCtrl.Nop(), WbCtrl.Reg()),
+    'auipc': Inst.U(Pattern(Opcodes.AUIPC, None, None), ExCtrl(AluSrc.RS2, 0b00, auipc=True), MemCtrl.Nop(), WbCtrl.Reg()),
 
     #
     # J-Type Instructions
     #
 
-    'jal': Inst.J(Pattern(Opcodes.JAL, None, None), ExCtrl(AluSrc.RS2, 0b00), MemCtrl.Jal(), WbCtrl.Nop())
+    'jal': Inst.J(Pattern(Opcodes.JAL, None, None), ExCtrl(AluSrc.RS2, 0b00), MemCtrl.Jal(), WbCtrl.Reg())
 }
 
 class AluInsts(object):
@@ -13,11 +13,17 @@ mem_read_request = {
     'addr': Bits(C['paddr-width']),
 }
 
+#
+# N.B. A line comes back as a number of beats (see mem_bus_width). The beat
+# holding the requested address comes first and the rest follow in wrapping
+# order, each with the address of its first byte.
+#
+
 mem_read_response = {
     'valid': Bits(1),
     'ready': Flip(Bits(1)),
     'addr': Bits(C['paddr-width']),
-    'data': Bits(C['mem-width'])
+    'data': Bits(mem_bus_width)
 }
 
 mem_write_request = {
@@ -33,24 +39,93 @@ mem_bundle = {
     'write': mem_write_request
 }
 
+prefetch_hint_bundle = {
+    'valid': Bits(1),
+    'addr': Bits(C['paddr-width'])
+}
+
+#
+# Fetch redirect bundle: a request from within the frontend to restart fetch
+# at target (see frontend/frontend.py).
+#
+
+fetch_redirect_bundle = {
+    'valid': Bits(1),
+    'target': Bits(C['paddr-width'])
+}
+
+fetch_redirect_bundle_reset = {
+    'valid': False,
+    'target': 0
+}
+
+#
+# Decode redirect bundle: a direct jump (or a backward branch that missed in
+# the BTB) redirecting fetch from decode. pc is the pc of the last halfword of
+# the instruction, which the BTB learns target for.
+#
+
+decode_redirect_bundle = {
+    'valid': Bits(1),
+    'pc': Bits(C['paddr-width']),
+    'target': Bits(C['paddr-width'])
+}
+
+#
+# rd is the register a load writes. A non-blocking cache (see cache/mshr.py)
+# writes it back itself when the load misses, in which case the response is
+# marked pending.
+#
+# data is the value a store writes. The bytes of it that are written follow
+# from rtype (see cache/merge.py).
+#
+
 cpu_cache_req = {
     'valid': Bits(1),
     'addr': Bits(C['paddr-width']),
     'rtype': Bits(access_rtype.bitwidth),
     'read': Bits(1),
+    'rd': Bits(Log2Ceil(C['reg-count'])),
+    'data': Bits(C['core-width'])
 }
 
 cpu_cache_req_reset = {
     'valid': False,
     'addr': 0,
     'rtype': 0,
-    'read': False
+    'read': False,
+    'rd': 0,
+    'data': 0
 }
 
 cpu_cache_resp = {
+    'data': Bits(C['core-width']),
+    'pending': Bits(1)
+}
+
+#
+# Register fill bundle: a load that missed in a non-blocking cache being
+# written to the register file once its line arrives. The write port is shared
+# with writeback, so a fill only happens when the port is free (ready).
+#
+
+reg_fill_bundle = {
+    'valid': Bits(1),
+    'ready': Flip(Bits(1)),
+    'rd': Bits(Log2Ceil(C['reg-count'])),
     'data': Bits(C['core-width'])
 }
 
+#
+# Predecode classes: the kind of control flow instruction that starts at a
+# halfword of an icache line, as worked out when the line is refilled (see
+# cache/predecode.py). The icache reports the classes of both halfwords of a
+# fetched word.
+#
+
+pd_class = Enum(['none', 'branch', 'jump', 'call', 'ret', 'indirect'])
+predecode_word_width = 2 * pd_class.bitwidth
+
 #
 # Control signal bundles
 #
@@ -113,10 +188,70 @@ writeback_ctrl_bundle_reset = {
     'write_reg': False
 }
 
+#
+# Fetch prediction bundle: what the frontend predicted for an instruction. This
+# travels down the pipeline with the instruction so that later stages can tell
+# when the prediction was wrong. target is the PC the frontend fetched next.
+#
+# The frontend fetches aligned 32-bit words, which can hold two compressed
+# instructions. half is the halfword of the word in which the predicted taken
+# branch ends (see frontend/frontend.py). hit is set when the BTB had an entry
+# for the instruction (taken or not). direction is what the direction
+# predictor predicted (whether or not the BTB hit) and history is the global
+# history it was read with, which the branch trains with once it resolves.
+# Likewise, path is the path history the indirect predictor was read with.
+#
+
+fetch_pred_bundle = {
+    'taken': Bits(1),
+    'target': Bits(C['paddr-width']),
+    'half': Bits(1),
+    'hit': Bits(1),
+    'direction': Bits(1),
+    'history': Bits(bpred_history_width),
+    'path': Bits(ind_path_width)
+}
+
+fetch_pred_bundle_reset = {
+    'taken': False,
+    'target': 0,
+    'half': 0,
+    'hit': False,
+    'direction': False,
+    'history': 0,
+    'path': 0
+}
+
+#
+# RAS checkpoint bundle: the state of the return address stack right after an
+# instruction was decoded (see frontend/ras.py). It travels down the pipeline
+# with the instruction so the RAS can be repaired if the instruction
+# mispredicts.
+#
+
+ras_checkpoint_bundle = {
+    'ptr': Bits(Log2Ceil(C['ras']['size'])),
+    'count': Bits(Log2Ceil(C['ras']['size'] + 1)),
+    'top': Bits(C['paddr-width']),
+    'pop': Bits(1)
+}
+
+ras_checkpoint_bundle_reset = {
+    'ptr': 0,
+    'count': 0,
+    'top': 0,
+    'pop': False
+}
+
 ctrl_bundle = {
     'valid': Bits(1),
     'inst': Bits(32),
     'pc': Bits(C['paddr-width']),
+    'pred': fetch_pred_bundle,
+    'ras': ras_checkpoint_bundle,
+    'is_call': Bits(1),
+    'is_return': Bits(1),
+    'rvc': Bits(1),
     'ex': execute_ctrl_bundle,
     'mem': mem_ctrl_bundle,
     'wb': writeback_ctrl_bundle
@@ -126,6 +261,11 @@ ctrl_bundle_reset = {
     'valid': False,
     'inst': 0,
     'pc': 0,
+    'pred': fetch_pred_bundle_reset,
+    'ras': ras_checkpoint_bundle_reset,
+    'is_call': False,
+    'is_return': False,
+    'rvc': False,
     'ex': execute_ctrl_bundle_reset,
     'mem': mem_ctrl_bundle_reset,
     'wb': writeback_ctrl_bundle_reset
@@ -149,12 +289,24 @@ reg_write_bundle_reset = {
 
 if_bundle = {
     'valid': Bits(1),
-    'pc': Bits(C['paddr-width'])
+    'pc': Bits(C['paddr-width']),
+    'pred': fetch_pred_bundle
 }
 
 if_bundle_reset = {
     'valid': False,
-    'pc': 0
+    'pc': 0,
+    'pred': fetch_pred_bundle_reset
+}
+
+#
+# Fetch entry: an instruction as it leaves the frontend (see
+# frontend/frontend.py).
+#
+
+fetch_entry = {
+    'if_id': if_bundle,
+    'inst': Bits(32)
 }
 
 id_ex_bundle = {
@@ -197,12 +349,25 @@ mem_wb_bundle_reset = {
 # Other
 #
 
+#
+# N.B. is_branch is low when the mispredicted instruction is not a branch or
+# jump at all, but was predicted taken because it aliased with a branch in the
+# BTB. is_indirect is set for a JALR that isn't a return.
+#
+# pc is the pc of the last halfword of the mispredicted instruction, which is
+# what the BTB is keyed by (see management/branch.py).
+#
+
 mispred_bundle = {
     'valid': Bits(1),
     'pc': Bits(C['paddr-width']),
     'target': Bits(C['paddr-width']),
     'taken': Bits(1),
-    'is_return': Bits(1)
+    'is_branch': Bits(1),
+    'is_call': Bits(1),
+    'is_return': Bits(1),
+    'is_indirect': Bits(1),
+    'ras': ras_checkpoint_bundle
 }
 
 mispred_bundle_reset = {
@@ -210,13 +375,62 @@ mispred_bundle_reset = {
     'pc': 0,
     'target': 0,
     'taken': False,
-    'is_return': False
+    'is_branch': False,
+    'is_call': False,
+    'is_return': False,
+    'is_indirect': False,
+    'ras': ras_checkpoint_bundle_reset
+}
+
+#
+# Branch bundle: the outcome of a branch (or of any instruction the frontend
+# predicted taken) as computed in the execute stage.
+#
+
+branch_bundle = {
+    'valid': Bits(1),
+    'pc': Bits(C['paddr-width']),
+    'taken': Bits(1),
+    'target': Bits(C['paddr-width']),
+    'pred_target': Bits(C['paddr-width']),
+    'is_branch': Bits(1),
+    'is_call': Bits(1),
+    'is_return': Bits(1),
+    'is_indirect': Bits(1),
+    'rvc': Bits(1),
+    'ras': ras_checkpoint_bundle,
+    'pred_taken': Bits(1),
+    'history': Bits(bpred_history_width),
+    'path': Bits(ind_path_width)
+}
+
+branch_resolve_bundle = {
+    'valid': Bits(1),
+    'pc': Bits(C['paddr-width']),
+    'taken': Bits(1),
+    'indirect': Bits(1),
+    'target': Bits(C['paddr-width']),
+    'pred_taken': Bits(1),
+    'history': Bits(bpred_history_width),
+    'path': Bits(ind_path_width)
+}
+
+branch_resolve_bundle_reset = {
+    'valid': False,
+    'pc': 0,
+    'taken': False,
+    'indirect': False,
+    'target': 0,
+    'pred_taken': False,
+    'history': 0,
+    'path': 0
 }
 
 ras_ctrl_bundle = {
     'push': Bits(1),
     'pop': Bits(1),
-    'pc': Bits(C['paddr-width'])
+    'pc': Bits(C['paddr-width']),
+    'rvc': Bits(1)
 }
 
 debug_bundle = {
@@ -175,3 +175,59 @@ class ProbeOperator(Operator):
 @OpGen(cacheable=False)
 def Probe(bits, name=None):
     return ProbeOperator(bits, probe_name=name)
+
+
+def XorFold(bits, width):
+    """XOR-fold a bits signal down to width bits.
+
+    The signal is split into width-bit chunks (the last chunk is zero extended)
+    and the chunks are XOR'd together. This is used to hash long values (like
+    history registers or tags) into a small number of index / tag bits.
+    """
+
+    zero = Wire(Bits(1))
+    zero <<= 0
+
+    folded = None
+
+    for lo in range(0, bits.width, width):
+        hi = min(lo + width, bits.width) - 1
+        chunk = bits(hi, lo)
+
+        if hi - lo + 1 < width:
+            chunk = Cat([Fill(zero, width - (hi - lo + 1)), chunk])
+
+        folded = chunk if folded is None else folded ^ chunk
+
+    return folded
+
+def NextPc(pc, rvc):
+    """The pc of the instruction following the one at pc.
+
+    Compressed (RVC) instructions are 2 bytes long, all others are 4.
+    """
+
+    next_pc = Wire(Bits(pc.width))
+
+    with rvc:
+        next_pc <<= pc + 2
+    with otherwise:
+        next_pc <<= pc + 4
+
+    return next_pc
+
+def EndPc(pc, rvc):
+    """The pc of the last halfword of the instruction at pc.
+
+    Branches are looked up in the BTB (and direction predictor) by this pc,
+    since it is the halfword the frontend's prediction is attached to.
+    """
+
+    end_pc = Wire(Bits(pc.width))
+
+    with rvc:
+        end_pc <<= pc
+    with otherwise:
+        end_pc <<= pc + 2
+
+    return end_pc
@@ -0,0 +1,139 @@
+from atlas import *
+
+#
+# True LRU replacement helpers.
+#
+# The LRU state of a set is a list of per-way ages, each Log2Ceil(num_ways)
+# bits wide. Age 0 is the most recently used way and age num_ways - 1 is the
+# least recently used (the victim). The ages are packed into a single bits
+# value (way 0 in the lsbs) so the state of a set fits in one Mem entry (as in
+# the BTB) or one Reg (as in the cache meta arrays, see cache/meta.py).
+#
+# N.B. Touching saturates at num_ways - 1 and ages every way that is at least
+# as recently used as the touched way. The BTB keeps its state in a Mem, whose
+# contents are not reset, so there the ages of a set start out as arbitrary
+# values rather than a permutation. Together with filling invalid ways first,
+# this settles the state of a set into a proper permutation after num_ways
+# fills.
+#
+
+def LessThan(a, b):
+    """Unsigned a < b, computed from the borrow of a zero extended subtract."""
+
+    zero = Wire(Bits(1))
+    zero <<= 0
+
+    diff = Cat([zero, a]) - Cat([zero, b])
+    return diff(a.width, a.width)
+
+def LruUnpack(state, num_ways):
+    age_bits = Log2Ceil(num_ways)
+    return [
+        state((way + 1) * age_bits - 1, way * age_bits)
+        for way in range(num_ways)
+    ]
+
+def LruPack(ages):
+    return Cat(list(reversed(ages)))
+
+def LruTouch(ages, way):
+    """Produce the ages of a set after the given way has been accessed."""
+
+    num_ways = len(ages)
+    age_bits = Log2Ceil(num_ways)
+
+    touched_age = Wire(Bits(age_bits))
+    touched_age <<= 0
+
+    for w in range(num_ways):
+        with way == w:
+            touched_age <<= ages[w]
+
+    new_ages = [Wire(Bits(age_bits)) for _ in range(num_ways)]
+
+    for w in range(num_ways):
+        new_ages[w] <<= ages[w]
+
+        with ~LessThan(touched_age, ages[w]) & (ages[w] != num_ways - 1):
+            new_ages[w] <<= ages[w] + 1
+
+        with way == w:
+            new_ages[w] <<= 0
+
+    NameSignals(locals())
+    return new_ages
+
+def LruVictim(ages):
+    """Produce the least recently used way of a set."""
+
+    num_ways = len(ages)
+
+    victim = Wire(Bits(Log2Ceil(num_ways)))
+    victim <<= 0
+
+    for w in range(num_ways):
+        with ages[w] == num_ways - 1:
+            victim <<= w
+
+    NameSignals(locals())
+    return victim
+
+#
+# Tree pseudo-LRU replacement helpers.
+#
+# The PLRU state of a set is a binary tree of num_ways - 1 bits (num_ways must
+# be a power of 2), kept heap style: the children of node n are nodes 2n + 1
+# and 2n + 2, and node n is bit n of the state. Each node points to the less
+# recently used half of its subtree (0 for the lower ways and 1 for the upper
+# ways), so following the nodes down from the root leads to the victim.
+# Touching a way points every node on its path away from it.
+#
+
+def PlruPath(way : int, num_ways : int):
+    """The (node, direction) pairs on the path from the root to a way."""
+
+    levels = Log2Ceil(num_ways)
+
+    return [
+        ((1 << l) - 1 + (way >> (levels - l)), (way >> (levels - 1 - l)) & 1)
+        for l in range(levels)
+    ]
+
+def PlruTouch(state, way, num_ways):
+    """Produce the PLRU state of a set after the given way has been accessed."""
+
+    nodes = [Wire(Bits(1)) for _ in range(num_ways - 1)]
+
+    for n in range(num_ways - 1):
+        nodes[n] <<= state(n, n)
+
+    for w in range(num_ways):
+        with way == w:
+            for (n, direction) in PlruPath(w, num_ways):
+                nodes[n] <<= 1 - direction
+
+    new_state = Wire(Bits(num_ways - 1))
+    new_state <<= Cat(list(reversed(nodes)))
+
+    NameSignals(locals())
+    return new_state
+
+def PlruVictim(state, num_ways):
+    """Produce the pseudo least recently used way of a set."""
+
+    victim = Wire(Bits(Log2Ceil(num_ways)))
+    victim <<= 0
+
+    for w in range(num_ways):
+        follows = None
+
+        for (n, direction) in PlruPath(w, num_ways):
+            node = state(n, n)
+            step = node if direction == 1 else ~node
+            follows = step if follows is None else follows & step
+
+        with follows:
+            victim <<= w
+
+    NameSignals(locals())
+    return victim
@@ -10,7 +10,7 @@ all: $(APP).img
 	$(OBJCOPY) -O binary $< $@
 
 %.elf: %.S ../link.ld
-	$(CC) -T../link.ld $< -mabi=lp64 -march=rv64i -nostdlib -static -Wl,--no-gc-sections -o $@
+	$(CC) -T../link.ld $< -mabi=lp64 -march=rv64ic -nostdlib -static -Wl,--no-gc-sections -o $@
 
 clean:
 	rm -f *.bin *.img *.elf
\ No newline at end of file
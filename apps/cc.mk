@@ -11,7 +11,7 @@ $(APP).bin: $(APP).elf
 	$(OBJCOPY) -O binary $< $@
 
 $(APP).elf: $(APP).c ../link.ld
-	$(CC) -T../link.ld ../crt0.S $< -march=rv64g -nostdlib -static -Wl,--no-gc-sections -o $@
+	$(CC) -T../link.ld ../crt0.S $< -march=rv64gc -nostdlib -static -Wl,--no-gc-sections -o $@
 
 clean:
 	rm -f *.bin *.img *.elf
\ No newline at end of file
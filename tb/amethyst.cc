@@ -9,6 +9,7 @@
 #include "VAmethyst_Amethyst.h"
 
 #define MEMSIZE (uint64_t)0x20000
+#define EBREAK 0x00100073
 
 #define ASSERT(condition) \
     if (!(condition)) { \
@@ -24,37 +25,125 @@ double sc_time_stamp() {
     return simtime;
 }
 
+#define LINE_BYTES 64
+
+//
+// Memory is MEM_LATENCY cycles away: the first beat of a line is returned that
+// many cycles after the read is taken, and the rest follow one per cycle.
+//
+
+#define MEM_LATENCY 40
+
+#define MAX_CYCLES 100000
+
 typedef struct _ReadResponse {
+    uint64_t ready;
     uint64_t addr;
     uint32_t data[16];
 } ReadResponse;
 
+#if HAS_L2
+std::queue<ReadResponse> mqueue;
+#else
 std::queue<ReadResponse> iqueue;
 std::queue<ReadResponse> dqueue;
+#endif
 
 VAmethyst * top;
 VerilatedVcdC * vcd;
 
+//
+// Lines are returned over the memory bus a beat at a time (one response per
+// beat), starting with the beat holding the requested address and wrapping
+// around the line. A beat is as wide as the response data port (mem-bus-width,
+// see configs/mem-bus.json).
+//
+
+void QueueLine(
+    std::queue<ReadResponse>& queue,
+    uint8_t * mem,
+    uint64_t addr,
+    uint64_t beat_bytes)
+{
+    uint64_t line = addr & ~(uint64_t)(LINE_BYTES - 1);
+    uint64_t first = addr & (LINE_BYTES - 1) & ~(beat_bytes - 1);
+
+    ASSERT(line < (MEMSIZE - LINE_BYTES))
+
+    for (uint64_t i = 0; i < LINE_BYTES; i += beat_bytes) {
+        ReadResponse resp;
+        resp.ready = simtime / 2 + MEM_LATENCY + i / beat_bytes;
+        resp.addr = line + ((first + i) % LINE_BYTES);
+        memcpy(resp.data, mem + resp.addr, beat_bytes);
+        queue.push(resp);
+    }
+}
+
+bool ResponseReady(std::queue<ReadResponse>& queue) {
+    return !queue.empty() && queue.front().ready <= simtime / 2;
+}
+
+//
+// With the L2 (see configs/l2.json), the processor has a single memory port,
+// otherwise the icache and dcache each have their own.
+//
+
+#if HAS_L2
+void HandleMem(VAmethyst * top, uint8_t * mem) {
+    top->io_mem_read_ready = true;
+
+    if (top->io_mem_read_valid) {
+        QueueLine(
+            mqueue,
+            mem,
+            top->io_mem_read_addr,
+            sizeof(top->io_mem_resp_data));
+    }
+
+    top->io_mem_resp_valid = false;
+
+    if (top->io_mem_resp_ready && ResponseReady(mqueue)) {
+        const ReadResponse& resp = mqueue.front();
+        top->io_mem_resp_valid = true;
+        top->io_mem_resp_addr = resp.addr;
+        memcpy(
+            &top->io_mem_resp_data,
+            resp.data,
+            sizeof(top->io_mem_resp_data));
+        mqueue.pop();
+    }
+
+    top->io_mem_write_ready = true;
+
+    if (top->io_mem_write_valid) {
+        memcpy(
+            mem + top->io_mem_write_addr,
+            top->io_mem_write_data,
+            LINE_BYTES);
+    }
+}
+#else
 void HandleIMem(VAmethyst * top, uint8_t * mem) {
     top->io_imem_read_ready = true;
 
     if (top->io_imem_read_valid) {
-        ReadResponse resp;
-        resp.addr = top->io_imem_read_addr & ~0x3F;
-
-        ASSERT(resp.addr < (MEMSIZE - 64))
-
-        memcpy(resp.data, mem + resp.addr, 64);
-        iqueue.push(resp);
+        QueueLine(
+            iqueue,
+            mem,
+            top->io_imem_read_addr,
+            sizeof(top->io_imem_resp_data));
     }
 
     top->io_imem_resp_valid = false;
 
-    if (top->io_imem_resp_ready && !iqueue.empty()) {
+    if (top->io_imem_resp_ready && ResponseReady(iqueue)) {
         const ReadResponse& resp = iqueue.front();
         top->io_imem_resp_valid = true;
         top->io_imem_resp_addr = resp.addr;
-        memcpy(top->io_imem_resp_data, resp.data, 64);
+        memcpy(
+            &top->io_imem_resp_data,
+            resp.data,
+            sizeof(top->io_imem_resp_data));
         iqueue.pop();
     }
 
@@ -65,31 +154,36 @@ void HandleDMem(VAmethyst * top, uint8_t * mem) {
     top->io_dmem_read_ready = true;
 
     if (top->io_dmem_read_valid) {
-        ReadResponse resp;
-        resp.addr = top->io_dmem_read_addr & ~0x3F;
-
-        ASSERT(resp.addr < (MEMSIZE - 64))
-
-        memcpy(resp.data, mem + resp.addr, 64);
-        dqueue.push(resp);
+        QueueLine(
+            dqueue,
+            mem,
+            top->io_dmem_read_addr,
+            sizeof(top->io_dmem_resp_data));
     }
 
     top->io_dmem_resp_valid = false;
 
-    if (top->io_dmem_resp_ready && !dqueue.empty()) {
+    if (top->io_dmem_resp_ready && ResponseReady(dqueue)) {
         const ReadResponse& resp = dqueue.front();
         top->io_dmem_resp_valid = true;
         top->io_dmem_resp_addr = resp.addr;
-        memcpy(top->io_dmem_resp_data, resp.data, 64);
+        memcpy(
+            &top->io_dmem_resp_data,
+            resp.data,
+            sizeof(top->io_dmem_resp_data));
         dqueue.pop();
     }
 
     top->io_dmem_write_ready = true;
 
     if (top->io_dmem_write_valid) {
-        memcpy(mem + top->io_dmem_write_addr, top->io_dmem_write_data, 64);
+        memcpy(
+            mem + top->io_dmem_write_addr,
+            top->io_dmem_write_data,
+            LINE_BYTES);
     }
 }
+#endif
 
 void HandlePcLog(VAmethyst * top) {
     if (top->io_debug_pc_trigger) {
@@ -179,6 +273,211 @@ void PipeView(VAmethyst * top) {
 }
 
 
+//
+// Counters stop (and the simulation ends) once an ebreak retires, so cycles is
+// the run time of the program.
+//
+
+typedef struct _PerfCounters {
+    bool halted;
+    uint64_t cycles;
+    uint64_t branches;
+    uint64_t mispreds;
+    uint64_t decode_redirects;
+    uint64_t returns;
+    uint64_t return_mispreds;
+    uint64_t indirects;
+    uint64_t indirect_mispreds;
+    uint64_t icache_accesses;
+    uint64_t icache_misses;
+    uint64_t icache_prefetch_useful;
+    uint64_t icache_prefetch_useless;
+    uint64_t dcache_misses;
+    uint64_t dcache_stall_cycles;
+    uint64_t dcache_wb_reclaims;
+    uint64_t dcache_store_forwards;
+    uint64_t dcache_req_stall_cycles;
+    uint64_t dcache_victim_hits;
+    uint64_t dcache_victim_misses;
+    uint64_t l2_hits;
+    uint64_t l2_misses;
+    uint64_t loop_buffer_insts;
+    uint64_t fused_lui_addi;
+    uint64_t fused_auipc_addi;
+    uint64_t fused_slli_srli;
+    uint64_t fused_auipc_jalr;
+} PerfCounters;
+
+PerfCounters perf = {0};
+
+void UpdatePerfCounters(VAmethyst * top) {
+    if (perf.halted) {
+        return;
+    }
+
+    perf.cycles++;
+
+    if (top->Amethyst->probe_wb_valid &&
+        top->Amethyst->probe_wb_inst == EBREAK) {
+        perf.halted = true;
+    }
+
+    if (top->Amethyst->probe_branch_resolve) {
+        perf.branches++;
+    }
+
+    if (top->Amethyst->probe_mispred) {
+        perf.mispreds++;
+    }
+
+    if (top->Amethyst->probe_decode_redirect) {
+        perf.decode_redirects++;
+    }
+
+    if (top->Amethyst->probe_return_resolve) {
+        perf.returns++;
+    }
+
+    if (top->Amethyst->probe_return_mispred) {
+        perf.return_mispreds++;
+    }
+
+    if (top->Amethyst->probe_indirect_resolve) {
+        perf.indirects++;
+    }
+
+    if (top->Amethyst->probe_indirect_mispred) {
+        perf.indirect_mispreds++;
+    }
+
+    if (top->Amethyst->probe_icache_access) {
+        perf.icache_accesses++;
+    }
+
+    if (top->Amethyst->probe_icache_miss) {
+        perf.icache_misses++;
+    }
+
+    if (top->Amethyst->probe_icache_prefetch_useful) {
+        perf.icache_prefetch_useful++;
+    }
+
+    perf.icache_prefetch_useless +=
+        __builtin_popcount(top->Amethyst->probe_icache_prefetch_useless);
+
+    if (top->Amethyst->probe_dcache_miss) {
+        perf.dcache_misses++;
+    }
+
+    if (top->Amethyst->probe_dcache_stall) {
+        perf.dcache_stall_cycles++;
+    }
+
+    if (top->Amethyst->probe_dcache_wb_reclaim) {
+        perf.dcache_wb_reclaims++;
+    }
+
+    if (top->Amethyst->probe_dcache_store_forward) {
+        perf.dcache_store_forwards++;
+    }
+
+    if (top->Amethyst->probe_dcache_req_stall) {
+        perf.dcache_req_stall_cycles++;
+    }
+
+    if (top->Amethyst->probe_dcache_victim_hit) {
+        perf.dcache_victim_hits++;
+    }
+
+    if (top->Amethyst->probe_dcache_victim_miss) {
+        perf.dcache_victim_misses++;
+    }
+
+#if HAS_L2
+    if (top->Amethyst->probe_l2_hit) {
+        perf.l2_hits++;
+    }
+
+    if (top->Amethyst->probe_l2_miss) {
+        perf.l2_misses++;
+    }
+#endif
+
+    if (top->Amethyst->probe_loop_buffer_supply) {
+        perf.loop_buffer_insts++;
+    }
+
+    if (top->Amethyst->probe_fuse_lui_addi) {
+        perf.fused_lui_addi++;
+    }
+
+    if (top->Amethyst->probe_fuse_auipc_addi) {
+        perf.fused_auipc_addi++;
+    }
+
+    if (top->Amethyst->probe_fuse_slli_srli) {
+        perf.fused_slli_srli++;
+    }
+
+    if (top->Amethyst->probe_fuse_auipc_jalr) {
+        perf.fused_auipc_jalr++;
+    }
+}
+
+void PrintPerfCounters() {
+    printf("\n");
+    printf("cycles:      %lu%s\n", perf.cycles, perf.halted ? "" : " (no ebreak)");
+    printf("branches:    %lu\n", perf.branches);
+    printf("mispredicts: %lu\n", perf.mispreds);
+
+    if (perf.branches > 0) {
+        printf(
+            "mispredict rate: %.2f%%\n",
+            100.0 * perf.mispreds / perf.branches);
+    }
+
+    printf("decode redirects: %lu\n", perf.decode_redirects);
+    printf("returns:            %lu\n", perf.returns);
+    printf("return mispredicts: %lu\n", perf.return_mispreds);
+
+    if (perf.returns > 0) {
+        printf(
+            "return accuracy: %.2f%%\n",
+            100.0 * (perf.returns - perf.return_mispreds) / perf.returns);
+    }
+
+    printf("indirect jumps:       %lu\n", perf.indirects);
+    printf("indirect mispredicts: %lu\n", perf.indirect_mispreds);
+
+    if (perf.indirects > 0) {
+        printf(
+            "indirect accuracy: %.2f%%\n",
+            100.0 * (perf.indirects - perf.indirect_mispreds) / perf.indirects);
+    }
+
+    printf("icache array accesses: %lu\n", perf.icache_accesses);
+    printf("icache misses: %lu\n", perf.icache_misses);
+    printf("icache prefetches useful: %lu\n", perf.icache_prefetch_useful);
+    printf("icache prefetches useless: %lu\n", perf.icache_prefetch_useless);
+    printf("dcache misses: %lu\n", perf.dcache_misses);
+    printf("dcache stall cycles: %lu\n", perf.dcache_stall_cycles);
+    printf("dcache write-back buffer reclaims: %lu\n", perf.dcache_wb_reclaims);
+    printf("dcache store buffer forwards: %lu\n", perf.dcache_store_forwards);
+    printf("dcache request stall cycles: %lu\n",
+        perf.dcache_req_stall_cycles);
+    printf("dcache victim cache hits: %lu\n", perf.dcache_victim_hits);
+    printf("dcache victim cache misses: %lu\n", perf.dcache_victim_misses);
+#if HAS_L2
+    printf("l2 hits: %lu\n", perf.l2_hits);
+    printf("l2 misses: %lu\n", perf.l2_misses);
+#endif
+    printf("loop buffer instructions: %lu\n", perf.loop_buffer_insts);
+    printf("fused lui + addi:   %lu\n", perf.fused_lui_addi);
+    printf("fused auipc + addi: %lu\n", perf.fused_auipc_addi);
+    printf("fused slli + srli:  %lu\n", perf.fused_slli_srli);
+    printf("fused auipc + jalr: %lu\n", perf.fused_auipc_jalr);
+}
+
 void ITrace(VAmethyst * top) {
     static uint64_t prev = 0;
     if (top->Amethyst->probe_wb_valid) {
@@ -222,15 +521,20 @@ int main(int argc, char **argv) {
 
     top->io_reset = 0;
 
-    while (simtime < 20000) {
+    while (simtime < 2 * MAX_CYCLES && !perf.halted) {
         top->io_clock = 0;
+#if HAS_L2
+        HandleMem(top, mem);
+#else
         HandleIMem(top, mem);
         HandleDMem(top, mem);
+#endif
 
         top->eval();
         vcd->dump((vluint64_t)simtime++);
 
         PipeView(top);
+        UpdatePerfCounters(top);
         // ITrace(top);
 
         top->io_clock = 1;
@@ -239,6 +543,8 @@ int main(int argc, char **argv) {
         vcd->dump((vluint64_t)simtime++);
     }
 
+    PrintPerfCounters();
+
     vcd->close();
     top->final();
 